@@ -1,8 +1,17 @@
 from django.contrib import admin
 from django.contrib.auth import admin as auth_admin
 from django.contrib.auth.models import User
+from django.utils.translation import gettext_lazy as _
 
-from core.models import ImageJob, Plan, Thumbnail, ThumbnailSize, UserPlan
+from core.links import revoke_external_link
+from core.models import (
+    EncoderProfile,
+    ImageJob,
+    Plan,
+    Thumbnail,
+    ThumbnailSize,
+    UserPlan,
+)
 
 admin.site.unregister(User)
 
@@ -15,7 +24,56 @@ class ThumbnailSizeInline(admin.StackedInline):
 @admin.register(Plan)
 class PlanAdmin(admin.ModelAdmin):
     inlines = [ThumbnailSizeInline]
-    list_display = ("title", "keeping_original_image", "expiring_link")
+    list_display = (
+        "title",
+        "keeping_original_image",
+        "expiring_link",
+        "lazy_thumbnails",
+        "queue",
+        "encoder_profile",
+        "upload_rate",
+        "max_in_flight_jobs",
+        "megapixels_per_hour",
+    )
+    fieldsets = (
+        (
+            None,
+            {
+                "fields": (
+                    "title",
+                    "keeping_original_image",
+                    "expiring_link",
+                    "lazy_thumbnails",
+                    "queue",
+                    "encoder_profile",
+                )
+            },
+        ),
+        (
+            _("Limits"),
+            {
+                "fields": ("upload_rate", "upload_burst", "max_in_flight_jobs", "megapixels_per_hour"),
+                "description": _(
+                    "Uploads per second (up to the burst at once), jobs waiting or being processed at a time and "
+                    "megapixels uploaded per hour by each of the plan's users; empty for no limit. "
+                    "Enforced with RATE_LIMIT_URL set."
+                ),
+            },
+        ),
+    )
+
+
+@admin.register(EncoderProfile)
+class EncoderProfileAdmin(admin.ModelAdmin):
+    list_display = (
+        "name",
+        "quality",
+        "subsampling",
+        "progressive",
+        "optimize",
+        "png_compress_level",
+        "opaque_png_to_jpeg",
+    )
 
 
 class PlanInline(admin.StackedInline):
@@ -37,3 +95,10 @@ class ThumbnailInline(admin.StackedInline):
 class ImageRequestAdmin(admin.ModelAdmin):
     list_display = ("id", "original_image", "user_plan")
     inlines = [ThumbnailInline]
+    actions = ["revoke_external_links"]
+
+    @admin.action(description="Revoke external links")
+    def revoke_external_links(self, request, queryset):
+        thumbnails = Thumbnail.objects.filter(image_job__in=queryset, external_id__isnull=False)
+        for external_id, expires_at in thumbnails.values_list("external_id", "external_id_expires_at"):
+            revoke_external_link(external_id, expires_at)
@@ -0,0 +1,13 @@
+from django.apps import AppConfig
+from django.conf import settings
+
+from PIL import Image
+
+
+class CoreConfig(AppConfig):
+    default_auto_field = "django.db.models.BigAutoField"
+    name = "core"
+
+    def ready(self) -> None:
+        Image.MAX_IMAGE_PIXELS = settings.IMAGE_JOB_MAX_PIXELS
+        from core import signals  # noqa: F401
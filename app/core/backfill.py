@@ -0,0 +1,44 @@
+from collections import defaultdict
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+
+from django.db.models import Q
+
+from core.models import ImageJob, Thumbnail
+from core.plans import get_user_plan_config_by_id
+
+
+def backfillable_jobs():
+    # only done jobs that kept their original can be rendered again
+    return ImageJob.objects.filter(status=ImageJob.STATUS_DONE).exclude(Q(original_image=None) | Q(original_image=""))
+
+
+def missing_heights(jobs: List[Tuple[int, int]]) -> Dict[int, List[int]]:
+    # jobs as (job id, user plan id), by job id the heights of the current plan they have no thumbnail of
+    existing: Dict[int, Set[int]] = defaultdict(set)
+    for img_job_id, height in Thumbnail.objects.filter(
+        image_job_id__in=[img_job_id for img_job_id, _ in jobs]
+    ).values_list("image_job_id", "height"):
+        existing[img_job_id].add(height)
+    missing = {}
+    for img_job_id, user_plan_id in jobs:
+        heights = [
+            height
+            for height in get_user_plan_config_by_id(user_plan_id).plan.heights
+            if height not in existing[img_job_id]
+        ]
+        if heights:
+            missing[img_job_id] = heights
+    return missing
+
+
+def backfill_chunks(
+    after_id: int, chunk_size: int, plan_title: Optional[str] = None
+) -> Iterator[Tuple[int, List[int]]]:
+    # keyset iteration on the primary key: every chunk is an index range scan, however far into the table,
+    # yields the last scanned id with the ids of the chunk's jobs missing thumbnails
+    img_jobs = backfillable_jobs()
+    if plan_title:
+        img_jobs = img_jobs.filter(user_plan__plan__title=plan_title)
+    while chunk := list(img_jobs.filter(id__gt=after_id).order_by("id").values_list("id", "user_plan_id")[:chunk_size]):
+        after_id = chunk[-1][0]
+        yield after_id, sorted(missing_heights(chunk))
@@ -0,0 +1,526 @@
+import asyncio
+import http.cookiejar
+import math
+import os
+import platform
+import socket
+import tempfile
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from io import BytesIO
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from urllib.parse import SplitResult, urlencode, urlsplit
+from uuid import uuid4
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.db import connection, transaction
+from django.test import RequestFactory, override_settings
+from django.urls import reverse
+
+import PIL
+from asgiref.sync import async_to_sync
+from PIL import Image, ImageChops, ImageStat
+from rest_framework.test import APIRequestFactory, force_authenticate
+
+from core import joblist, plans, tasks, views
+from core.encoding import EncoderConfig, encode, output_name
+from core.imaging import build_pyramid, open_image, resize_from_pyramid, resized_width
+from core.links import sign_external_link
+from core.models import EncoderProfile, ImageJob, Plan, Thumbnail, UserPlan
+from core.pagination import KeysetPagination
+from core.plans import get_user_plan_config_by_id
+
+SAMPLE_IMAGE = os.path.join(settings.BASE_DIR, "testdata", "sample.jpg")
+
+THUMBNAIL_HEIGHTS = [800, 400, 200]
+
+BUILTIN_PLANS = ["Basic", "Premium", "Enterprise"]
+
+
+def synthetic_image(megapixels: float, aspect: float = 4 / 3) -> Image.Image:
+    # deterministic, detailed content: a mandelbrot rendered at low resolution and upscaled,
+    # mixed with gradients so every channel differs
+    height = round(math.sqrt(megapixels * 1_000_000 / aspect))
+    width = round(height * aspect)
+    base_size = (max(width // 4, 1), max(height // 4, 1))
+    mandelbrot = Image.effect_mandelbrot(base_size, (-2.0, -1.2, 1.0, 1.2), 100)
+    red = mandelbrot.resize((width, height), Image.Resampling.BICUBIC)
+    green = Image.linear_gradient("L").resize((width, height))
+    blue = ImageChops.multiply(red, Image.radial_gradient("L").resize((width, height)))
+    return Image.merge("RGB", (red, green, blue))
+
+
+def synthetic_image_file(megapixels: float, fmt: str = "JPEG") -> str:
+    ext = {"JPEG": "jpg", "PNG": "png"}[fmt]
+    filename = os.path.join(tempfile.gettempdir(), f"heximg-bench-{megapixels:g}mp.{ext}")
+    if not os.path.exists(filename):
+        synthetic_image(megapixels).save(filename, fmt)
+    return filename
+
+
+def legacy_thumbnails(filename: str, heights: List[int]) -> List[Image.Image]:
+    # the pipeline as it was before the resize engine: one image shrunk in place through sorted sizes
+    img = Image.open(filename)
+    results = []
+    for height in sorted(heights, reverse=True):
+        img.thumbnail((resized_width(img.size, height), height), Image.Resampling.LANCZOS)
+        results.append(img.copy())
+    return results
+
+
+def engine_thumbnails(filename: str, heights: List[int]) -> List[Image.Image]:
+    heights = sorted(heights, reverse=True)
+    img = open_image(filename, max_height=heights[0])
+    levels = build_pyramid(img, min_height=heights[-1])
+    with ThreadPoolExecutor(max_workers=len(heights)) as executor:
+        return list(executor.map(lambda height: resize_from_pyramid(levels, height), heights))
+
+
+def reference_thumbnails(filename: str, heights: List[int]) -> List[Image.Image]:
+    # full decode and a single LANCZOS pass per size, the quality reference
+    img = Image.open(filename)
+    img.load()
+    return [
+        img.resize((resized_width(img.size, height), height), Image.Resampling.LANCZOS)
+        for height in sorted(heights, reverse=True)
+    ]
+
+
+def mean_abs_diff(a: Image.Image, b: Image.Image) -> float:
+    if a.size != b.size:
+        b = b.resize(a.size, Image.Resampling.LANCZOS)
+    diff = ImageChops.difference(a.convert("RGB"), b.convert("RGB"))
+    return sum(ImageStat.Stat(diff).mean) / 3
+
+
+def _timeit(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_resize(repeat: int = 3, megapixels: Tuple[float, ...] = (12, 48)) -> List[Dict]:
+    files = [("sample.jpg", SAMPLE_IMAGE)] + [
+        (f"synthetic {mp:g} MP jpeg", synthetic_image_file(mp)) for mp in megapixels
+    ]
+    results = []
+    for name, filename in files:
+        full_decode = _timeit(lambda: reference_thumbnails(filename, THUMBNAIL_HEIGHTS), repeat)
+        legacy = _timeit(lambda: legacy_thumbnails(filename, THUMBNAIL_HEIGHTS), repeat)
+        engine = _timeit(lambda: engine_thumbnails(filename, THUMBNAIL_HEIGHTS), repeat)
+        quality = max(
+            mean_abs_diff(ref, out)
+            for ref, out in zip(
+                reference_thumbnails(filename, THUMBNAIL_HEIGHTS), engine_thumbnails(filename, THUMBNAIL_HEIGHTS)
+            )
+        )
+        results.append(
+            {
+                "id": f"resize/{name}",
+                "image": name,
+                "full_decode_s": full_decode,
+                "legacy_s": legacy,
+                "engine_s": engine,
+                "speedup": legacy / engine if engine else math.inf,
+                "full_decode_speedup": full_decode / engine if engine else math.inf,
+                "mean_abs_diff": quality,
+            }
+        )
+    return results
+
+
+ENCODE_CANDIDATES: Dict[str, Optional[EncoderConfig]] = {
+    "pillow defaults": None,
+    "q75 4:2:0": EncoderConfig(75, 2, False, False, 6, False, 80),
+    "q80 4:2:0 progressive": EncoderConfig(80, 2, True, True, 6, False, 80),
+    "q85 4:2:0": EncoderConfig(85, 2, False, False, 6, False, 80),
+    "q85 4:2:0 optimize": EncoderConfig(85, 2, False, True, 6, False, 80),
+    "q85 4:2:0 progressive": EncoderConfig(85, 2, True, True, 6, False, 80),
+    "q90 4:4:4 progressive": EncoderConfig(90, 0, True, True, 6, False, 80),
+    "png level 1": EncoderConfig(85, 2, True, True, 1, False, 80),
+    "png level 9": EncoderConfig(85, 2, True, True, 9, False, 80),
+    "opaque png to jpeg": EncoderConfig(85, 2, True, True, 6, True, 80),
+}
+
+
+def _encode(img: Image.Image, fmt: str, encoder: Optional[EncoderConfig]) -> bytes:
+    name = output_name(img, "thumb." + fmt.lower(), encoder)
+    output = BytesIO()
+    encode(img, output, {".png": "PNG"}.get(os.path.splitext(name)[-1], "JPEG"), encoder)
+    return output.getvalue()
+
+
+def _cpu_timeit(fn: Callable[[], object], repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.process_time()
+        fn()
+        timings.append(time.process_time() - start)
+    return min(timings)
+
+
+def bench_encode(repeat: int = 3, megapixels: Tuple[float, ...] = (12,)) -> List[Dict]:
+    # encode cpu time against output bytes of the thumbnails, per candidate and stored profile
+    candidates = dict(ENCODE_CANDIDATES)
+    for profile in EncoderProfile.objects.order_by("name"):
+        candidates[f"profile {profile.name}"] = EncoderConfig.from_profile(profile)
+    files = [("sample.jpg", SAMPLE_IMAGE)]
+    for mp in megapixels:
+        files += [(f"synthetic {mp:g} MP {fmt.lower()}", synthetic_image_file(mp, fmt)) for fmt in ("JPEG", "PNG")]
+    results = []
+    for name, filename in files:
+        fmt = Image.open(filename).format
+        thumbnails = engine_thumbnails(filename, THUMBNAIL_HEIGHTS)
+        for candidate, encoder in candidates.items():
+            if fmt == "JPEG" and candidate.startswith(("png", "opaque png")):
+                continue
+            encoded = [_encode(thumbnail, fmt, encoder) for thumbnail in thumbnails]
+            results.append(
+                {
+                    "id": f"encode/{name}/{candidate}",
+                    "image": name,
+                    "profile": candidate,
+                    "encode_cpu_s": _cpu_timeit(
+                        lambda: [_encode(thumbnail, fmt, encoder) for thumbnail in thumbnails], repeat
+                    ),
+                    "bytes": sum(len(data) for data in encoded),
+                    "mean_abs_diff": max(
+                        mean_abs_diff(thumbnail, Image.open(BytesIO(data)))
+                        for thumbnail, data in zip(thumbnails, encoded)
+                    ),
+                }
+            )
+    return results
+
+
+class _Rollback(Exception):
+    pass
+
+
+@contextmanager
+def _scratch(**overrides) -> Iterator[None]:
+    # rows and media files created by a benchmark are discarded afterwards
+    with tempfile.TemporaryDirectory() as media_root, override_settings(
+        MEDIA_ROOT=media_root, ALLOWED_HOSTS=["testserver"], **overrides
+    ):
+        try:
+            with transaction.atomic():
+                yield
+                raise _Rollback()
+        except _Rollback:
+            pass
+        finally:
+            plans.clear_local()  # rolled back rows send no signals
+
+
+def _bench_user_plan(plan_title: str) -> UserPlan:
+    user = User.objects.create_user(f"heximg-bench-{plan_title.lower()}")
+    return UserPlan.objects.create(user=user, plan=Plan.objects.get(title=plan_title))
+
+
+def _create_small_jobs(user_plan: UserPlan, count: int, content: bytes) -> List[int]:
+    return [
+        ImageJob.objects.create(
+            user_plan=user_plan, original_image=ContentFile(content, name="avatar.jpg"), queue=user_plan.plan.queue
+        ).id
+        for _ in range(count)
+    ]
+
+
+def bench_jobs(count: int = 200, batch_size: int = 50) -> List[Dict]:
+    # per-task fixed cost on small avatars: one task execution per job vs. micro-batches,
+    # measured in-process (broker round trips excluded)
+    avatar = BytesIO()
+    synthetic_image(0.065, aspect=1).save(avatar, "JPEG")
+    results = []
+    with _scratch(IMAGE_JOB_MICRO_BATCH_SIZE=batch_size):
+        user_plan = _bench_user_plan("Basic")
+
+        img_job_ids = _create_small_jobs(user_plan, count, avatar.getvalue())
+        start = time.perf_counter()
+        for img_job_id in img_job_ids:
+            tasks.process_image_job(img_job_id)
+        single = time.perf_counter() - start
+
+        _create_small_jobs(user_plan, count, avatar.getvalue())
+        start = time.perf_counter()
+        tasks.process_new_image_jobs(user_plan.plan.queue)
+        batched = time.perf_counter() - start
+
+        results.append(
+            {
+                "id": f"jobs/{count}x{batch_size}",
+                "jobs": count,
+                "batch_size": batch_size,
+                "single_jobs_per_s": count / single,
+                "batched_jobs_per_s": count / batched,
+                "speedup": single / batched,
+            }
+        )
+    return results
+
+
+def bench_pipeline(repeat: int = 3, megapixels: Tuple[float, ...] = (0.3, 3, 12, 50)) -> List[Dict]:
+    # thumbnails of a job as the workers render them, per image size, format and built-in plan
+    results = []
+    with _scratch(THUMBNAIL_VARIANTS_EAGER=False):
+        user_plans = [_bench_user_plan(title) for title in BUILTIN_PLANS]
+        for mp in megapixels:
+            for fmt in ("JPEG", "PNG"):
+                filename = synthetic_image_file(mp, fmt)
+                with open(filename, "rb") as f:
+                    content = f.read()
+                for user_plan in user_plans:
+                    plan = get_user_plan_config_by_id(user_plan.id).plan
+                    img_job = ImageJob.objects.create(
+                        user_plan=user_plan, original_image=ContentFile(content, name=os.path.basename(filename))
+                    )
+                    results.append(
+                        {
+                            "id": f"pipeline/{mp:g}mp/{fmt.lower()}/{plan.title}",
+                            "megapixels": mp,
+                            "format": fmt,
+                            "plan": plan.title,
+                            "thumbnails_s": _timeit(lambda: tasks._process_thumbnails(img_job, plan), repeat),
+                        }
+                    )
+    return results
+
+
+def bench_list(repeat: int = 3, counts: Tuple[int, ...] = (10, 1000, 100000)) -> List[Dict]:
+    # a user's job list, first page and a page deep into the keyset, rendered to json; then the first page
+    # from the list cache and revalidated by its etag
+    factory = APIRequestFactory()
+    view = views.ImageJobView.as_view()
+
+    def get(user: User, cached: bool = False, etag: str = "", **params) -> str:
+        if not cached:
+            joblist._bump([user_plan.id])
+        request = factory.get(reverse("image-jobs"), params, HTTP_IF_NONE_MATCH=etag)
+        force_authenticate(request, user)
+        response = view(request)
+        response.render()
+        return response["ETag"]
+
+    results = []
+    for count in counts:
+        with _scratch(IMAGE_JOB_LIST_CACHE_TIMEOUT=300):
+            user_plan = _bench_user_plan("Premium")
+            img_jobs = ImageJob.objects.bulk_create(
+                ImageJob(user_plan=user_plan, original_image="original/sample.jpg", status=ImageJob.STATUS_DONE)
+                for _ in range(count)
+            )
+            Thumbnail.objects.bulk_create(
+                Thumbnail(image_job=img_job, image=f"thumbs/sample_thumb_{height}.jpg", height=height)
+                for img_job in img_jobs
+                for height in (400, 200)
+            )
+            # the oldest rows, just above a last page
+            deep = ImageJob.objects.order_by("created_at", "id")[min(settings.IMAGE_JOB_PAGE_SIZE, count - 1)]
+            cursor = KeysetPagination().encode_cursor(deep.created_at, deep.id)
+            user = user_plan.user
+            results.append(
+                {
+                    "id": f"list/{count}",
+                    "jobs": count,
+                    "first_page_s": _timeit(lambda: get(user), repeat),
+                    "deep_page_s": _timeit(lambda: get(user, cursor=cursor), repeat),
+                }
+            )
+            etag = get(user)
+            results[-1]["cached_page_s"] = _timeit(lambda: get(user, cached=True), repeat)
+            results[-1]["not_modified_s"] = _timeit(lambda: get(user, cached=True, etag=etag), repeat)
+    return results
+
+
+def bench_links(repeat: int = 3, requests: int = 200) -> List[Dict]:
+    # per request cost of resolving external links: legacy uuid links through the db, signed ones without;
+    # the file body is left to the proxy to measure resolution only
+    factory = RequestFactory()
+    results = []
+    with _scratch(MEDIA_DELIVERY="x-accel"):
+        user_plan = _bench_user_plan("Enterprise")
+        with open(SAMPLE_IMAGE, "rb") as f:
+            img_job = ImageJob.objects.create(
+                user_plan=user_plan, original_image=ContentFile(f.read(), name="sample.jpg"), link_expires_in=30000
+            )
+        thumbnails = tasks._process_thumbnails(img_job, get_user_plan_config_by_id(user_plan.id).plan)
+        Thumbnail.objects.bulk_create(thumbnails)
+        thumbnail = thumbnails[0]
+        fmt = thumbnail.ext[1:]
+        token = sign_external_link(thumbnail)
+
+        def resolve(view: Callable, **kwargs) -> None:
+            for _ in range(requests):
+                view(factory.get("/"), fmt=fmt, **kwargs)
+
+        for name, view, kwargs in (
+            ("legacy", async_to_sync(views.ext_image), {"external_id": str(thumbnail.external_id)}),
+            ("signed", views.ext_image_signed, {"token": token}),
+        ):
+            results.append(
+                {
+                    "id": f"links/{name}",
+                    "link": name,
+                    "request_s": _timeit(lambda: resolve(view, **kwargs), repeat) / requests,
+                }
+            )
+    return results
+
+
+def _multipart_upload(filename: str) -> Tuple[str, bytes]:
+    boundary = uuid4().hex
+    with open(filename, "rb") as f:
+        content = f.read()
+    body = (
+        (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="original_image"; filename="{os.path.basename(filename)}"\r\n'
+            "Content-Type: application/octet-stream\r\n\r\n"
+        ).encode()
+        + content
+        + f"\r\n--{boundary}--\r\n".encode()
+    )
+    return f"multipart/form-data; boundary={boundary}", body
+
+
+def _login(url: str, username: str, password: str) -> Dict[str, str]:
+    # a session rather than basic auth, which would measure password hashing on every request
+    cookies = http.cookiejar.CookieJar()
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(cookies))
+    login_url = url.rstrip("/") + reverse("rest_framework:login")
+    opener.open(login_url)
+    csrf_token = next(cookie.value for cookie in cookies if cookie.name == settings.CSRF_COOKIE_NAME)
+    data = urlencode({"username": username, "password": password, "csrfmiddlewaretoken": csrf_token})
+    opener.open(
+        urllib.request.Request(
+            f"{login_url}?{urlencode({'next': reverse('core')})}", data.encode(), headers={"Referer": login_url}
+        )
+    )
+    session = {cookie.name: cookie.value for cookie in cookies}
+    if settings.SESSION_COOKIE_NAME not in session:
+        raise ValueError("login failed")
+    return session
+
+
+async def _slow_upload(url: SplitResult, head: bytes, body: bytes, rate: int) -> Tuple[int, float]:
+    # the body trickles in at rate bytes/s, like from a phone on a weak connection
+    start = time.perf_counter()
+    chunk = max(rate // 10, 1)
+    try:
+        reader, writer = await asyncio.open_connection(url.hostname, url.port or 80)
+    except OSError:
+        return 0, time.perf_counter() - start
+    try:
+        # small send buffers: like on a slow link, the client can't get ahead of what the server reads
+        writer.get_extra_info("socket").setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, chunk)
+        writer.transport.set_write_buffer_limits(high=chunk)
+        writer.write(head)
+        for offset in range(0, len(body), chunk):
+            writer.write(body[offset : offset + chunk])
+            await writer.drain()
+            await asyncio.sleep(0.1)
+        status_line = await reader.readline()
+        status = int(status_line.split()[1]) if status_line else 0
+    except (OSError, ValueError, IndexError):
+        status = 0
+    finally:
+        writer.close()
+    return status, time.perf_counter() - start
+
+
+async def _slow_uploads(url: SplitResult, head: bytes, body: bytes, rate: int, clients: int) -> List[Tuple[int, float]]:
+    return await asyncio.gather(*(_slow_upload(url, head, body, rate) for _ in range(clients)))
+
+
+def bench_uploads(
+    url: str,
+    username: str,
+    password: str,
+    clients: Tuple[int, ...] = (10, 50, 200),
+    rate: int = 64 * 1024,
+    filename: str = SAMPLE_IMAGE,
+) -> List[Dict]:
+    # load test of a running server: concurrent slow uploads, each pins a worker thread of a sync stack
+    # for its whole transfer, an asgi server receives the bodies on its event loop;
+    # creates real jobs for the user
+    target = urlsplit(url)
+    if target.scheme != "http":
+        raise ValueError("only http servers can be load tested")
+    content_type, body = _multipart_upload(filename)
+    session = _login(url, username, password)
+    head = (
+        f"POST {reverse('image-jobs')} HTTP/1.1\r\n"
+        f"Host: {target.netloc}\r\n"
+        f"Cookie: {'; '.join(f'{name}={value}' for name, value in session.items())}\r\n"
+        f"X-CSRFToken: {session[settings.CSRF_COOKIE_NAME]}\r\n"
+        f"Content-Type: {content_type}\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode()
+    results = []
+    for count in clients:
+        start = time.perf_counter()
+        uploads = asyncio.run(_slow_uploads(target, head, body, rate, count))
+        elapsed = time.perf_counter() - start
+        latencies = sorted(latency for status, latency in uploads if status == 201)
+        results.append(
+            {
+                "id": f"uploads/{count}",
+                "clients": count,
+                "transfer_s": len(body) / rate,
+                "p50_s": latencies[len(latencies) // 2] if latencies else 0.0,
+                "p95_s": latencies[math.ceil(len(latencies) * 0.95) - 1] if latencies else 0.0,
+                "uploads_per_s": len(latencies) / elapsed,
+                "failed": count - len(latencies),
+            }
+        )
+    return results
+
+
+def environment() -> Dict:
+    return {
+        "python": platform.python_version(),
+        "django": django.get_version(),
+        "pillow": PIL.__version__,
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "database": connection.vendor,
+    }
+
+
+def _lower_is_better(metric: str) -> Optional[bool]:
+    if metric.endswith("_per_s"):
+        return False
+    if metric.endswith("_s") or metric == "bytes":
+        return True
+    return None
+
+
+def compare(results: Dict[str, List[Dict]], baseline: Dict[str, List[Dict]], tolerance: float) -> List[Dict]:
+    # regressions of timings, throughput and output sizes beyond the tolerated relative change
+    baseline_rows = {row["id"]: row for rows in baseline.values() for row in rows}
+    regressions = []
+    for rows in results.values():
+        for row in rows:
+            base = baseline_rows.get(row["id"])
+            if base is None:
+                continue
+            for metric, value in row.items():
+                lower_is_better = _lower_is_better(metric)
+                if lower_is_better is None or not base.get(metric):
+                    continue
+                change = value / base[metric] - 1
+                if (change if lower_is_better else -change) > tolerance:
+                    regressions.append(
+                        {"id": row["id"], "metric": metric, "baseline": base[metric], "value": value, "change": change}
+                    )
+    return regressions
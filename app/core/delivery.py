@@ -0,0 +1,60 @@
+import mimetypes
+import os
+from stat import S_ISREG
+
+from django.conf import settings
+from django.core.exceptions import SuspiciousFileOperation
+from django.core.files.storage import Storage
+from django.http import (
+    FileResponse,
+    Http404,
+    HttpRequest,
+    HttpResponse,
+    HttpResponseRedirect,
+)
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from core.models import Thumbnail
+
+
+def file_response(request: HttpRequest, name: str, **cache_control) -> HttpResponse:
+    # with X-Accel-Redirect/X-Sendfile the front proxy sends the body, django only answers from file metadata
+    storage = Thumbnail._meta.get_field("image").storage
+    try:
+        path = storage.path(name)
+        stat = os.stat(path)
+    except NotImplementedError:
+        return _redirect_response(storage, name, **cache_control)
+    except (SuspiciousFileOperation, OSError):
+        raise Http404()
+    if not S_ISREG(stat.st_mode):
+        raise Http404()  # a directory, e.g. thumbs/..
+    etag = quote_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+
+    response = get_conditional_response(request, etag=etag, last_modified=int(stat.st_mtime))
+    if response is None:
+        if settings.MEDIA_DELIVERY == "x-accel":
+            response = HttpResponse(content_type=mimetypes.guess_type(name)[0])
+            response["X-Accel-Redirect"] = settings.MEDIA_ACCEL_REDIRECT_PREFIX + name
+        elif settings.MEDIA_DELIVERY == "x-sendfile":
+            response = HttpResponse(content_type=mimetypes.guess_type(name)[0])
+            response["X-Sendfile"] = path
+        else:
+            response = FileResponse(open(path, "rb"))
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(stat.st_mtime)
+    patch_cache_control(response, **cache_control)
+    return response
+
+
+def _redirect_response(storage: Storage, name: str, **cache_control) -> HttpResponse:
+    # remote storage: the client fetches the file from its presigned or cdn url, the store isn't contacted
+    response = HttpResponseRedirect(storage.url(name))
+    url_expire = getattr(storage, "url_expire", None)
+    if url_expire and not getattr(storage, "custom_domain", None):
+        # the redirect must not be cached beyond its presigned url
+        cache_control["max_age"] = min(cache_control.get("max_age", url_expire), url_expire)
+        cache_control.pop("immutable", None)
+    patch_cache_control(response, **cache_control)
+    return response
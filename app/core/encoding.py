@@ -0,0 +1,76 @@
+import os
+from dataclasses import dataclass
+from typing import IO, Optional
+
+from PIL import Image
+
+from core.models import EncoderProfile
+
+
+@dataclass(frozen=True)
+class EncoderConfig:
+    quality: int
+    subsampling: int
+    progressive: bool
+    optimize: bool
+    png_compress_level: int
+    opaque_png_to_jpeg: bool
+    variant_quality: int
+
+    @classmethod
+    def from_profile(cls, profile: EncoderProfile) -> "EncoderConfig":
+        return cls(
+            quality=profile.quality,
+            subsampling=profile.subsampling,
+            progressive=profile.progressive,
+            optimize=profile.optimize,
+            png_compress_level=profile.png_compress_level,
+            opaque_png_to_jpeg=profile.opaque_png_to_jpeg,
+            variant_quality=profile.variant_quality,
+        )
+
+
+# png opens 16 bit grayscale as one of these, with samples up to 65535
+HIGH_BIT_DEPTH_MODES = {"I", "I;16", "I;16B", "I;16L"}
+
+
+def is_opaque(img: Image.Image) -> bool:
+    # of the 8 bit modes a jpeg holds without losing anything but the (opaque) alpha, deeper images stay png
+    if img.mode in ("RGBA", "LA"):
+        return img.getchannel("A").getextrema()[0] == 255
+    if img.mode == "P":
+        return "transparency" not in img.info
+    return img.mode in ("L", "RGB")
+
+
+def eight_bit(img: Image.Image) -> Image.Image:
+    # scaled down to 8 bits, convert() would clip the samples at 255 and turn the image near white
+    if img.mode in HIGH_BIT_DEPTH_MODES:
+        return img.convert("I").point(lambda v: v / 256).convert("L")
+    return img
+
+
+def output_name(img: Image.Image, name: str, encoder: Optional[EncoderConfig]) -> str:
+    root, ext = os.path.splitext(name)
+    if encoder and encoder.opaque_png_to_jpeg and ext.lower() == ".png" and is_opaque(img):
+        return root + ".jpg"
+    return name
+
+
+def encode(img: Image.Image, output: IO[bytes], fmt: str, encoder: Optional[EncoderConfig]) -> None:
+    if encoder is None:
+        img.save(output, fmt)
+    elif fmt == "JPEG":
+        img = eight_bit(img)
+        if img.mode not in ("RGB", "L", "CMYK"):
+            img = img.convert("RGB")
+        img.save(
+            output,
+            fmt,
+            quality=encoder.quality,
+            subsampling=encoder.subsampling,
+            progressive=encoder.progressive,
+            optimize=encoder.optimize,
+        )
+    else:
+        img.save(output, fmt, compress_level=encoder.png_compress_level)  # optimize would force level 9
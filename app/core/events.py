@@ -0,0 +1,92 @@
+import logging
+import re
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.db import transaction
+
+import redis
+import redis.asyncio
+
+from core import joblist, quotas
+from core.models import ImageJob
+
+logger = logging.getLogger(__name__)
+
+# redis stream entry ids, handed to clients as the cursors of the events
+CURSOR_RE = re.compile(r"^\d+-\d+$")
+
+Event = Tuple[str, Dict[str, str]]
+
+
+def enabled() -> bool:
+    return bool(settings.JOB_EVENTS_URL)
+
+
+@lru_cache(maxsize=None)
+def _client(url: str) -> redis.Redis:
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+def _stream(user_plan_id: int) -> str:
+    return f"image-job-events:{user_plan_id}"
+
+
+def _publish(status: str, jobs: List[Tuple[int, int]]) -> None:
+    try:
+        with _client(settings.JOB_EVENTS_URL).pipeline(transaction=False) as pipe:
+            for user_plan_id, img_job_id in jobs:
+                pipe.xadd(
+                    _stream(user_plan_id),
+                    {"id": img_job_id, "status": status},
+                    maxlen=settings.JOB_EVENTS_STREAM_LENGTH,
+                    approximate=True,
+                )
+            for user_plan_id in {user_plan_id for user_plan_id, _ in jobs}:
+                pipe.expire(_stream(user_plan_id), settings.JOB_EVENTS_STREAM_TTL)
+            pipe.execute()
+    except redis.RedisError as e:
+        # clients miss the push, not the status: it's still in the job list
+        logger.warning("image job events not published: %s", e)
+
+
+def job_status_changed(status: str, jobs: Iterable[Tuple[int, int]]) -> None:
+    # jobs as (user plan id, job id), published once the status change is committed
+    jobs = list(jobs)
+    joblist.jobs_changed(user_plan_id for user_plan_id, _ in jobs)
+    if status in (ImageJob.STATUS_DONE, ImageJob.STATUS_ERROR):
+        quotas.jobs_finished(jobs)
+    if jobs and enabled():
+        transaction.on_commit(lambda: _publish(status, jobs))
+
+
+def async_client() -> redis.asyncio.Redis:
+    # bound to the running event loop, so one per event stream rather than per process
+    return redis.asyncio.Redis.from_url(settings.JOB_EVENTS_URL, decode_responses=True)
+
+
+def last_cursor(user_plan_id: int) -> str:
+    entries = _client(settings.JOB_EVENTS_URL).xrevrange(_stream(user_plan_id), count=1)
+    return entries[0][0] if entries else "0-0"
+
+
+def _events(response) -> List[Event]:
+    return [(entry_id, fields) for _, entries in response or [] for entry_id, fields in entries]
+
+
+def read_events(user_plan_id: int, cursor: str, timeout: float) -> List[Event]:
+    # the events after the cursor, waiting up to timeout seconds for the first one
+    return _events(
+        _client(settings.JOB_EVENTS_URL).xread(
+            {_stream(user_plan_id): cursor}, count=settings.JOB_EVENTS_READ_COUNT, block=int(timeout * 1000)
+        )
+    )
+
+
+async def aread_events(client: redis.asyncio.Redis, user_plan_id: int, cursor: str, timeout: float) -> List[Event]:
+    return _events(
+        await client.xread(
+            {_stream(user_plan_id): cursor}, count=settings.JOB_EVENTS_READ_COUNT, block=int(timeout * 1000)
+        )
+    )
@@ -0,0 +1,27 @@
+import hashlib
+
+from django.core.files import File
+from django.db.models.fields.files import FieldFile
+
+
+def file_digest(file: File) -> str:
+    digest = getattr(file, "sha256", None)  # set by the hashing upload handlers
+    if digest is None:
+        sha256 = hashlib.sha256()
+        for chunk in file.chunks():
+            sha256.update(chunk)
+        file.seek(0)
+        digest = sha256.hexdigest()
+    return digest
+
+
+def delete_unreferenced(field_file: FieldFile) -> bool:
+    # files can be shared between rows (deduplicated uploads), they are reference counted by the rows naming them
+    instance = field_file.instance
+    references = instance.__class__._default_manager.filter(**{field_file.field.name: field_file.name})
+    if instance.pk is not None:
+        references = references.exclude(pk=instance.pk)
+    if references.exists():
+        return False
+    field_file.delete(save=False)
+    return True
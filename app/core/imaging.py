@@ -0,0 +1,146 @@
+import math
+import struct
+import zlib
+from typing import IO, Iterator, List, Optional, Tuple, Union
+
+from PIL import Image
+
+# minimal ratio kept between a pre-shrunk image and the requested output,
+# so the final LANCZOS pass still has enough source pixels to filter
+REDUCING_GAP = 2.0
+
+DRAFT_MODES = {"RGB", "L"}
+
+# 8 bit png modes whose scanlines can be decoded a strip at a time
+STRIP_MODES = {"L", "LA", "RGB", "RGBA", "P"}
+
+IDAT_READ_SIZE = 64 * 1024
+
+
+def resized_width(size: Tuple[int, int], h: int) -> int:
+    h_percent = h / size[1]
+    return max(round(size[0] * h_percent), 1)
+
+
+def decoded_size(size: Tuple[int, int], mode: str) -> int:
+    # bytes of the decoded pixels, pillow keeps multi-band images at 4 bytes per pixel
+    return size[0] * size[1] * (1 if len(mode) == 1 else 4)
+
+
+def open_image(fp: Union[str, IO[bytes]], max_height: int, memory_budget: Optional[int] = None) -> Image.Image:
+    img = Image.open(fp)
+    if img.format == "JPEG" and max_height < img.height:
+        # DCT-domain downscaling (1/2, 1/4, 1/8) skips most of the decoding work
+        draft_height = round(max_height * REDUCING_GAP)
+        img.draft(
+            img.mode if img.mode in DRAFT_MODES else None,
+            (resized_width(img.size, draft_height), draft_height),
+        )
+    elif memory_budget and decoded_size(img.size, img.mode) > memory_budget and _strip_decodable(img):
+        factor = int(img.height // (max_height * REDUCING_GAP))
+        if factor > 1:
+            return _reduce_png_in_strips(img, factor, memory_budget)
+    img.load()
+    return img
+
+
+def _strip_decodable(img: Image.Image) -> bool:
+    if img.format != "PNG" or img.info.get("interlace") or len(img.tile) != 1:
+        return False
+    decoder, _, _, rawmode = img.tile[0]
+    return decoder == "zip" and rawmode == img.mode and img.mode in STRIP_MODES
+
+
+def _idat_data(fp: IO[bytes], offset: int) -> Iterator[bytes]:
+    # the compressed image data, continued over consecutive IDAT chunks from the first one's data
+    fp.seek(offset - 8)
+    while True:
+        length, chunk_type = struct.unpack(">I4s", fp.read(8))
+        if chunk_type != b"IDAT":
+            return
+        while length > 0:
+            data = fp.read(min(length, IDAT_READ_SIZE))
+            if not data:
+                raise OSError("truncated png image data")
+            length -= len(data)
+            yield data
+        fp.read(4)  # crc
+
+
+def _reduce_png_in_strips(img: Image.Image, factor: int, memory_budget: int) -> Image.Image:
+    # the same as img.reduce(factor), but only a strip of rows is decoded at a time:
+    # strips are a multiple of factor high, so their reduced blocks match the whole image's
+    width, height = img.size
+    stride = width * len(img.mode) + 1  # a filter type byte per scanline
+    rows = max(memory_budget // (4 * decoded_size((width, factor), img.mode)), 1) * factor
+    reduced_mode = ("RGBA" if "transparency" in img.info else "RGB") if img.mode == "P" else img.mode
+    reduced = Image.new(reduced_mode, (math.ceil(width / factor), math.ceil(height / factor)))
+
+    inflate = zlib.decompressobj()
+    data = _idat_data(img.fp, img.tile[0][2])
+    pending = bytearray()
+    prior: Optional[bytes] = None
+    for y in range(0, height, rows):
+        strip_rows = min(rows, height - y)
+        needed = strip_rows * stride
+        while len(pending) < needed:
+            # inflated no further than the strip, the rest waits in unconsumed_tail: data inflating
+            # far beyond the header's size (a decompression bomb) is never held at once
+            compressed = inflate.unconsumed_tail or next(data, b"")
+            if not compressed:
+                raise OSError("truncated png image data")
+            pending += inflate.decompress(compressed, needed - len(pending))
+        scanlines = bytes(pending)
+        pending.clear()
+
+        # up, average and paeth filters refer to the row above: the previous strip's last row
+        # goes first, unfiltered, and is cropped off again
+        top = 0 if prior is None else 1
+        if prior is not None:
+            scanlines = b"\0" + prior + scanlines
+        strip = Image.frombytes(img.mode, (width, strip_rows + top), zlib.compress(scanlines, 0), "zip", img.mode)
+        prior = strip.crop((0, strip.height - 1, width, strip.height)).tobytes()
+        if img.mode == "P":
+            strip.palette = img.palette.copy()
+            strip.info = dict(img.info)
+            strip = strip.convert(reduced_mode)
+        reduced.paste(strip.reduce(factor, box=(0, top, width, strip.height)), (0, y // factor))
+        del strip
+    reduced.info = {key: value for key, value in img.info.items() if key != "transparency"}
+    return reduced
+
+
+def reducible(img: Image.Image) -> Image.Image:
+    # reduce() doesn't take palette and bilevel images, and they'd be resampled with NEAREST
+    if img.mode == "P":
+        return img.convert("RGBA" if "transparency" in img.info else "RGB")
+    if img.mode == "1":
+        return img.convert("L")
+    return img
+
+
+def resize_to_height(img: Image.Image, height: int) -> Image.Image:
+    if height >= img.height:
+        return img.copy()  # never upscale
+    factor = int(img.height // (height * REDUCING_GAP))
+    if factor > 1:
+        img = reducible(img).reduce(factor)  # cheap integer box downscale
+    return img.resize((resized_width(img.size, height), height), Image.Resampling.LANCZOS)
+
+
+def build_pyramid(img: Image.Image, min_height: int) -> List[Image.Image]:
+    # halving levels, each still large enough to resample ``min_height`` thumbnails from
+    levels = [reducible(img)]
+    while levels[-1].height // 2 >= min_height * REDUCING_GAP:
+        levels.append(levels[-1].reduce(2))
+    return levels
+
+
+def resize_from_pyramid(levels: List[Image.Image], height: int) -> Image.Image:
+    # the smallest level keeping enough headroom, i.e. the nearest larger one
+    source = levels[0]
+    for level in levels[1:]:
+        if level.height < height * REDUCING_GAP:
+            break
+        source = level
+    return resize_to_height(source, height)
@@ -0,0 +1,113 @@
+import hashlib
+import json
+import os
+import time
+from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from django.core.cache import cache
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+from django.http import HttpRequest
+from django.urls import reverse
+from django.utils.encoding import filepath_to_uri
+from django.utils.http import quote_etag
+
+from rest_framework.utils.encoders import JSONEncoder
+
+from core import links
+from core.models import ImageJob, Thumbnail
+
+VERSION_KEY = "image-jobs:version:{user_plan_id}"
+PAGE_KEY = "image-jobs:page:{user_plan_id}:{version}:{url}"
+
+JOB_FIELDS = ("id", "status", "original_image", "created_at")
+THUMBNAIL_FIELDS = ("id", "image_job_id", "image", "lazy", "external_id", "external_id_expires_at")
+
+
+def list_version(user_plan_id: int) -> int:
+    # starts from the clock, so a version evicted from the cache doesn't come back for stale pages
+    return cache.get_or_set(VERSION_KEY.format(user_plan_id=user_plan_id), time.time_ns, timeout=None)
+
+
+def _bump(user_plan_ids: Iterable[int]) -> None:
+    for user_plan_id in user_plan_ids:
+        try:
+            cache.incr(VERSION_KEY.format(user_plan_id=user_plan_id))
+        except ValueError:
+            cache.set(VERSION_KEY.format(user_plan_id=user_plan_id), time.time_ns(), timeout=None)
+
+
+def jobs_changed(user_plan_ids: Iterable[int]) -> None:
+    # once committed: the version is read before the rows, so a page rendered from the old rows meanwhile
+    # is cached under the old version
+    user_plan_ids = set(user_plan_ids)
+    if user_plan_ids:
+        transaction.on_commit(lambda: _bump(user_plan_ids))
+
+
+def page_key(user_plan_id: int, version: int, request: HttpRequest) -> str:
+    # the absolute url: the page's links are built from the host, filters and cursor
+    url = hashlib.sha256(request.build_absolute_uri().encode()).hexdigest()
+    return PAGE_KEY.format(user_plan_id=user_plan_id, version=version, url=url)
+
+
+def etag(data: Dict, media_type: str) -> str:
+    # of the data along with the representation it is rendered in
+    content = json.dumps([media_type, data], cls=JSONEncoder).encode()
+    return quote_etag(hashlib.sha256(content).hexdigest()[:32])
+
+
+def _url_prefix(request: HttpRequest, name: str, *args) -> str:
+    # the views' arguments fill the last path segment
+    return request.build_absolute_uri(reverse(name, args=args)).rsplit("/", 1)[0] + "/"
+
+
+def _media_url(request: HttpRequest) -> Callable[[str], str]:
+    storage = ImageJob._meta.get_field("original_image").storage
+    if isinstance(storage, FileSystemStorage):
+        prefix = request.build_absolute_uri(storage.base_url)
+        return lambda name: prefix + filepath_to_uri(name).lstrip("/")
+    return lambda name: request.build_absolute_uri(storage.url(name))
+
+
+def render_jobs(request: HttpRequest, img_jobs: List[Dict], now: datetime) -> Tuple[List[Dict], Optional[datetime]]:
+    # jobs as ImageJobSerializer renders them, from JOB_FIELDS rows and with the url prefixes computed once;
+    # also when the first of their external links expires
+    media_url = _media_url(request)
+    thumbnail_prefix = _url_prefix(request, "thumbnail", 0)
+    ext_image_prefix = _url_prefix(request, "ext_image", "0", "jpg")
+    signed_prefix = _url_prefix(request, "ext_image_signed", "0", "jpg")
+
+    originals = {img_job["id"]: img_job["original_image"] for img_job in img_jobs}
+    thumbnails: Dict[int, List[Dict]] = {img_job_id: [] for img_job_id in originals}
+    first_expiry = None
+    for thumbnail in (
+        Thumbnail.objects.filter(image_job_id__in=list(originals)).order_by("id").values(*THUMBNAIL_FIELDS)
+    ):
+        image, expires_at = thumbnail["image"], thumbnail["external_id_expires_at"]
+        external_url = None
+        if thumbnail["external_id"] and expires_at and expires_at > now:
+            first_expiry = min(first_expiry or expires_at, expires_at)
+            # lazy thumbnails take the original's extension until they are rendered
+            ext = os.path.splitext(image or originals[thumbnail["image_job_id"]])[-1][1:]
+            if thumbnail["lazy"]:
+                external_url = f"{ext_image_prefix}{thumbnail['external_id']}.{ext}"
+            else:
+                external_url = f"{signed_prefix}{links.sign_link(image, expires_at, thumbnail['external_id'])}.{ext}"
+        thumbnails[thumbnail["image_job_id"]].append(
+            {
+                "image_url": f"{thumbnail_prefix}{thumbnail['id']}" if thumbnail["lazy"] else media_url(image),
+                "external_url": external_url,
+                "external_url_expires_at": expires_at,
+            }
+        )
+    return [
+        {
+            "id": img_job["id"],
+            "thumbnails": thumbnails[img_job["id"]],
+            "status": img_job["status"],
+            "original_image": media_url(img_job["original_image"]) if img_job["original_image"] else None,
+        }
+        for img_job in img_jobs
+    ], first_expiry
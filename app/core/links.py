@@ -0,0 +1,114 @@
+import logging
+import time
+from datetime import datetime
+from typing import Dict, Optional, Tuple
+from uuid import UUID
+
+from django.conf import settings
+from django.core import signing
+from django.core.cache import caches
+from django.utils import timezone
+
+from core import joblist
+from core.models import Thumbnail
+
+logger = logging.getLogger(__name__)
+
+EXTERNAL_LINK_SALT = "core.links.external"
+
+# revocations are numbered by the version key, each one kept under its number until the link expires
+REVOCATIONS_VERSION_KEY = "ext-link-revocations:version"
+REVOCATION_KEY = "ext-link-revocations:{number}"
+
+# process local, external id -> expiry timestamp: signed links resolve from memory, the shared cache is only
+# asked for new revocations every EXTERNAL_LINK_REVOCATION_CHECK_INTERVAL seconds
+_revoked: Dict[str, float] = {}
+_local_version: Optional[int] = None
+_checked_at = 0.0
+
+
+def sign_external_link(thumbnail: Thumbnail) -> str:
+    assert thumbnail.external_id_expires_at is not None
+    return sign_link(thumbnail.image.name, thumbnail.external_id_expires_at, thumbnail.external_id)
+
+
+def sign_link(name: str, expires_at: datetime, external_id: Optional[UUID]) -> str:
+    # the token carries everything needed to resolve the link, no db lookup involved
+    payload = {"p": name, "e": int(expires_at.timestamp()), "i": external_id.hex if external_id else None}
+    return signing.Signer(salt=EXTERNAL_LINK_SALT).sign_object(payload)
+
+
+def resolve_external_link(token: str) -> Optional[Tuple[str, datetime]]:
+    try:
+        payload = signing.Signer(salt=EXTERNAL_LINK_SALT).unsign_object(token)  # constant-time signature check
+    except signing.BadSignature:
+        return None
+    expires_at = datetime.fromtimestamp(payload["e"], tz=timezone.utc)
+    if expires_at < timezone.now() or _is_revoked(payload["i"]):
+        return None
+    return payload["p"], expires_at
+
+
+def _is_revoked(external_id: Optional[str]) -> bool:
+    if not settings.EXTERNAL_LINK_REVOCATION_CACHE or external_id is None:
+        return False
+    _check_revocations()
+    return external_id in _revoked
+
+
+def _check_revocations() -> None:
+    global _local_version, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < settings.EXTERNAL_LINK_REVOCATION_CHECK_INTERVAL:
+        return
+    _checked_at = now
+    shared = caches[settings.EXTERNAL_LINK_REVOCATION_CACHE]
+    version = shared.get_or_set(REVOCATIONS_VERSION_KEY, 0, timeout=None)
+    if version == _local_version:
+        return
+    if _local_version is None or version < _local_version:
+        # a new process, or the version was evicted: the latest revocations, older ones have expired by now
+        _revoked.clear()
+        _local_version = max(version - settings.EXTERNAL_LINK_REVOCATION_MAX, 0)
+    numbers = range(_local_version + 1, version + 1)
+    revocations = shared.get_many([REVOCATION_KEY.format(number=number) for number in numbers])
+    _remember(dict(revocations.values()))
+    _local_version = version
+
+
+def _remember(revocations: Dict[str, float]) -> None:
+    _revoked.update(revocations)
+    now = time.time()
+    for external_id in [external_id for external_id, expires_at in _revoked.items() if expires_at < now]:
+        del _revoked[external_id]
+    if len(_revoked) > settings.EXTERNAL_LINK_REVOCATION_MAX:
+        logger.warning("more than %d external links revoked, the first to expire are dropped", len(_revoked))
+        for external_id in sorted(_revoked, key=_revoked.get)[: len(_revoked) - settings.EXTERNAL_LINK_REVOCATION_MAX]:
+            del _revoked[external_id]
+
+
+def clear_local() -> None:
+    global _local_version, _checked_at
+    _revoked.clear()
+    _local_version = None
+    _checked_at = 0.0
+
+
+def revoke_external_link(external_id: UUID, expires_at: datetime) -> None:
+    # signed links stay valid until they expire, so revocations are kept just as long
+    timeout = (expires_at - timezone.now()).total_seconds()
+    if settings.EXTERNAL_LINK_REVOCATION_CACHE and timeout > 0:
+        # other processes notice it within EXTERNAL_LINK_REVOCATION_CHECK_INTERVAL
+        shared = caches[settings.EXTERNAL_LINK_REVOCATION_CACHE]
+        try:
+            number = shared.incr(REVOCATIONS_VERSION_KEY)
+        except ValueError:
+            shared.add(REVOCATIONS_VERSION_KEY, 0, timeout=None)
+            number = shared.incr(REVOCATIONS_VERSION_KEY)
+        shared.set(
+            REVOCATION_KEY.format(number=number), (external_id.hex, expires_at.timestamp()), timeout=int(timeout) + 1
+        )
+        _remember({external_id.hex: expires_at.timestamp()})
+    thumbnails = Thumbnail.objects.filter(external_id=external_id)
+    joblist.jobs_changed(thumbnails.values_list("image_job__user_plan_id", flat=True))
+    thumbnails.update(external_id=None, external_id_expires_at=None)
@@ -0,0 +1,109 @@
+import json
+import multiprocessing
+import os
+import time
+from collections import deque
+from multiprocessing.pool import AsyncResult
+from typing import Deque, List, Optional, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core.backfill import backfill_chunks
+from core.models import Plan
+from core.tasks import backfill_image_jobs
+
+
+def _backfill(img_job_ids: List[int]) -> int:
+    # module level, the process pool pickles it by name
+    return backfill_image_jobs(img_job_ids)
+
+
+class Command(BaseCommand):
+    help = "Render the thumbnails of the current plan sizes that done jobs with kept originals are missing"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("--plan", type=str, help="only the jobs of this plan's users")
+        parser.add_argument("--chunk-size", type=int, default=200, help="jobs scanned per query and per task")
+        parser.add_argument("--workers", type=int, default=1, help="processes rendering the chunks")
+        parser.add_argument(
+            "--celery",
+            action="store_true",
+            help=f"send the chunks to the {settings.IMAGE_JOB_BACKFILL_QUEUE} queue instead of rendering them here",
+        )
+        parser.add_argument("--rate", type=float, default=0, help="max jobs per second, 0 for no limit")
+        parser.add_argument("--checkpoint", type=str, help="file the last finished job id is kept in to resume from")
+        parser.add_argument("--after", type=int, help="start after this job id instead of the checkpoint")
+
+    def handle(self, *args, **options):
+        if options["plan"] and not Plan.objects.filter(title=options["plan"]).exists():
+            raise CommandError(f'Plan with "{options["plan"]}" title does not exist')
+        if options["chunk_size"] < 1 or options["workers"] < 1:
+            raise CommandError("--chunk-size and --workers must be positive")
+
+        after_id = options["after"]
+        if after_id is None:
+            after_id = self._read_checkpoint(options["checkpoint"])
+        self.checkpoint_path = options["checkpoint"]
+        self.rate = options["rate"]
+        self.start = time.monotonic()
+        self.sent = self.jobs = self.thumbnails = 0
+
+        chunks = backfill_chunks(after_id, options["chunk_size"], options["plan"])
+        if options["celery"]:
+            self._dispatch(chunks)
+        elif options["workers"] > 1:
+            self._render_in_pool(chunks, options["workers"])
+        else:
+            for last_id, img_job_ids in chunks:
+                self._throttle(len(img_job_ids))
+                self._finished(last_id, len(img_job_ids), backfill_image_jobs(img_job_ids) if img_job_ids else 0)
+        self.stdout.write(self.style.SUCCESS(f"Backfilled {self._progress()}"))
+
+    def _dispatch(self, chunks) -> None:
+        # the tasks outlive the run, the checkpoint marks the chunks sent
+        for last_id, img_job_ids in chunks:
+            self._throttle(len(img_job_ids))
+            if img_job_ids:
+                backfill_image_jobs.apply_async((img_job_ids,), queue=settings.IMAGE_JOB_BACKFILL_QUEUE)
+            self._finished(last_id, len(img_job_ids), None)
+
+    def _render_in_pool(self, chunks, workers: int) -> None:
+        # forked workers must not share the db connection of this process
+        connections.close_all()
+        pending: Deque[Tuple[int, int, AsyncResult]] = deque()
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            for last_id, img_job_ids in chunks:
+                self._throttle(len(img_job_ids))
+                pending.append((last_id, len(img_job_ids), pool.apply_async(_backfill, (img_job_ids,))))
+                # a few chunks ahead only, and the checkpoint never passes an unfinished one
+                while len(pending) > 2 * workers:
+                    self._finished(pending[0][0], pending[0][1], pending.popleft()[2].get())
+            while pending:
+                self._finished(pending[0][0], pending[0][1], pending.popleft()[2].get())
+
+    def _throttle(self, jobs: int) -> None:
+        self.sent += jobs
+        if self.rate:
+            time.sleep(max(0.0, self.sent / self.rate - (time.monotonic() - self.start)))
+
+    def _finished(self, last_id: int, jobs: int, thumbnails: Optional[int]) -> None:
+        self.jobs += jobs
+        self.thumbnails += thumbnails or 0
+        if self.checkpoint_path:
+            with open(f"{self.checkpoint_path}.tmp", "w") as f:
+                json.dump({"last_id": last_id}, f)
+            os.replace(f"{self.checkpoint_path}.tmp", self.checkpoint_path)
+        if jobs:
+            self.stdout.write(f"up to job {last_id}: {self._progress()}")
+
+    def _progress(self) -> str:
+        elapsed = time.monotonic() - self.start
+        return f"{self.jobs} jobs, {self.thumbnails} thumbnails in {elapsed:.1f}s ({self.jobs / elapsed if elapsed else 0:.1f} jobs/s)"
+
+    def _read_checkpoint(self, path: Optional[str]) -> int:
+        if not path or not os.path.exists(path):
+            return 0
+        with open(path) as f:
+            return json.load(f)["last_id"]
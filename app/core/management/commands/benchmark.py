@@ -0,0 +1,101 @@
+import json
+from typing import Dict, List
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core import benchmarks
+
+SUITES = ["resize", "encode", "pipeline", "jobs", "list", "links"]
+
+FORMATS = {
+    "resize": "{image:<26} full decode {full_decode_s:8.4f}s  legacy {legacy_s:8.4f}s  engine {engine_s:8.4f}s  "
+    "speedup {full_decode_speedup:5.2f}x / {speedup:5.2f}x  mean abs diff {mean_abs_diff:.3f}",
+    "encode": "{image:<26} {profile:<28} encode cpu {encode_cpu_s:8.4f}s  {bytes:9d} bytes  "
+    "mean abs diff {mean_abs_diff:.3f}",
+    "pipeline": "{megapixels:6g} MP {format:<5} {plan:<11} thumbnails {thumbnails_s:8.4f}s",
+    "jobs": "{jobs} jobs  single {single_jobs_per_s:8.1f} jobs/s  batches of {batch_size} "
+    "{batched_jobs_per_s:8.1f} jobs/s  speedup {speedup:5.2f}x",
+    "list": "{jobs:7d} jobs  first page {first_page_s:8.4f}s  deep page {deep_page_s:8.4f}s  "
+    "cached {cached_page_s:8.4f}s  not modified {not_modified_s:8.4f}s",
+    "links": "{link:<7} link  {request_s:10.6f}s per request",
+    "uploads": "{clients:5d} slow uploads ({transfer_s:.1f}s transfer)  p50 {p50_s:7.2f}s  p95 {p95_s:7.2f}s  "
+    "{uploads_per_s:7.2f} uploads/s  {failed} failed",
+}
+
+
+class Command(BaseCommand):
+    help = "Benchmark the thumbnail pipeline and the API hot paths"
+
+    def add_arguments(self, parser) -> None:
+        # uploads is a load test of a running server, not part of all
+        parser.add_argument("suites", nargs="+", choices=SUITES + ["uploads", "all"])
+        parser.add_argument("--repeat", type=int, default=3)
+        parser.add_argument("--megapixels", type=float, nargs="*", help="image sizes of the image suites")
+        parser.add_argument("--jobs", type=int, default=200)
+        parser.add_argument("--batch-size", type=int, default=50)
+        parser.add_argument("--list-sizes", type=int, nargs="*", help="job counts of the list suite")
+        parser.add_argument("--url", help="server the uploads suite posts to, e.g. http://localhost:8000")
+        parser.add_argument("--username")
+        parser.add_argument("--password")
+        parser.add_argument("--clients", type=int, nargs="*", help="concurrent uploads of the uploads suite")
+        parser.add_argument("--upload-rate", type=int, default=64 * 1024, help="bytes/s sent by every upload")
+        # uploads smaller than the socket buffers are taken in by the kernel, use a phone photo
+        parser.add_argument("--upload-file", default=benchmarks.SAMPLE_IMAGE, help="image posted by the uploads")
+        parser.add_argument("--json", help="write the results as json to this file, - for stdout")
+        parser.add_argument("--baseline", help="json results of an earlier run to flag regressions against")
+        parser.add_argument("--tolerance", type=float, default=0.2, help="tolerated relative slowdown")
+
+    def _run(self, suite: str, options: Dict) -> List[Dict]:
+        repeat = options["repeat"]
+        sizes = {"megapixels": tuple(options["megapixels"])} if options["megapixels"] else {}
+        if suite == "resize":
+            return benchmarks.bench_resize(repeat=repeat, **sizes)
+        if suite == "encode":
+            return benchmarks.bench_encode(repeat=repeat, **sizes)
+        if suite == "pipeline":
+            return benchmarks.bench_pipeline(repeat=repeat, **sizes)
+        if suite == "jobs":
+            return benchmarks.bench_jobs(count=options["jobs"], batch_size=options["batch_size"])
+        if suite == "list":
+            counts = {"counts": tuple(options["list_sizes"])} if options["list_sizes"] else {}
+            return benchmarks.bench_list(repeat=repeat, **counts)
+        if suite == "links":
+            return benchmarks.bench_links(repeat=repeat)
+        if not (options["url"] and options["username"] and options["password"]):
+            raise CommandError("the uploads suite needs --url, --username and --password")
+        clients = {"clients": tuple(options["clients"])} if options["clients"] else {}
+        return benchmarks.bench_uploads(
+            options["url"],
+            options["username"],
+            options["password"],
+            rate=options["upload_rate"],
+            filename=options["upload_file"],
+            **clients,
+        )
+
+    def handle(self, *args, **options):
+        suites = SUITES if "all" in options["suites"] else list(dict.fromkeys(options["suites"]))
+        results = {}
+        for suite in suites:
+            results[suite] = self._run(suite, options)
+            if options["json"] != "-":
+                for result in results[suite]:
+                    self.stdout.write(FORMATS[suite].format(**result))
+
+        report = {"environment": benchmarks.environment(), "results": results}
+        if options["json"] == "-":
+            self.stdout.write(json.dumps(report, indent=2))
+        elif options["json"]:
+            with open(options["json"], "w") as f:
+                json.dump(report, f, indent=2)
+
+        if options["baseline"]:
+            with open(options["baseline"]) as f:
+                baseline = json.load(f)["results"]
+            regressions = benchmarks.compare(results, baseline, options["tolerance"])
+            for regression in regressions:
+                self.stderr.write(
+                    "regression {id}: {metric} {baseline:.6g} -> {value:.6g} ({change:+.0%})".format(**regression)
+                )
+            if regressions:
+                raise CommandError(f"{len(regressions)} regressions against {options['baseline']}")
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.scheduling import queue_stats
+
+
+class Command(BaseCommand):
+    help = "Show depth and wait times of the image job queues"
+
+    def handle(self, *args, **options):
+        for stats in queue_stats():
+            self.stdout.write(
+                "{queue:<20} depth {depth:6d}  users {users:4d}  oldest {oldest_wait_s:8.1f}s  "
+                "started {started:6d}  wait avg {avg_wait_s:8.1f}s  max {max_wait_s:8.1f}s".format(**stats)
+            )
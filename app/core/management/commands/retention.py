@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from core import retention
+
+
+class Command(BaseCommand):
+    help = "Run the retention sweeps: expired external links, originals of failed jobs and orphaned media files"
+
+    def add_arguments(self, parser) -> None:
+        parser.add_argument("sweeps", nargs="*", choices=["links", "failed", "orphans"], help="all by default")
+        parser.add_argument("--dry-run", action="store_true", help="only list the orphaned media files")
+
+    def handle(self, *args, **options):
+        sweeps = options["sweeps"] or ["links", "failed", "orphans"]
+        if "links" in sweeps and not options["dry_run"]:
+            self.stdout.write(f"expired links purged: {retention.purge_expired_links()}")
+        if "failed" in sweeps and not options["dry_run"]:
+            self.stdout.write(f"originals of failed jobs dropped: {retention.purge_failed_jobs()}")
+        if "orphans" in sweeps:
+            orphans = retention.reconcile_media(dry_run=options["dry_run"])
+            for name in orphans:
+                self.stdout.write(f"  {name}")
+            self.stdout.write(f"orphaned media files {'found' if options['dry_run'] else 'deleted'}: {len(orphans)}")
@@ -1,6 +1,7 @@
 from django.contrib.auth.models import User
 from django.core.management.base import BaseCommand, CommandError
 
+from core import plans
 from core.models import Plan, UserPlan
 
 
@@ -24,8 +25,10 @@ class Command(BaseCommand):
                 )
             )
 
-        n = UserPlan.objects.update(user=user, plan=plan)
+        n = UserPlan.objects.filter(user=user).update(plan=plan)
         if n == 0:
             UserPlan.objects.create(user=user, plan=plan)
+        else:
+            plans.invalidate()  # update() sends no signals
 
         self.stdout.write(self.style.SUCCESS("Successfully changed plan"))
@@ -0,0 +1,134 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Callable, Iterable, Iterator
+
+from django.conf import settings
+from django.http import HttpRequest, HttpResponse
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from celery.signals import worker_init
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+)
+from prometheus_client.core import GaugeMetricFamily, Metric
+from prometheus_client.registry import Collector
+
+from core.models import ImageJob
+from core.scheduling import queue_stats
+
+STAGE_SECONDS = Histogram(
+    "heximg_job_stage_seconds",
+    "Duration of the image job processing stages",
+    ["stage"],
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+)
+JOB_MEGAPIXELS = Histogram(
+    "heximg_job_original_megapixels",
+    "Resolution of the processed originals",
+    buckets=(0.1, 0.5, 1, 2, 5, 12, 24, 50, 100, 200),
+)
+JOB_BYTES_WRITTEN = Histogram(
+    "heximg_job_bytes_written",
+    "Bytes of thumbnails written per image job",
+    buckets=tuple(4**exponent * 1024 for exponent in range(10)),
+)
+REQUEST_SECONDS = Histogram(
+    "heximg_request_seconds",
+    "Latency of the API and image requests",
+    ["view", "method", "status"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    if not settings.METRICS_ENABLED:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.labels(name).observe(time.perf_counter() - start)
+
+
+def observe_job(img_job: ImageJob, bytes_written: int) -> None:
+    if not settings.METRICS_ENABLED:
+        return
+    if img_job.original_width and img_job.original_height:
+        JOB_MEGAPIXELS.observe(img_job.original_width * img_job.original_height / 1_000_000)
+    JOB_BYTES_WRITTEN.observe(bytes_written)
+
+
+class RequestMetricsMiddleware:
+    # only installed with METRICS_ENABLED; async capable, so async views under asgi don't hop to a thread for it
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response: Callable) -> None:
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request: HttpRequest):
+        if iscoroutinefunction(self):
+            return self._acall(request)
+        start = time.perf_counter()
+        response = self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    async def _acall(self, request: HttpRequest) -> HttpResponse:
+        start = time.perf_counter()
+        response = await self.get_response(request)
+        self._observe(request, response, start)
+        return response
+
+    def _observe(self, request: HttpRequest, response: HttpResponse, start: float) -> None:
+        # url names keep the label cardinality bounded
+        view = request.resolver_match.url_name if request.resolver_match else None
+        REQUEST_SECONDS.labels(view or "unresolved", request.method, response.status_code).observe(
+            time.perf_counter() - start
+        )
+
+
+class QueueCollector(Collector):
+    # read from the database at scrape time, by the api's endpoint only: the values aren't per process
+    def collect(self) -> Iterable[Metric]:
+        depth = GaugeMetricFamily("heximg_queue_depth", "Image jobs waiting in the queue", labels=["queue"])
+        users = GaugeMetricFamily("heximg_queue_users", "Users with image jobs waiting in the queue", labels=["queue"])
+        oldest_wait = GaugeMetricFamily(
+            "heximg_queue_oldest_wait_seconds", "Wait so far of the oldest image job in the queue", labels=["queue"]
+        )
+        for stats in queue_stats():
+            depth.add_metric([stats["queue"]], stats["depth"])
+            users.add_metric([stats["queue"]], stats["users"])
+            oldest_wait.add_metric([stats["queue"]], stats["oldest_wait_s"])
+        return [depth, users, oldest_wait]
+
+
+def _registry() -> CollectorRegistry:
+    # prefork workers and multi-process servers share their samples through PROMETHEUS_MULTIPROC_DIR
+    if "PROMETHEUS_MULTIPROC_DIR" not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def exposition() -> bytes:
+    queues = CollectorRegistry()
+    queues.register(QueueCollector())
+    return generate_latest(_registry()) + generate_latest(queues)
+
+
+@worker_init.connect
+def start_worker_metrics_server(**kwargs) -> None:
+    if settings.METRICS_ENABLED and settings.METRICS_WORKER_PORT:
+        start_http_server(settings.METRICS_WORKER_PORT, registry=_registry())
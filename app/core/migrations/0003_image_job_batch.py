@@ -0,0 +1,26 @@
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0002_auto_20230929_2058"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ImageJobBatch",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("created_at", models.DateTimeField(auto_now_add=True)),
+                ("user_plan", models.ForeignKey(on_delete=django.db.models.deletion.RESTRICT, to="core.userplan")),
+            ],
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="batch",
+            field=models.ForeignKey(
+                null=True, on_delete=django.db.models.deletion.RESTRICT, related_name="jobs", to="core.imagejobbatch"
+            ),
+        ),
+    ]
@@ -0,0 +1,42 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0003_image_job_batch"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="plan",
+            name="lazy_thumbnails",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="thumbnail",
+            name="file_size",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="thumbnail",
+            name="last_accessed_at",
+            field=models.DateTimeField(db_index=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="thumbnail",
+            name="lazy",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AlterField(
+            model_name="thumbnail",
+            name="image",
+            field=models.ImageField(blank=True, upload_to="thumbs/"),
+        ),
+        migrations.AddConstraint(
+            model_name="plan",
+            constraint=models.CheckConstraint(
+                check=models.Q(("lazy_thumbnails", False), ("keeping_original_image", True), _connector="OR"),
+                name="lazy_thumbnails_keeping_original_image",
+            ),
+        ),
+    ]
@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0004_lazy_thumbnails"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagejob",
+            name="original_digest",
+            field=models.CharField(db_index=True, max_length=64, null=True),
+        ),
+    ]
@@ -0,0 +1,14 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0005_original_digest"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="imagejob",
+            index=models.Index(fields=["user_plan", "created_at", "id"], name="imagejob_user_plan_created"),
+        ),
+    ]
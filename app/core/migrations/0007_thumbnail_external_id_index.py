@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0006_image_job_keyset_index"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="thumbnail",
+            name="external_id",
+            field=models.UUIDField(db_index=True, null=True),
+        ),
+    ]
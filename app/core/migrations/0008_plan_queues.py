@@ -0,0 +1,38 @@
+from django.db import migrations, models
+
+
+def route_builtin_plans(apps, schema_editor):
+    Plan = apps.get_model("core", "Plan")
+    Plan.objects.filter(title="Premium").update(queue="images-premium")
+    Plan.objects.filter(title="Enterprise").update(queue="images-enterprise")
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0007_thumbnail_external_id_index"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagejob",
+            name="queue",
+            field=models.CharField(default="images", max_length=50),
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="started_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name="plan",
+            name="queue",
+            field=models.CharField(default="images", max_length=50),
+        ),
+        migrations.AddIndex(
+            model_name="imagejob",
+            index=models.Index(
+                condition=models.Q(("status", "N")), fields=["queue", "user_plan", "id"], name="imagejob_new_queue"
+            ),
+        ),
+        migrations.RunPython(route_builtin_plans, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,84 @@
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+def create_balanced_profile(apps, schema_editor):
+    # chosen with `manage.py benchmark encode`: about the bytes of pillow's defaults (q75) at a lower error.
+    # png thumbnails stay png, opaque_png_to_jpeg (about 4x smaller) is turned on per profile in the admin
+    EncoderProfile = apps.get_model("core", "EncoderProfile")
+    Plan = apps.get_model("core", "Plan")
+    profile = EncoderProfile.objects.create(
+        name="Balanced",
+        quality=80,
+        subsampling=2,
+        progressive=True,
+        optimize=True,
+        png_compress_level=6,
+        variant_quality=80,
+    )
+    Plan.objects.filter(title__in=["Basic", "Premium", "Enterprise"]).update(encoder_profile=profile)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0008_plan_queues"),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="EncoderProfile",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("name", models.CharField(max_length=30, unique=True)),
+                (
+                    "quality",
+                    models.PositiveSmallIntegerField(
+                        default=80,
+                        validators=[
+                            django.core.validators.MinValueValidator(1),
+                            django.core.validators.MaxValueValidator(95),
+                        ],
+                    ),
+                ),
+                (
+                    "subsampling",
+                    models.PositiveSmallIntegerField(choices=[(0, "4:4:4"), (1, "4:2:2"), (2, "4:2:0")], default=2),
+                ),
+                ("progressive", models.BooleanField(default=True)),
+                ("optimize", models.BooleanField(default=True)),
+                (
+                    "png_compress_level",
+                    models.PositiveSmallIntegerField(
+                        default=6, validators=[django.core.validators.MaxValueValidator(9)]
+                    ),
+                ),
+                ("opaque_png_to_jpeg", models.BooleanField(default=False)),
+                (
+                    "variant_quality",
+                    models.PositiveSmallIntegerField(
+                        default=80,
+                        validators=[
+                            django.core.validators.MinValueValidator(1),
+                            django.core.validators.MaxValueValidator(100),
+                        ],
+                    ),
+                ),
+            ],
+        ),
+        migrations.AddField(
+            model_name="plan",
+            name="encoder_profile",
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="core.encoderprofile"
+            ),
+        ),
+        migrations.AddField(
+            model_name="thumbnailsize",
+            name="encoder_profile",
+            field=models.ForeignKey(
+                blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="core.encoderprofile"
+            ),
+        ),
+        migrations.RunPython(create_balanced_profile, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0009_encoder_profiles"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagejob",
+            name="original_format",
+            field=models.CharField(max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="original_height",
+            field=models.PositiveIntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="original_mode",
+            field=models.CharField(max_length=10, null=True),
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="original_width",
+            field=models.PositiveIntegerField(null=True),
+        ),
+    ]
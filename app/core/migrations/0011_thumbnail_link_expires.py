@@ -0,0 +1,18 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0010_original_header"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="thumbnail",
+            index=models.Index(
+                condition=models.Q(("external_id_expires_at__isnull", False)),
+                fields=["external_id_expires_at"],
+                name="thumbnail_link_expires",
+            ),
+        ),
+    ]
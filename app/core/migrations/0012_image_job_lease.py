@@ -0,0 +1,40 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import migrations, models
+from django.utils import timezone
+
+
+def lease_pending_jobs(apps, schema_editor):
+    # jobs pending since before leases get one from now, so those of workers lost back then are reclaimed too
+    ImageJob = apps.get_model("core", "ImageJob")
+    lease_expires_at = timezone.now() + timedelta(seconds=settings.IMAGE_JOB_LEASE)
+    ImageJob.objects.filter(status="P").update(lease_expires_at=lease_expires_at, attempts=1)
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0011_thumbnail_link_expires"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagejob",
+            name="attempts",
+            field=models.PositiveSmallIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name="imagejob",
+            name="lease_expires_at",
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddIndex(
+            model_name="imagejob",
+            index=models.Index(
+                condition=models.Q(("lease_expires_at__isnull", False)),
+                fields=["lease_expires_at"],
+                name="imagejob_lease",
+            ),
+        ),
+        migrations.RunPython(lease_pending_jobs, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,37 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0012_image_job_lease"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="plan",
+            name="max_in_flight_jobs",
+            field=models.PositiveIntegerField(
+                blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]
+            ),
+        ),
+        migrations.AddField(
+            model_name="plan",
+            name="megapixels_per_hour",
+            field=models.PositiveIntegerField(
+                blank=True, null=True, validators=[django.core.validators.MinValueValidator(1)]
+            ),
+        ),
+        migrations.AddField(
+            model_name="plan",
+            name="upload_burst",
+            field=models.PositiveIntegerField(default=10, validators=[django.core.validators.MinValueValidator(1)]),
+        ),
+        migrations.AddField(
+            model_name="plan",
+            name="upload_rate",
+            field=models.FloatField(
+                blank=True, null=True, validators=[django.core.validators.MinValueValidator(0.001)]
+            ),
+        ),
+    ]
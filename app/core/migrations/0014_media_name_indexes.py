@@ -0,0 +1,26 @@
+import django.core.validators
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0013_plan_limits"),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name="imagejob",
+            name="original_image",
+            field=models.ImageField(
+                db_index=True,
+                null=True,
+                upload_to="original/",
+                validators=[django.core.validators.FileExtensionValidator(["png", "jpeg", "jpg"])],
+            ),
+        ),
+        migrations.AlterField(
+            model_name="thumbnail",
+            name="image",
+            field=models.ImageField(blank=True, db_index=True, upload_to="thumbs/"),
+        ),
+    ]
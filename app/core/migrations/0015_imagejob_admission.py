@@ -0,0 +1,15 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("core", "0014_media_name_indexes"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="imagejob",
+            name="admission",
+            field=models.CharField(blank=True, default="", max_length=40),
+        ),
+    ]
@@ -1,24 +1,80 @@
+import os
+
 from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
 from django.core.validators import (
     FileExtensionValidator,
     MaxValueValidator,
     MinValueValidator,
 )
 from django.db import models
+from django.utils.translation import gettext_lazy as _
+
+
+class EncoderProfile(models.Model):
+    SUBSAMPLING_444 = 0
+    SUBSAMPLING_422 = 1
+    SUBSAMPLING_420 = 2
+    SUBSAMPLING_CHOICES = (
+        (SUBSAMPLING_444, "4:4:4"),
+        (SUBSAMPLING_422, "4:2:2"),
+        (SUBSAMPLING_420, "4:2:0"),
+    )
+    name = models.CharField(max_length=30, unique=True)
+    quality = models.PositiveSmallIntegerField(default=80, validators=[MinValueValidator(1), MaxValueValidator(95)])
+    subsampling = models.PositiveSmallIntegerField(choices=SUBSAMPLING_CHOICES, default=SUBSAMPLING_420)
+    progressive = models.BooleanField(default=True)
+    optimize = models.BooleanField(default=True)
+    png_compress_level = models.PositiveSmallIntegerField(default=6, validators=[MaxValueValidator(9)])
+    # photos uploaded as png get far smaller jpeg thumbnails, transparent images stay png
+    opaque_png_to_jpeg = models.BooleanField(default=False)
+    # webp/avif variants
+    variant_quality = models.PositiveSmallIntegerField(
+        default=80, validators=[MinValueValidator(1), MaxValueValidator(100)]
+    )
+
+    def __str__(self) -> str:
+        return self.name
 
 
 class Plan(models.Model):
     title = models.CharField(max_length=30, unique=True)
     keeping_original_image = models.BooleanField(default=False)
     expiring_link = models.BooleanField(default=False)
+    # thumbnails are rendered on first request, which needs the original to be kept
+    lazy_thumbnails = models.BooleanField(default=False)
+    # celery queue of the plan's jobs, consumed by a worker pool sized for the tier
+    queue = models.CharField(max_length=50, default="images")
+    # pillow defaults without a profile
+    encoder_profile = models.ForeignKey(EncoderProfile, on_delete=models.SET_NULL, null=True, blank=True)
+    # admission limits of the plan's users, none when empty: uploads refill at upload_rate per second
+    # up to upload_burst, megapixels per hour refill by the second up to an hour's worth
+    upload_rate = models.FloatField(null=True, blank=True, validators=[MinValueValidator(0.001)])
+    upload_burst = models.PositiveIntegerField(default=10, validators=[MinValueValidator(1)])
+    max_in_flight_jobs = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
+    megapixels_per_hour = models.PositiveIntegerField(null=True, blank=True, validators=[MinValueValidator(1)])
+
+    class Meta:
+        constraints = [
+            models.CheckConstraint(
+                check=models.Q(lazy_thumbnails=False) | models.Q(keeping_original_image=True),
+                name="lazy_thumbnails_keeping_original_image",
+            )
+        ]
 
     def __str__(self) -> str:
         return self.title
 
+    def clean(self) -> None:
+        if self.lazy_thumbnails and not self.keeping_original_image:
+            raise ValidationError({"lazy_thumbnails": _("Lazy thumbnails require keeping the original image.")})
+
 
 class ThumbnailSize(models.Model):
     plan = models.ForeignKey(Plan, on_delete=models.RESTRICT)
     height = models.PositiveSmallIntegerField()
+    # overrides the plan's profile
+    encoder_profile = models.ForeignKey(EncoderProfile, on_delete=models.SET_NULL, null=True, blank=True)
 
 
 class UserPlan(models.Model):
@@ -26,6 +82,11 @@ class UserPlan(models.Model):
     plan = models.ForeignKey(Plan, on_delete=models.RESTRICT)
 
 
+class ImageJobBatch(models.Model):
+    user_plan = models.ForeignKey(UserPlan, on_delete=models.RESTRICT)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+
 class ImageJob(models.Model):
     STATUS_NEW = "N"
     STATUS_PENDING = "P"
@@ -38,19 +99,70 @@ class ImageJob(models.Model):
         (STATUS_ERROR, "Error"),
     )
     user_plan = models.ForeignKey(UserPlan, on_delete=models.RESTRICT)
+    batch = models.ForeignKey(ImageJobBatch, on_delete=models.RESTRICT, null=True, related_name="jobs")
+    # indexed: shared originals are reference counted by the rows naming them
     original_image = models.ImageField(
         upload_to="original/",
         validators=[FileExtensionValidator(["png", "jpeg", "jpg"])],
         null=True,
+        db_index=True,
     )
+    # sha256 of the uploaded original, identical uploads share originals and thumbnails
+    original_digest = models.CharField(max_length=64, null=True, db_index=True)
+    # from the original's header at upload time, so routing and limits don't need its pixels
+    original_width = models.PositiveIntegerField(null=True)
+    original_height = models.PositiveIntegerField(null=True)
+    original_format = models.CharField(max_length=10, null=True)
+    original_mode = models.CharField(max_length=10, null=True)
     link_expires_in = models.SmallIntegerField(null=True, validators=[MinValueValidator(300), MaxValueValidator(30000)])
     created_at = models.DateTimeField(auto_now_add=True)
     status = models.CharField(max_length=3, choices=STATUS_CHOICES, default=STATUS_NEW)
+    queue = models.CharField(max_length=50, default="images")
+    started_at = models.DateTimeField(null=True)
+    # pending: until when the claiming worker owns the job; new: when a reclaimed job may be retried
+    lease_expires_at = models.DateTimeField(null=True)
+    # claims so far, also the fencing token of the current one
+    attempts = models.PositiveSmallIntegerField(default=0)
+    # its upload's member of the user plan's jobs in flight, of plans limiting them (core.quotas)
+    admission = models.CharField(max_length=40, blank=True, default="")
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["user_plan", "created_at", "id"], name="imagejob_user_plan_created"),
+            models.Index(
+                fields=["queue", "user_plan", "id"], condition=models.Q(status="N"), name="imagejob_new_queue"
+            ),
+            models.Index(
+                fields=["lease_expires_at"],
+                condition=models.Q(lease_expires_at__isnull=False),
+                name="imagejob_lease",
+            ),
+        ]
 
 
 class Thumbnail(models.Model):
     image_job = models.ForeignKey(ImageJob, on_delete=models.RESTRICT, related_name="thumbnails")
-    image = models.ImageField(upload_to="thumbs/")
+    # indexed like the original, shared thumbnail files are reference counted too
+    image = models.ImageField(upload_to="thumbs/", blank=True, db_index=True)
     height = models.SmallIntegerField()
-    external_id = models.UUIDField(null=True)
+    external_id = models.UUIDField(null=True, db_index=True)
     external_id_expires_at = models.DateTimeField(null=True)
+    file_size = models.PositiveIntegerField(null=True)
+    # lazy thumbnails have no image until first requested and may be evicted again
+    lazy = models.BooleanField(default=False)
+    last_accessed_at = models.DateTimeField(null=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # only the rows with a link, for the sweep of expired ones
+            models.Index(
+                fields=["external_id_expires_at"],
+                condition=models.Q(external_id_expires_at__isnull=False),
+                name="thumbnail_link_expires",
+            ),
+        ]
+
+    @property
+    def ext(self) -> str:
+        # lazy thumbnails take the original's extension until they are rendered
+        return os.path.splitext(self.image.name or self.image_job.original_image.name)[-1]
@@ -0,0 +1,69 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination
+from rest_framework.request import Request
+from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
+
+
+class KeysetPagination(BasePagination):
+    # cursor pagination on (created_at, id), newest first, matching the (user_plan, created_at, id) index
+    cursor_query_param = "cursor"
+    page_size_query_param = "page_size"
+    invalid_cursor_message = _("Invalid cursor")
+
+    def paginate_queryset(self, queryset: QuerySet, request: Request, view=None) -> List:
+        self.request = request
+        self.page_size = self.get_page_size(request)
+        cursor = self.decode_cursor(request)
+        if cursor is not None:
+            created_at, pk = cursor
+            # the first condition alone bounds the index range scan, the second one drops the boundary rows
+            queryset = queryset.filter(created_at__lte=created_at).filter(Q(created_at__lt=created_at) | Q(id__lt=pk))
+        page = list(queryset.order_by("-created_at", "-id")[: self.page_size + 1])
+        self.has_next = len(page) > self.page_size
+        self.page = page[: self.page_size]
+        return self.page
+
+    def get_page_size(self, request: Request) -> int:
+        try:
+            page_size = int(request.query_params[self.page_size_query_param])
+        except (KeyError, ValueError):
+            return settings.IMAGE_JOB_PAGE_SIZE
+        return min(max(page_size, 1), settings.IMAGE_JOB_MAX_PAGE_SIZE)
+
+    def decode_cursor(self, request: Request) -> Optional[Tuple[datetime, int]]:
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            created_at, pk = urlsafe_b64decode(encoded.encode("ascii")).decode("ascii").split("|")
+            parsed = parse_datetime(created_at)
+            if parsed is None:
+                raise ValueError(created_at)
+            return parsed, int(pk)
+        except (TypeError, ValueError, UnicodeError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, created_at: datetime, pk: int) -> str:
+        return urlsafe_b64encode(f"{created_at.isoformat()}|{pk}".encode("ascii")).decode("ascii")
+
+    def get_next_link(self) -> Optional[str]:
+        if not self.has_next:
+            return None
+        # pages of jobs or of their values() rows
+        last = self.page[-1]
+        created_at, pk = (last["created_at"], last["id"]) if isinstance(last, dict) else (last.created_at, last.id)
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, self.encode_cursor(created_at, pk))
+
+    def get_paginated_response(self, data) -> Response:
+        return Response({"next": self.get_next_link(), "results": data})
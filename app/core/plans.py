@@ -0,0 +1,123 @@
+import time
+from dataclasses import dataclass, replace
+from functools import lru_cache
+from typing import List, Optional, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+
+from core.encoding import EncoderConfig
+from core.models import Plan, ThumbnailSize, UserPlan
+
+VERSION_KEY = "plans:version"
+
+
+@dataclass(frozen=True)
+class PlanConfig:
+    id: int
+    title: str
+    keeping_original_image: bool
+    expiring_link: bool
+    lazy_thumbnails: bool
+    queue: str
+    heights: Tuple[int, ...]  # descending
+    encoders: Tuple[Optional[EncoderConfig], ...]  # of the heights
+    # admission limits, none when empty
+    upload_rate: Optional[float] = None
+    upload_burst: int = 10
+    max_in_flight_jobs: Optional[int] = None
+    megapixels_per_hour: Optional[int] = None
+
+    @property
+    def rate_limited(self) -> bool:
+        return bool(self.upload_rate or self.max_in_flight_jobs or self.megapixels_per_hour)
+
+    def encoder(self, height: int) -> Optional[EncoderConfig]:
+        return self.encoders[self.heights.index(height)] if height in self.heights else None
+
+    def only(self, heights: List[int]) -> "PlanConfig":
+        kept = [index for index, height in enumerate(self.heights) if height in heights]
+        return replace(
+            self,
+            heights=tuple(self.heights[index] for index in kept),
+            encoders=tuple(self.encoders[index] for index in kept),
+        )
+
+
+@dataclass(frozen=True)
+class UserPlanConfig:
+    id: int
+    plan: PlanConfig
+
+
+# process local, dropped whenever the shared version key moves
+_local_version: Optional[int] = None
+_checked_at = 0.0
+
+
+@lru_cache(maxsize=None)
+def _load_plan(plan_id: int) -> PlanConfig:
+    plan = Plan.objects.select_related("encoder_profile").get(id=plan_id)
+    sizes = ThumbnailSize.objects.filter(plan_id=plan_id).select_related("encoder_profile").order_by("-height")
+    plan_encoder = EncoderConfig.from_profile(plan.encoder_profile) if plan.encoder_profile else None
+    return PlanConfig(
+        id=plan.id,
+        title=plan.title,
+        keeping_original_image=plan.keeping_original_image,
+        expiring_link=plan.expiring_link,
+        lazy_thumbnails=plan.lazy_thumbnails,
+        queue=plan.queue,
+        heights=tuple(size.height for size in sizes),
+        encoders=tuple(
+            EncoderConfig.from_profile(size.encoder_profile) if size.encoder_profile else plan_encoder for size in sizes
+        ),
+        upload_rate=plan.upload_rate,
+        upload_burst=plan.upload_burst,
+        max_in_flight_jobs=plan.max_in_flight_jobs,
+        megapixels_per_hour=plan.megapixels_per_hour,
+    )
+
+
+@lru_cache(maxsize=settings.PLAN_CONFIG_CACHE_USERS)
+def _load_user_plan(**lookup) -> Optional[Tuple[int, int]]:
+    return UserPlan.objects.filter(**lookup).values_list("id", "plan_id").first()
+
+
+def _check_version() -> None:
+    global _local_version, _checked_at
+    now = time.monotonic()
+    if now - _checked_at < settings.PLAN_CONFIG_CHECK_INTERVAL:
+        return
+    _checked_at = now
+    version = cache.get_or_set(VERSION_KEY, 1, timeout=None)
+    if version != _local_version:
+        clear_local()
+        _local_version = version
+
+
+def clear_local() -> None:
+    _load_plan.cache_clear()
+    _load_user_plan.cache_clear()
+
+
+def invalidate() -> None:
+    # other processes notice the new version within PLAN_CONFIG_CHECK_INTERVAL
+    try:
+        cache.incr(VERSION_KEY)
+    except ValueError:
+        cache.set(VERSION_KEY, 1, timeout=None)
+    clear_local()
+
+
+def get_user_plan_config(user_id: int) -> Optional[UserPlanConfig]:
+    _check_version()
+    user_plan = _load_user_plan(user_id=user_id)
+    return UserPlanConfig(id=user_plan[0], plan=_load_plan(user_plan[1])) if user_plan else None
+
+
+def get_user_plan_config_by_id(user_plan_id: int) -> UserPlanConfig:
+    _check_version()
+    user_plan = _load_user_plan(id=user_plan_id)
+    if user_plan is None:
+        raise UserPlan.DoesNotExist()
+    return UserPlanConfig(id=user_plan[0], plan=_load_plan(user_plan[1]))
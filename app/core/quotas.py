@@ -0,0 +1,197 @@
+import logging
+import re
+from collections import defaultdict
+from functools import lru_cache
+from typing import Dict, Iterable, List, Tuple
+from uuid import uuid4
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.translation import gettext_lazy as _
+
+import redis
+from rest_framework.exceptions import Throttled
+
+from core.models import ImageJob
+from core.plans import UserPlanConfig
+
+logger = logging.getLogger(__name__)
+
+IN_FLIGHT_KEY_RE = re.compile(r"^rate-limit:\{(\d+)\}:in-flight-jobs$")
+
+# KEYS: upload bucket, megapixel bucket, in-flight jobs
+# ARGV: upload rate, upload burst, uploads, megapixel rate, megapixel burst, megapixels (rates per second, 0 for
+# none), max in flight (0 for none), in-flight ttl, in-flight retry after, admission
+# every limit is checked before any is taken; returns the exceeded limit and the milliseconds to wait, or "".
+# jobs in flight are a sorted set scored by admit time, each upload counted as "<admission>:<n>", which its job
+# keeps (ImageJob.admission) to be released by; members older than the ttl are dropped one by one, a leaked one
+# doesn't stick
+ADMIT = """
+local unpack = unpack or table.unpack -- redis runs lua 5.1, lupa (fakeredis in the tests) a later one
+local clock = redis.call("TIME")
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local uploads = tonumber(ARGV[3])
+local buckets = {
+    {"uploads", KEYS[1], tonumber(ARGV[1]), tonumber(ARGV[2]), uploads},
+    {"megapixels", KEYS[2], tonumber(ARGV[4]), tonumber(ARGV[5]), tonumber(ARGV[6])},
+}
+local levels = {}
+for i, bucket in ipairs(buckets) do
+    local limit, key, rate, burst, cost = unpack(bucket)
+    if rate > 0 then
+        local state = redis.call("HMGET", key, "tokens", "at")
+        local tokens = tonumber(state[1])
+        levels[i] = tokens and math.min(burst, tokens + (now - tonumber(state[2])) * rate) or burst
+        -- a cost beyond the burst is taken from a full bucket, which is left in debt
+        local needed = math.min(cost, burst)
+        if levels[i] < needed then
+            return {limit, math.ceil((needed - levels[i]) / rate * 1000)}
+        end
+    end
+end
+local max_in_flight = tonumber(ARGV[7])
+if max_in_flight > 0 then
+    redis.call("ZREMRANGEBYSCORE", KEYS[3], "-inf", now - tonumber(ARGV[8]))
+    local in_flight = redis.call("ZCARD", KEYS[3])
+    if in_flight > 0 and in_flight + uploads > max_in_flight then
+        return {"in_flight", tonumber(ARGV[9]) * 1000}
+    end
+end
+for i, bucket in ipairs(buckets) do
+    local limit, key, rate, burst, cost = unpack(bucket)
+    if rate > 0 then
+        redis.call("HSET", key, "tokens", levels[i] - cost, "at", now)
+        -- dropped once it would be full again
+        redis.call("PEXPIRE", key, math.ceil((burst - levels[i] + cost) / rate * 1000) + 1000)
+    end
+end
+if max_in_flight > 0 then
+    for n = 1, uploads do
+        redis.call("ZADD", KEYS[3], now, ARGV[10] .. ":" .. n)
+    end
+    redis.call("EXPIRE", KEYS[3], ARGV[8])
+end
+return {"", 0}
+"""
+
+MESSAGES = {
+    "uploads": _("Upload rate limit of your plan exceeded."),
+    "megapixels": _("Hourly megapixel limit of your plan exceeded."),
+    "in_flight": _("Too many of your jobs are still being processed."),
+}
+
+
+def enabled() -> bool:
+    return bool(settings.RATE_LIMIT_URL)
+
+
+@lru_cache(maxsize=None)
+def _client(url: str) -> redis.Redis:
+    return redis.Redis.from_url(url, decode_responses=True)
+
+
+def _keys(user_plan_id: int) -> List[str]:
+    # hash tagged, a user plan's keys stay on one cluster node for the script
+    return [f"rate-limit:{{{user_plan_id}}}:{limit}" for limit in ("uploads", "megapixels", "in-flight-jobs")]
+
+
+def _in_flight_key(user_plan_id: int) -> str:
+    return _keys(user_plan_id)[2]
+
+
+def admit(user_plan: UserPlanConfig, uploads: int, megapixels: float) -> List[str]:
+    # a single round trip takes all of the plan's limits at once or none of them; raises Throttled.
+    # the uploads' members of the jobs in flight for their jobs to keep, if the plan limits them
+    plan = user_plan.plan
+    if not enabled() or not plan.rate_limited:
+        return []
+    admission = uuid4().hex if plan.max_in_flight_jobs else ""
+    client = _client(settings.RATE_LIMIT_URL)
+    try:
+        limit, wait = client.register_script(ADMIT)(
+            keys=_keys(user_plan.id),
+            args=[
+                plan.upload_rate or 0,
+                plan.upload_burst,
+                uploads,
+                (plan.megapixels_per_hour or 0) / 3600,
+                plan.megapixels_per_hour or 0,
+                megapixels,
+                plan.max_in_flight_jobs or 0,
+                settings.RATE_LIMIT_IN_FLIGHT_TTL,
+                settings.RATE_LIMIT_IN_FLIGHT_RETRY_AFTER,
+                admission,
+            ],
+        )
+    except redis.RedisError as e:
+        # the limits protect the workers, uploads don't depend on them
+        logger.warning("rate limits not enforced: %s", e)
+        return []
+    if limit:
+        raise Throttled(wait=wait / 1000, detail=str(MESSAGES[limit]))
+    return [f"{admission}:{n}" for n in range(1, uploads + 1)] if admission else []
+
+
+def withdraw(user_plan_id: int, admissions: List[str]) -> None:
+    # admitted uploads whose jobs weren't created
+    if not admissions:
+        return
+    try:
+        _client(settings.RATE_LIMIT_URL).zrem(_in_flight_key(user_plan_id), *admissions)
+    except redis.RedisError as e:
+        logger.warning("jobs in flight not released: %s", e)
+
+
+def release(img_job_ids: List[int]) -> None:
+    # finished jobs, from the user plan whatever plan the user is on now: the jobs were counted under the plan
+    # they were admitted by
+    admissions: Dict[int, List[str]] = defaultdict(list)
+    for user_plan_id, admission in (
+        ImageJob.objects.filter(id__in=img_job_ids).exclude(admission="").values_list("user_plan_id", "admission")
+    ):
+        admissions[user_plan_id].append(admission)
+    if not admissions:
+        return
+    client = _client(settings.RATE_LIMIT_URL)
+    try:
+        with client.pipeline(transaction=False) as pipe:
+            for user_plan_id, members in admissions.items():
+                pipe.zrem(_in_flight_key(user_plan_id), *members)
+            pipe.execute()
+    except redis.RedisError as e:
+        # prune_in_flight drops them
+        logger.warning("jobs in flight not released: %s", e)
+
+
+def jobs_finished(jobs: Iterable[Tuple[int, int]]) -> None:
+    # jobs done or failed as (user plan id, job id), released once committed
+    img_job_ids = [img_job_id for _, img_job_id in jobs]
+    if enabled() and img_job_ids:
+        transaction.on_commit(lambda: release(img_job_ids))
+
+
+def prune_in_flight() -> int:
+    # members of jobs whose release was lost (redis unreachable, a process killed before its commit hook), of
+    # deleted jobs, and of uploads that failed without withdrawing leave the counts here; members admitted
+    # within RATE_LIMIT_IN_FLIGHT_GRACE seconds may still be getting their jobs
+    if not enabled():
+        return 0
+    client = _client(settings.RATE_LIMIT_URL)
+    pruned = 0
+    try:
+        admitted_before = client.time()[0] - settings.RATE_LIMIT_IN_FLIGHT_GRACE
+        for key in client.scan_iter(match="rate-limit:*:in-flight-jobs", count=1000):
+            members = set(client.zrangebyscore(key, "-inf", admitted_before))
+            if not members:
+                continue
+            user_plan_id = int(IN_FLIGHT_KEY_RE.match(key).group(1))  # type: ignore
+            in_flight = ImageJob.objects.filter(
+                user_plan_id=user_plan_id,
+                admission__in=members,
+                status__in=(ImageJob.STATUS_NEW, ImageJob.STATUS_PENDING),
+            ).values_list("admission", flat=True)
+            if stale := members.difference(in_flight):
+                pruned += client.zrem(key, *stale)
+    except redis.RedisError as e:
+        logger.warning("jobs in flight not pruned: %s", e)
+    return pruned
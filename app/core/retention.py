@@ -0,0 +1,109 @@
+from datetime import timedelta
+from typing import Iterable, Iterator, List
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from core import joblist, metrics
+from core.models import ImageJob, Thumbnail
+from core.variants import thumbnail_name
+
+ORIGINAL_FIELD = ImageJob._meta.get_field("original_image")
+THUMBNAIL_FIELD = Thumbnail._meta.get_field("image")
+
+
+def _chunks(items: List, size: int) -> Iterator[List]:
+    for start in range(0, len(items), size):
+        yield items[start : start + size]
+
+
+def delete_unreferenced_originals(names: Iterable[str]) -> int:
+    # outside the transaction that dropped the references; a name no committed row holds can't be taken up
+    # by a deduplicated upload anymore, which only reuses originals of rows naming them
+    names = list(set(names))
+    deleted = 0
+    with metrics.stage("delete_original"):
+        for chunk in _chunks(names, settings.RETENTION_BATCH_SIZE):
+            referenced = set(ImageJob.objects.filter(original_image__in=chunk).values_list("original_image", flat=True))
+            for name in chunk:
+                if name not in referenced:
+                    ORIGINAL_FIELD.storage.delete(name)
+                    deleted += 1
+    return deleted
+
+
+def drop_originals(img_jobs: List[ImageJob], **fields) -> None:
+    # must run in a transaction: locks every job sharing the originals, which serializes with uploads
+    # deduplicated onto them; the files are deleted once it committed. fields are updated along
+    if not img_jobs:
+        return
+    joblist.jobs_changed(img_job.user_plan_id for img_job in img_jobs)
+    names = [img_job.original_image.name for img_job in img_jobs]
+    list(ImageJob.objects.select_for_update().filter(original_image__in=names).values("id"))
+    ImageJob.objects.filter(id__in=[img_job.id for img_job in img_jobs]).update(original_image=None, **fields)
+    for img_job in img_jobs:
+        img_job.original_image = None
+    transaction.on_commit(lambda: delete_unreferenced_originals(names))
+
+
+def purge_expired_links() -> int:
+    # expired links only 404, the sweep frees their ids; walks the partial index on external_id_expires_at
+    purged = 0
+    now = timezone.now()
+    while True:
+        ids = list(
+            Thumbnail.objects.filter(external_id_expires_at__lt=now).values_list("id", flat=True)[
+                : settings.RETENTION_BATCH_SIZE
+            ]
+        )
+        if not ids:
+            return purged
+        purged += Thumbnail.objects.filter(id__in=ids).update(external_id=None, external_id_expires_at=None)
+
+
+def purge_failed_jobs() -> int:
+    # failed jobs keep their originals, nothing is going to process them anymore
+    purged = 0
+    failed = ImageJob.objects.filter(
+        status=ImageJob.STATUS_ERROR,
+        created_at__lt=timezone.now() - timedelta(seconds=settings.RETENTION_FAILED_JOBS_AFTER),
+    ).exclude(Q(original_image=None) | Q(original_image=""))
+    while img_jobs := list(failed.only("id", "user_plan_id", "original_image")[: settings.RETENTION_BATCH_SIZE]):
+        with transaction.atomic():
+            drop_originals(img_jobs)
+        purged += len(img_jobs)
+    return purged
+
+
+def _referencing_name(name: str) -> str:
+    # variants belong to the thumbnail they are named after
+    return thumbnail_name(name) or name
+
+
+def reconcile_media(dry_run: bool = False) -> List[str]:
+    # files no row names: left behind by crashed workers or uploads whose transaction rolled back;
+    # recent files may still be about to be committed
+    cutoff = timezone.now() - timedelta(seconds=settings.RETENTION_ORPHAN_GRACE)
+    orphans = []
+    for field, model in ((ORIGINAL_FIELD, ImageJob), (THUMBNAIL_FIELD, Thumbnail)):
+        storage = field.storage
+        directory = field.upload_to.rstrip("/")
+        try:
+            files = sorted(storage.listdir(directory)[1])
+        except FileNotFoundError:
+            continue
+        for chunk in _chunks([f"{directory}/{file}" for file in files], settings.RETENTION_BATCH_SIZE):
+            candidates = {name: _referencing_name(name) for name in chunk}
+            referenced = set(
+                model._default_manager.filter(**{f"{field.name}__in": set(candidates.values())}).values_list(
+                    field.name, flat=True
+                )
+            )
+            for name, referencing_name in candidates.items():
+                if referencing_name not in referenced and storage.get_modified_time(name) < cutoff:
+                    orphans.append(name)
+                    if not dry_run:
+                        storage.delete(name)
+    return orphans
@@ -0,0 +1,215 @@
+from collections import defaultdict
+from datetime import timedelta
+from functools import reduce
+from operator import or_
+from typing import Dict, Iterable, List, Tuple
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (
+    Avg,
+    Count,
+    DurationField,
+    ExpressionWrapper,
+    F,
+    Max,
+    Min,
+    Q,
+)
+from django.utils import timezone
+
+from core import events
+from core.models import ImageJob, Plan
+from core.plans import PlanConfig
+
+# the user plan a queue's last job was taken from
+ROUND_ROBIN_KEY = "image-jobs:round-robin:{queue}"
+
+
+def image_job_queue(plan: PlanConfig, size: int, pixels: int) -> str:
+    # the decoded pixels, not the compressed size, drive a job's memory and time
+    if size > settings.IMAGE_JOB_HEAVY_SIZE or pixels > settings.IMAGE_JOB_HEAVY_PIXELS:
+        return settings.IMAGE_JOB_HEAVY_QUEUE
+    return plan.queue
+
+
+def _fair_new_jobs(queue: str, limit: int, skipped: List[int]) -> List[int]:
+    # round-robin across users, on from the user served last: every user's oldest job, then every user's
+    # second oldest, ... so one bulk upload can't starve the other users of the queue. each job is a single
+    # probe of the imagejob_new_queue index for the oldest job of the next user plan
+    new = ImageJob.objects.filter(status=ImageJob.STATUS_NEW, queue=queue, lease_expires_at=None)
+    key = ROUND_ROBIN_KEY.format(queue=queue)
+    user_plan_id = cache.get(key, 0)
+    candidates = list(skipped)
+    while len(candidates) - len(skipped) < limit:
+        found = (
+            new.filter(user_plan_id__gt=user_plan_id)
+            .exclude(id__in=candidates)
+            .order_by("user_plan_id", "id")
+            .values_list("id", "user_plan_id")
+            .first()
+        )
+        if found is None:
+            if not user_plan_id:
+                break
+            user_plan_id = 0  # on from the first user again
+            continue
+        candidates.append(found[0])
+        user_plan_id = found[1]
+    cache.set(key, user_plan_id, timeout=None)
+    return candidates[len(skipped) :]
+
+
+def _claim(candidates: List[int]) -> List[int]:
+    # compare-and-set under the row locks: of concurrent claims only one moves a job out of new,
+    # retries still backing off (with a lease) aren't claimable
+    now = timezone.now()
+    with transaction.atomic():
+        claimed = dict(
+            ImageJob.objects.select_for_update(skip_locked=True)
+            .filter(id__in=candidates, status=ImageJob.STATUS_NEW, lease_expires_at=None)
+            .values_list("id", "user_plan_id")
+        )
+        ImageJob.objects.filter(id__in=list(claimed)).update(
+            status=ImageJob.STATUS_PENDING,
+            started_at=now,
+            lease_expires_at=now + timedelta(seconds=settings.IMAGE_JOB_LEASE),
+            attempts=F("attempts") + 1,
+        )
+        events.job_status_changed(
+            ImageJob.STATUS_PENDING, ((user_plan_id, img_job_id) for img_job_id, user_plan_id in claimed.items())
+        )
+    return list(claimed)
+
+
+def claim_image_job(img_job_id: int) -> bool:
+    return bool(_claim([img_job_id]))
+
+
+def claim_new_image_jobs(queue: str, limit: int) -> List[int]:
+    skipped: List[int] = []
+    while candidates := _fair_new_jobs(queue, limit, skipped):
+        # candidates claimed by another worker meanwhile are skipped
+        if img_job_ids := _claim(candidates):
+            return img_job_ids
+        skipped.extend(candidates)
+    return []
+
+
+def _leased(img_jobs: Iterable[ImageJob]) -> Q:
+    # the claim the jobs were loaded with, a job reclaimed and claimed again has another attempt
+    return reduce(
+        or_,
+        (Q(id=img_job.id, status=ImageJob.STATUS_PENDING, attempts=img_job.attempts) for img_job in img_jobs),
+        Q(pk__in=[]),
+    )
+
+
+def lock_leased(img_jobs: List[ImageJob]) -> List[ImageJob]:
+    # the jobs whose claim is still held, locked until the end of the transaction finishing them
+    leased = set(ImageJob.objects.select_for_update().filter(_leased(img_jobs)).values_list("id", flat=True))
+    return [img_job for img_job in img_jobs if img_job.id in leased]
+
+
+def finish_image_jobs(img_jobs: List[ImageJob], status: str, **fields) -> List[ImageJob]:
+    # a single conditional update, jobs whose lease was reclaimed meanwhile are left alone
+    if not img_jobs:
+        return []
+    with transaction.atomic():
+        leased = lock_leased(img_jobs)
+        ImageJob.objects.filter(id__in=[img_job.id for img_job in leased]).update(
+            status=status, lease_expires_at=None, **fields
+        )
+        events.job_status_changed(status, ((img_job.user_plan_id, img_job.id) for img_job in leased))
+    return leased
+
+
+def requeue_expired_leases() -> Tuple[int, int]:
+    # jobs of workers that died (oom kills, lost nodes) go back to new after a backoff, or fail for good
+    now = timezone.now()
+    requeued = failed = 0
+    while True:
+        with transaction.atomic():
+            expired = list(
+                ImageJob.objects.select_for_update(skip_locked=True)
+                .filter(status=ImageJob.STATUS_PENDING, lease_expires_at__lt=now)
+                .values_list("id", "user_plan_id", "attempts")[: settings.IMAGE_JOB_REAPER_BATCH_SIZE]
+            )
+            if not expired:
+                return requeued, failed
+            retries: Dict[int, List[Tuple[int, int]]] = defaultdict(list)
+            given_up = []
+            for img_job_id, user_plan_id, attempts in expired:
+                if attempts < settings.IMAGE_JOB_MAX_ATTEMPTS:
+                    retries[attempts].append((user_plan_id, img_job_id))
+                else:
+                    given_up.append((user_plan_id, img_job_id))
+            for attempts, jobs in retries.items():
+                backoff = settings.IMAGE_JOB_RETRY_BACKOFF * 2 ** (attempts - 1)
+                ImageJob.objects.filter(id__in=[img_job_id for _, img_job_id in jobs]).update(
+                    status=ImageJob.STATUS_NEW, lease_expires_at=now + timedelta(seconds=backoff)
+                )
+                events.job_status_changed(ImageJob.STATUS_NEW, jobs)
+                requeued += len(jobs)
+            ImageJob.objects.filter(id__in=[img_job_id for _, img_job_id in given_up]).update(
+                status=ImageJob.STATUS_ERROR, lease_expires_at=None
+            )
+            events.job_status_changed(ImageJob.STATUS_ERROR, given_up)
+            failed += len(given_up)
+
+
+def release_due_retries() -> List[int]:
+    # requeued jobs whose backoff is over become claimable again, the caller dispatches them
+    now = timezone.now()
+    released: List[int] = []
+    while True:
+        with transaction.atomic():
+            due = list(
+                ImageJob.objects.select_for_update(skip_locked=True)
+                .filter(status=ImageJob.STATUS_NEW, lease_expires_at__lte=now)
+                .values_list("id", flat=True)[: settings.IMAGE_JOB_REAPER_BATCH_SIZE]
+            )
+            if not due:
+                return released
+            ImageJob.objects.filter(id__in=due).update(lease_expires_at=None)
+        released.extend(due)
+
+
+def image_job_queues() -> List[str]:
+    queues = set(Plan.objects.values_list("queue", flat=True))
+    queues.add(settings.IMAGE_JOB_HEAVY_QUEUE)
+    return sorted(queues)
+
+
+def queue_stats() -> List[Dict]:
+    now = timezone.now()
+    wait = ExpressionWrapper(F("started_at") - F("created_at"), output_field=DurationField())
+    waiting = {
+        row["queue"]: row
+        for row in ImageJob.objects.filter(status=ImageJob.STATUS_NEW)
+        .values("queue")
+        .annotate(depth=Count("id"), users=Count("user_plan", distinct=True), oldest=Min("created_at"))
+    }
+    started = {
+        row["queue"]: row
+        for row in ImageJob.objects.filter(started_at__gte=now - timedelta(seconds=settings.IMAGE_JOB_METRICS_WINDOW))
+        .values("queue")
+        .annotate(started=Count("id"), avg_wait=Avg(wait), max_wait=Max(wait))
+    }
+    stats = []
+    for queue in sorted(set(image_job_queues()) | set(waiting) | set(started)):
+        waiting_row = waiting.get(queue, {})
+        started_row = started.get(queue, {})
+        stats.append(
+            {
+                "queue": queue,
+                "depth": waiting_row.get("depth", 0),
+                "users": waiting_row.get("users", 0),
+                "oldest_wait_s": (now - waiting_row["oldest"]).total_seconds() if waiting_row else 0.0,
+                "started": started_row.get("started", 0),
+                "avg_wait_s": started_row["avg_wait"].total_seconds() if started_row.get("avg_wait") else 0.0,
+                "max_wait_s": started_row["max_wait"].total_seconds() if started_row.get("max_wait") else 0.0,
+            }
+        )
+    return stats
@@ -1,8 +1,11 @@
-import os
 from datetime import datetime
-from typing import Optional
+from typing import Dict, List, Optional
 
+from django.conf import settings
 from django.contrib.auth.base_user import AbstractBaseUser
+from django.core.files import File
+from django.core.validators import FileExtensionValidator
+from django.db import transaction
 from django.http import HttpRequest
 from django.urls import reverse
 from django.utils import timezone
@@ -11,7 +14,51 @@ from django.utils.translation import gettext_lazy as _
 from rest_framework import serializers
 from rest_framework.utils.serializer_helpers import ReturnDict
 
-from core.models import ImageJob, Thumbnail, UserPlan
+from core import quotas
+from core.files import file_digest
+from core.links import sign_external_link
+from core.models import ImageJob, ImageJobBatch, Thumbnail
+from core.plans import PlanConfig, UserPlanConfig, get_user_plan_config
+from core.scheduling import image_job_queue
+
+
+def _deduplicated_original(original_image: File) -> Dict:
+    # must run in a transaction: the lock keeps the reused original from being dropped meanwhile
+    digest = file_digest(original_image)
+    existing = (
+        ImageJob.objects.select_for_update()
+        .filter(original_digest=digest, original_image__isnull=False)
+        .exclude(original_image="")
+        .only("original_image")
+        .first()
+    )
+    return {"original_digest": digest, "original_image": existing.original_image.name if existing else original_image}
+
+
+def _validate_original_pixels(original_image: File) -> None:
+    # the image field's validation parsed the header only, the pixels aren't decoded at upload time
+    img = original_image.image  # type: ignore
+    if img.width * img.height > settings.IMAGE_JOB_MAX_PIXELS:
+        raise serializers.ValidationError(
+            _("Image is %(width)dx%(height)d, at most %(megapixels)d megapixels are allowed")
+            % {"width": img.width, "height": img.height, "megapixels": settings.IMAGE_JOB_MAX_PIXELS // 1_000_000}
+        )
+
+
+def _megapixels(original_image: File) -> float:
+    img = original_image.image  # type: ignore
+    return img.width * img.height / 1_000_000
+
+
+def _original_header(plan: PlanConfig, original_image: File) -> Dict:
+    img = original_image.image  # type: ignore
+    return {
+        "original_width": img.width,
+        "original_height": img.height,
+        "original_format": img.format,
+        "original_mode": img.mode,
+        "queue": image_job_queue(plan, original_image.size or 0, img.width * img.height),
+    }
 
 
 class NewImageJobSerializer(serializers.ModelSerializer):
@@ -23,7 +70,7 @@ class NewImageJobSerializer(serializers.ModelSerializer):
     def __init__(self, user: AbstractBaseUser, instance=None, *args, **kwargs) -> None:
         super().__init__(instance, *args, **kwargs)
         self._user = user
-        self._user_plan = None
+        self._user_plan: Optional[UserPlanConfig] = None
         if self.instance:
             self.fields.pop("link_expires_in")
 
@@ -33,14 +80,86 @@ class NewImageJobSerializer(serializers.ModelSerializer):
         data.pop("original_image")
         return data
 
+    def validate_original_image(self, value: File) -> File:
+        _validate_original_pixels(value)
+        return value
+
     def validate(self, data):
-        self._user_plan = UserPlan.objects.select_related("plan").filter(user=self._user).first()
+        self._user_plan = get_user_plan_config(self._user.pk)
         if self._user_plan is None:
             raise serializers.ValidationError(_("User plan required"))
         return data
 
     def create(self, validated_data) -> ImageJob:
-        return ImageJob.objects.create(user_plan=self._user_plan, **validated_data)  # type: ignore
+        original_image = validated_data["original_image"]
+        # before the original is stored
+        admissions = quotas.admit(self._user_plan, 1, _megapixels(original_image))  # type: ignore
+        try:
+            with transaction.atomic():
+                validated_data.update(_original_header(self._user_plan.plan, original_image))  # type: ignore
+                validated_data.update(_deduplicated_original(original_image))
+                return ImageJob.objects.create(
+                    user_plan_id=self._user_plan.id,  # type: ignore
+                    admission=admissions[0] if admissions else "",
+                    **validated_data,
+                )
+        except Exception:
+            quotas.withdraw(self._user_plan.id, admissions)  # type: ignore
+            raise
+
+
+class NewImageJobBatchSerializer(serializers.Serializer):
+    original_images = serializers.ListField(
+        child=serializers.ImageField(
+            validators=[FileExtensionValidator(["png", "jpeg", "jpg"]), _validate_original_pixels]
+        ),
+        allow_empty=False,
+        max_length=settings.IMAGE_JOB_BATCH_MAX_FILES,
+        write_only=True,
+    )
+    link_expires_in = serializers.IntegerField(
+        required=False, allow_null=True, min_value=300, max_value=30000, write_only=True
+    )
+    id = serializers.IntegerField(read_only=True)
+    jobs = serializers.SerializerMethodField("get_jobs")
+
+    def __init__(self, user: AbstractBaseUser, instance=None, *args, **kwargs) -> None:
+        super().__init__(instance, *args, **kwargs)
+        self._user = user
+        self._user_plan: Optional[UserPlanConfig] = None
+        self._jobs: List[ImageJob] = []
+
+    def validate(self, data):
+        self._user_plan = get_user_plan_config(self._user.pk)
+        if self._user_plan is None:
+            raise serializers.ValidationError(_("User plan required"))
+        return data
+
+    def create(self, validated_data) -> ImageJobBatch:
+        original_images = validated_data["original_images"]
+        megapixels = sum(_megapixels(original_image) for original_image in original_images)
+        admissions = quotas.admit(self._user_plan, len(original_images), megapixels)  # type: ignore
+        try:
+            with transaction.atomic():
+                batch = ImageJobBatch.objects.create(user_plan_id=self._user_plan.id)  # type: ignore
+                self._jobs = ImageJob.objects.bulk_create(
+                    ImageJob(
+                        user_plan_id=self._user_plan.id,  # type: ignore
+                        batch=batch,
+                        link_expires_in=validated_data.get("link_expires_in"),
+                        admission=admissions[n] if admissions else "",
+                        **_original_header(self._user_plan.plan, original_image),  # type: ignore
+                        **_deduplicated_original(original_image),
+                    )
+                    for n, original_image in enumerate(original_images)
+                )
+        except Exception:
+            quotas.withdraw(self._user_plan.id, admissions)  # type: ignore
+            raise
+        return batch
+
+    def get_jobs(self, obj: ImageJobBatch) -> List[int]:
+        return [job.id for job in self._jobs]
 
 
 class ThumbnailSerializer(serializers.ModelSerializer):
@@ -54,12 +173,18 @@ class ThumbnailSerializer(serializers.ModelSerializer):
 
     def get_image_url(self, obj: Thumbnail) -> str:
         request: HttpRequest = self.context["request"]
+        if obj.lazy:
+            return request.build_absolute_uri(reverse("thumbnail", args=[obj.id]))
         return request.build_absolute_uri(obj.image.url)
 
     def get_external_url(self, obj: Thumbnail) -> Optional[str]:
         if obj.external_id and obj.external_id_expires_at and obj.external_id_expires_at > timezone.now():
-            ext = os.path.splitext(obj.image.name)[-1][1:]  # without dot
-            path = reverse("ext_image", args=[obj.external_id, ext])
+            ext = obj.ext[1:]  # without dot
+            if obj.lazy:
+                # not rendered yet or evictable, resolved through the db
+                path = reverse("ext_image", args=[obj.external_id, ext])
+            else:
+                path = reverse("ext_image_signed", args=[sign_external_link(obj), ext])
             request: HttpRequest = self.context["request"]
             return request.build_absolute_uri(path)
         return None
@@ -74,3 +199,15 @@ class ImageJobSerializer(serializers.ModelSerializer):
     class Meta:
         fields = ["id", "thumbnails", "status", "original_image"]
         model = ImageJob
+
+
+class ImageJobBatchSerializer(serializers.ModelSerializer):
+    jobs = ImageJobSerializer(many=True, read_only=True)
+    done = serializers.SerializerMethodField("get_done")
+
+    class Meta:
+        fields = ["id", "created_at", "done", "jobs"]
+        model = ImageJobBatch
+
+    def get_done(self, obj: ImageJobBatch) -> bool:
+        return all(job.status in (ImageJob.STATUS_DONE, ImageJob.STATUS_ERROR) for job in obj.jobs.all())
@@ -0,0 +1,16 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from core import plans
+from core.models import EncoderProfile, Plan, ThumbnailSize, UserPlan
+
+
+@receiver([post_save, post_delete], sender=EncoderProfile)
+@receiver([post_save, post_delete], sender=Plan)
+@receiver([post_save, post_delete], sender=ThumbnailSize)
+@receiver([post_save, post_delete], sender=UserPlan)
+def invalidate_plan_configs(sender, **kwargs) -> None:
+    plans.clear_local()
+    # other processes must not reload the old configuration before the change is committed
+    transaction.on_commit(plans.invalidate)
@@ -0,0 +1,135 @@
+import mimetypes
+import posixpath
+from datetime import datetime
+from functools import lru_cache
+from tempfile import SpooledTemporaryFile
+from typing import List, Optional, Tuple
+from urllib.parse import quote
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.utils.deconstruct import deconstructible
+
+import boto3
+from boto3.s3.transfer import TransferConfig
+from botocore.client import BaseClient, Config
+from botocore.exceptions import ClientError
+
+
+@lru_cache(maxsize=None)
+def _client(endpoint_url: Optional[str], region_name: Optional[str], max_pool_connections: int) -> BaseClient:
+    # clients are thread safe: one per process, the rendering threads share its connection pool
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        region_name=region_name,
+        config=Config(
+            max_pool_connections=max_pool_connections,
+            signature_version="s3v4",
+            # minio and other stand-ins don't resolve bucket subdomains
+            s3={"addressing_style": "path" if endpoint_url else "auto"},
+            retries={"mode": "standard"},
+        ),
+    )
+
+
+def _not_found(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound")
+
+
+@deconstructible
+class S3MediaStorage(Storage):
+    # media in an S3 compatible bucket, shared by every api and worker host
+    remote = True
+
+    def __init__(
+        self,
+        bucket_name: Optional[str] = None,
+        endpoint_url: Optional[str] = None,
+        region_name: Optional[str] = None,
+        custom_domain: Optional[str] = None,
+        url_expire: Optional[int] = None,
+    ) -> None:
+        self.bucket_name = bucket_name or settings.MEDIA_S3_BUCKET
+        self.endpoint_url = endpoint_url or settings.MEDIA_S3_ENDPOINT_URL
+        self.region_name = region_name or settings.MEDIA_S3_REGION
+        self.custom_domain = custom_domain or settings.MEDIA_S3_CUSTOM_DOMAIN
+        self.url_expire = url_expire or settings.MEDIA_S3_URL_EXPIRE
+        self.transfer_config = TransferConfig(
+            multipart_threshold=settings.MEDIA_S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=settings.MEDIA_S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=settings.MEDIA_S3_MAX_CONCURRENCY,
+        )
+
+    @property
+    def client(self) -> BaseClient:
+        return _client(self.endpoint_url, self.region_name, settings.MEDIA_S3_MAX_POOL_CONNECTIONS)
+
+    def _open(self, name: str, mode: str = "rb") -> File:
+        if "w" in mode:
+            raise ValueError("media files are written with save()")
+        # decoders seek, the object is downloaded (in ranged parts when large) into a spooled file
+        f = SpooledTemporaryFile(max_size=settings.THUMBNAIL_SPOOL_MAX_SIZE)
+        try:
+            self.client.download_fileobj(self.bucket_name, name, f, Config=self.transfer_config)
+        except ClientError as e:
+            f.close()
+            if _not_found(e):
+                raise FileNotFoundError(name) from e
+            raise
+        f.seek(0)
+        return File(f, name=name)
+
+    def _save(self, name: str, content: File) -> str:
+        # streamed from the upload's file, multipart above MEDIA_S3_MULTIPART_THRESHOLD
+        content.seek(0)
+        self.client.upload_fileobj(
+            content,
+            self.bucket_name,
+            name,
+            ExtraArgs={"ContentType": mimetypes.guess_type(name)[0] or "application/octet-stream"},
+            Config=self.transfer_config,
+        )
+        return name
+
+    def _head(self, name: str) -> dict:
+        try:
+            return self.client.head_object(Bucket=self.bucket_name, Key=name)
+        except ClientError as e:
+            if _not_found(e):
+                raise FileNotFoundError(name) from e
+            raise
+
+    def delete(self, name: str) -> None:
+        self.client.delete_object(Bucket=self.bucket_name, Key=name)
+
+    def exists(self, name: str) -> bool:
+        try:
+            self._head(name)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def listdir(self, path: str) -> Tuple[List[str], List[str]]:
+        prefix = posixpath.join(path, "") if path else ""
+        directories, files = [], []
+        paginator = self.client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=prefix, Delimiter="/"):
+            directories.extend(entry["Prefix"][len(prefix) :].rstrip("/") for entry in page.get("CommonPrefixes", []))
+            files.extend(entry["Key"][len(prefix) :] for entry in page.get("Contents", []))
+        return directories, files
+
+    def size(self, name: str) -> int:
+        return self._head(name)["ContentLength"]
+
+    def get_modified_time(self, name: str) -> datetime:
+        return self._head(name)["LastModified"]
+
+    def url(self, name: str) -> str:
+        # computed locally, the store isn't contacted
+        if self.custom_domain:
+            return f"https://{self.custom_domain}/{quote(name)}"
+        return self.client.generate_presigned_url(
+            "get_object", Params={"Bucket": self.bucket_name, "Key": name}, ExpiresIn=self.url_expire
+        )
@@ -1,22 +1,66 @@
+import hashlib
 import logging
-import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import replace
 from datetime import timedelta
-from io import BytesIO
 from os import path
-from typing import List, Tuple
+from tempfile import SpooledTemporaryFile
+from typing import Callable, Dict, List, Optional, Tuple
 from uuid import uuid4
 
-from django.core.files.uploadedfile import InMemoryUploadedFile
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
 from django.db import transaction
+from django.db.models import Sum
 from django.utils import timezone
 
-from celery import shared_task
+from celery import group, shared_task
 from PIL import Image
 
-from core.models import ImageJob, Thumbnail, ThumbnailSize
+from core import events, joblist, metrics, quotas
+from core.backfill import backfillable_jobs, missing_heights
+from core.encoding import EncoderConfig, encode, output_name
+from core.files import delete_unreferenced
+from core.imaging import (
+    build_pyramid,
+    open_image,
+    resize_from_pyramid,
+    resize_to_height,
+)
+from core.models import ImageJob, Thumbnail
+from core.plans import PlanConfig, get_user_plan_config_by_id
+from core.retention import (
+    drop_originals,
+    purge_expired_links,
+    purge_failed_jobs,
+    reconcile_media,
+)
+from core.scheduling import (
+    claim_image_job,
+    claim_new_image_jobs,
+    finish_image_jobs,
+    lock_leased,
+    release_due_retries,
+    requeue_expired_leases,
+)
+from core.variants import (
+    delete_variants,
+    save_variant,
+    variant_exists,
+    variant_formats,
+    variant_name,
+)
 
 logger = logging.getLogger(__name__)
 
+MICRO_BATCH_SCHEDULED_KEY = "image-jobs:micro-batch-scheduled"
+LAZY_THUMBNAIL_BYTES_KEY = "lazy-thumbnails:bytes"
+# held while a thumbnail or variant is rendered on request, by its file name
+RENDER_LOCK_KEY = "render-lock:{digest}"
+
 SUPPORTED_IMG_FORMATS = {".jpg": "JPEG", ".jpeg": "JPEG", ".png": "PNG"}
 
 SUPPORTED_IMG_CONTENT_TYPES = {
@@ -26,31 +70,64 @@ SUPPORTED_IMG_CONTENT_TYPES = {
 }
 
 
-def _img_to_dj_mem_file(img: Image.Image, name: str) -> InMemoryUploadedFile:
-    ext = path.splitext(name)[-1]
-    output = BytesIO()
-    img.save(output, SUPPORTED_IMG_FORMATS[ext])
-    return InMemoryUploadedFile(
-        file=output,
-        field_name="ImageField",
-        name=name,
-        content_type=SUPPORTED_IMG_CONTENT_TYPES[ext],
-        size=sys.getsizeof(output),
-        charset=None,
-    )
+def _thumbnail_name(original_name: str, height: int) -> str:
+    img_name, ext = path.splitext(path.basename(original_name))
+    return f"{img_name}_thumb_{height}{ext}"
+
+
+def _save_thumbnail_image(
+    thumbnail: Thumbnail, img: Image.Image, name: str, encoder: Optional[EncoderConfig] = None
+) -> None:
+    # small thumbnails are encoded in memory, large ones spill to disk;
+    # either way the buffer is released as soon as the storage has it
+    name = output_name(img, name, encoder)
+    with SpooledTemporaryFile(max_size=settings.THUMBNAIL_SPOOL_MAX_SIZE) as output:
+        with metrics.stage("encode"):
+            encode(img, output, SUPPORTED_IMG_FORMATS[path.splitext(name)[-1]], encoder)
+        content = File(output, name=name)
+        content.size = thumbnail.file_size = output.tell()
+        output.seek(0)
+        with metrics.stage("write"):
+            thumbnail.image.save(name, content, save=False)
+    if settings.THUMBNAIL_VARIANTS_EAGER:
+        quality = encoder.variant_quality if encoder else settings.THUMBNAIL_VARIANT_QUALITY
+        with metrics.stage("variants"):
+            for ext in variant_formats():
+                save_variant(thumbnail.image.storage, img, thumbnail.image.name, ext, quality, replace=True)
+
+
+def _delete_thumbnail_images(thumbnails: List[Thumbnail]) -> None:
+    for thumbnail in thumbnails:
+        if thumbnail.image:
+            name = thumbnail.image.name
+            if delete_unreferenced(thumbnail.image):
+                delete_variants(thumbnail.image.storage, name)
 
 
-def _resized_width(size: Tuple[int, int], h: int) -> int:
-    h_percent = h / size[1]
-    return round(size[0] * h_percent)
+def _reusable_thumbnails(
+    img_job: ImageJob, plan: PlanConfig, heights: List[int]
+) -> Dict[int, Tuple[str, Optional[int]]]:
+    if not img_job.original_digest:
+        return {}
+    # only the same plan's thumbnails were encoded with the same profiles
+    return {
+        height: (name, file_size)
+        for height, name, file_size in Thumbnail.objects.filter(
+            image_job__original_digest=img_job.original_digest,
+            image_job__user_plan__plan_id=plan.id,
+            height__in=heights,
+            lazy=False,
+        )
+        .exclude(image="")
+        .values_list("height", "image", "file_size")
+    }
 
 
-def _process_thumbnails(img_job: ImageJob) -> List[Thumbnail]:
-    plan = img_job.user_plan.plan
+def _process_thumbnails(img_job: ImageJob, plan: PlanConfig) -> List[Thumbnail]:
+    heights = list(plan.heights)
+    if not heights:
+        return []
 
-    # thumbnails
-    img = Image.open(img_job.original_image)
-    thumbnails = []
     external_linking_enabled = plan.expiring_link and img_job.link_expires_in
     expires_at = (
         (timezone.now() + timedelta(seconds=img_job.link_expires_in))
@@ -58,42 +135,321 @@ def _process_thumbnails(img_job: ImageJob) -> List[Thumbnail]:
         else None
     )
 
-    for thumbnail_size in ThumbnailSize.objects.filter(plan=plan).order_by("-height"):
-        size = (_resized_width(img.size, thumbnail_size.height), thumbnail_size.height)
-        img.thumbnail(size, Image.Resampling.LANCZOS)  # in place, that's why qset was sorted
-        img_name, ext = path.splitext(path.basename(img_job.original_image.path))
-        thumbnails.append(
-            Thumbnail(
-                height=thumbnail_size.height,
-                image=_img_to_dj_mem_file(img, f"{img_name}_thumb_{thumbnail_size.height}{ext}"),
-                external_id=uuid4() if external_linking_enabled else None,
-                external_id_expires_at=expires_at,
-            )
+    def new_thumbnail(height: int) -> Thumbnail:
+        return Thumbnail(
+            image_job=img_job,
+            height=height,
+            external_id=uuid4() if external_linking_enabled else None,
+            external_id_expires_at=expires_at,
+            lazy=plan.lazy_thumbnails,
         )
 
-    for thumbnail in thumbnails:
-        thumbnail.image_job = img_job
+    if plan.lazy_thumbnails:
+        return [new_thumbnail(height) for height in heights]  # rendered on first request
 
-    return thumbnails
+    # an identical original was processed before, its thumbnail files are shared
+    reused = []
+    for height, (name, file_size) in _reusable_thumbnails(img_job, plan, heights).items():
+        thumbnail = new_thumbnail(height)
+        thumbnail.image, thumbnail.file_size = name, file_size
+        reused.append(thumbnail)
+    heights = [height for height in heights if height not in {thumbnail.height for thumbnail in reused}]
+    if not heights:
+        return reused
+
+    # thumbnails: decode once, then every size is resampled from the nearest pyramid level
+    with metrics.stage("decode"):
+        img = open_image(img_job.original_image, max_height=heights[0], memory_budget=settings.THUMBNAIL_DECODE_BUDGET)
+    with metrics.stage("resize"):
+        levels = build_pyramid(img, min_height=heights[-1])
+
+    def render(height: int) -> Thumbnail:
+        thumbnail = new_thumbnail(height)
+        with metrics.stage("resize"):
+            resized = resize_from_pyramid(levels, height)
+        _save_thumbnail_image(
+            thumbnail,
+            resized,
+            _thumbnail_name(img_job.original_image.name, height),
+            plan.encoder(height),
+        )
+        return thumbnail
+
+    # Pillow releases the GIL while resampling and encoding, so sizes render in parallel
+    with ThreadPoolExecutor(max_workers=min(len(heights), settings.THUMBNAIL_THREADS)) as executor:
+        futures = [executor.submit(render, height) for height in heights]
+    rendered = [future.result() for future in futures if future.exception() is None]
+    errors = [future.exception() for future in futures if future.exception() is not None]
+    if errors:
+        _delete_thumbnail_images(rendered)  # don't leave files of a failed job behind
+        raise errors[0]  # type: ignore
+    return reused + rendered
+
+
+def lazy_thumbnail_bytes() -> int:
+    # the rendered lazy thumbnails' total size, counted again only when the shared counter is missing
+    return Thumbnail.objects.filter(lazy=True).exclude(image="").aggregate(total=Sum("file_size"))["total"] or 0
+
+
+def _add_lazy_thumbnail_bytes(size: int) -> int:
+    try:
+        return cache.incr(LAZY_THUMBNAIL_BYTES_KEY, size)
+    except ValueError:
+        total = lazy_thumbnail_bytes()
+        cache.set(LAZY_THUMBNAIL_BYTES_KEY, total, timeout=None)
+        return total
+
+
+def _evict_lazy_thumbnails(keep: Thumbnail, total: int) -> None:
+    if total <= settings.LAZY_THUMBNAIL_CACHE_BYTES:
+        return
+    evictable = Thumbnail.objects.filter(lazy=True).exclude(image="").exclude(id=keep.id).order_by("last_accessed_at")
+    for thumbnail in evictable.only("id", "image", "file_size", "last_accessed_at"):
+        # skipped when it was accessed in the meantime
+        evicted = Thumbnail.objects.filter(id=thumbnail.id, last_accessed_at=thumbnail.last_accessed_at).update(
+            image="", file_size=None
+        )
+        if evicted:
+            delete_variants(thumbnail.image.storage, thumbnail.image.name)
+            thumbnail.image.delete(save=False)
+            total = _add_lazy_thumbnail_bytes(-(thumbnail.file_size or 0))
+        if total <= settings.LAZY_THUMBNAIL_CACHE_BYTES:
+            break
+
+
+def _render_lock(name: str, rendered: Callable[[], bool]) -> Optional[str]:
+    # the shared cache's lock on rendering the file, so concurrent first requests of every process coalesce
+    # onto one render; None once another request rendered it meanwhile. a lock whose holder died expires
+    lock = RENDER_LOCK_KEY.format(digest=hashlib.sha256(name.encode()).hexdigest())
+    while not cache.add(lock, True, timeout=settings.RENDER_LOCK_TIMEOUT):
+        time.sleep(settings.RENDER_LOCK_POLL_INTERVAL)
+        if rendered():
+            return None
+    return lock
+
+
+def materialize_thumbnail(thumbnail: Thumbnail) -> Thumbnail:
+    now = timezone.now()
+    if thumbnail.image:
+        touch_before = now - timedelta(seconds=settings.LAZY_THUMBNAIL_TOUCH_INTERVAL)
+        if thumbnail.lazy and (thumbnail.last_accessed_at is None or thumbnail.last_accessed_at < touch_before):
+            Thumbnail.objects.filter(id=thumbnail.id).update(last_accessed_at=now)
+        return thumbnail
+
+    # rendering holds no transaction, the row is only claimed once the file is written
+    lock = _render_lock(f"thumbnail:{thumbnail.id}", Thumbnail.objects.filter(id=thumbnail.id).exclude(image="").exists)
+    if lock is None:
+        return Thumbnail.objects.select_related("image_job").get(id=thumbnail.id)
+    try:
+        thumbnail = Thumbnail.objects.select_related("image_job").get(id=thumbnail.id)
+        if thumbnail.image:
+            return thumbnail
+        original = thumbnail.image_job.original_image
+        encoder = get_user_plan_config_by_id(thumbnail.image_job.user_plan_id).plan.encoder(thumbnail.height)
+        if encoder:
+            # the url was handed out with the original's extension before rendering
+            encoder = replace(encoder, opaque_png_to_jpeg=False)
+        img = open_image(original, max_height=thumbnail.height, memory_budget=settings.THUMBNAIL_DECODE_BUDGET)
+        _save_thumbnail_image(
+            thumbnail,
+            resize_to_height(img, thumbnail.height),
+            _thumbnail_name(original.name, thumbnail.height),
+            encoder,
+        )
+        thumbnail.last_accessed_at = now
+        claimed = 0
+        try:
+            # conditional: the lock may have expired during a slow render
+            claimed = Thumbnail.objects.filter(id=thumbnail.id, image="").update(
+                image=thumbnail.image.name, file_size=thumbnail.file_size, last_accessed_at=now
+            )
+        finally:
+            if not claimed:
+                # another process rendered it meanwhile, or the write failed
+                delete_variants(thumbnail.image.storage, thumbnail.image.name)
+                thumbnail.image.delete(save=False)
+        if not claimed:
+            return Thumbnail.objects.select_related("image_job").get(id=thumbnail.id)
+    finally:
+        cache.delete(lock)
+    _evict_lazy_thumbnails(keep=thumbnail, total=_add_lazy_thumbnail_bytes(thumbnail.file_size or 0))
+    return thumbnail
+
+
+@shared_task
+def recount_lazy_thumbnails() -> int:
+    # corrects the running total for lazy thumbnails deleted along with their jobs
+    total = lazy_thumbnail_bytes()
+    cache.set(LAZY_THUMBNAIL_BYTES_KEY, total, timeout=None)
+    return total
+
+
+def materialize_variant(name: str, ext: str) -> str:
+    # variants rendered lazily, or missing because the thumbnail predates them, are converted from the thumbnail
+    storage = Thumbnail._meta.get_field("image").storage
+    variant = variant_name(name, ext)
+    if variant_exists(storage, name, ext):
+        return variant
+    lock = _render_lock(variant, lambda: variant_exists(storage, name, ext))
+    if lock is None:
+        return variant
+    try:
+        if not storage.exists(variant):
+            try:
+                with storage.open(name) as f:
+                    img = Image.open(f)
+                    img.load()
+            except OSError:
+                return name  # not found either
+            save_variant(storage, img, name, ext, settings.THUMBNAIL_VARIANT_QUALITY)
+    finally:
+        cache.delete(lock)
+    return variant
 
 
 @shared_task
 def process_image_job(img_job_id: int) -> None:
-    img_job = ImageJob.objects.select_related("user_plan__plan").get(id=img_job_id)
-    if img_job.status == ImageJob.STATUS_PENDING:
-        raise Exception("re-pending job isn't allowed")
-    img_job.status = ImageJob.STATUS_PENDING
-    img_job.save()
+    # duplicate deliveries are dropped, only the one claiming the job processes it
+    if claim_image_job(img_job_id):
+        _process_image_job_batch([img_job_id])
+
+
+def _process_image_job_batch(img_job_ids: List[int]) -> None:
+    img_jobs = list(ImageJob.objects.filter(id__in=img_job_ids, status=ImageJob.STATUS_PENDING))
+    plans = {img_job.id: get_user_plan_config_by_id(img_job.user_plan_id).plan for img_job in img_jobs}
+
+    # images back to back, each failure only affects its own job
+    thumbnails: Dict[int, List[Thumbnail]] = {}
+    failed: List[ImageJob] = []
+    for img_job in img_jobs:
+        try:
+            with metrics.stage("thumbnails"):
+                thumbnails[img_job.id] = _process_thumbnails(img_job, plans[img_job.id])
+            metrics.observe_job(img_job, sum(thumbnail.file_size or 0 for thumbnail in thumbnails[img_job.id]))
+        except Exception as e:
+            logger.error(e)
+            failed.append(img_job)
+
+    # per job a single conditional update, along with the thumbnails and dropping the original
+    done = [img_job for img_job in img_jobs if img_job.id in thumbnails]
+    leased: List[ImageJob] = []
     try:
-        thumbnails = _process_thumbnails(img_job)
-        with transaction.atomic():
-            Thumbnail.objects.bulk_create(thumbnails)
-            if not img_job.user_plan.plan.keeping_original_image:
-                img_job.original_image.delete(save=True)
-                img_job.original_image = None
-            img_job.status = ImageJob.STATUS_DONE
-            img_job.save()
+        with metrics.stage("commit"), transaction.atomic():
+            leased = lock_leased(done)
+            Thumbnail.objects.bulk_create(thumbnail for img_job in leased for thumbnail in thumbnails[img_job.id])
+            done_fields = {"status": ImageJob.STATUS_DONE, "lease_expires_at": None}
+            drop_originals(
+                [img_job for img_job in leased if not plans[img_job.id].keeping_original_image], **done_fields
+            )
+            ImageJob.objects.filter(
+                id__in=[img_job.id for img_job in leased if plans[img_job.id].keeping_original_image]
+            ).update(**done_fields)
+            events.job_status_changed(ImageJob.STATUS_DONE, [(img_job.user_plan_id, img_job.id) for img_job in leased])
     except Exception as e:
         logger.error(e)
-        img_job.status = ImageJob.STATUS_ERROR
-        img_job.save()
+        leased = []
+        failed.extend(done)
+    # jobs reclaimed meanwhile are another worker's now
+    _delete_thumbnail_images(
+        [thumbnail for img_job in img_jobs if img_job not in leased for thumbnail in thumbnails.get(img_job.id, [])]
+    )
+    finish_image_jobs(failed, ImageJob.STATUS_ERROR)
+
+
+def _backfill_image_job(img_job: ImageJob, heights: List[int]) -> int:
+    plan = get_user_plan_config_by_id(img_job.user_plan_id).plan
+    thumbnails = _process_thumbnails(img_job, plan.only(heights))
+    duplicates: List[Thumbnail] = []
+    try:
+        with transaction.atomic():
+            # another run may have added some of the heights meanwhile
+            list(ImageJob.objects.select_for_update().filter(id=img_job.id).values("id"))
+            existing = set(img_job.thumbnails.values_list("height", flat=True))
+            duplicates = [thumbnail for thumbnail in thumbnails if thumbnail.height in existing]
+            thumbnails = [thumbnail for thumbnail in thumbnails if thumbnail.height not in existing]
+            Thumbnail.objects.bulk_create(thumbnails)
+            joblist.jobs_changed([img_job.user_plan_id])
+    except Exception:
+        _delete_thumbnail_images(thumbnails + duplicates)
+        raise
+    _delete_thumbnail_images(duplicates)
+    return len(thumbnails)
+
+
+@shared_task
+def backfill_image_jobs(img_job_ids: List[int]) -> int:
+    # renders the heights of the current plan jobs have no thumbnail of; idempotent, so chunks can be
+    # retried and runs resumed
+    img_jobs = backfillable_jobs().filter(id__in=img_job_ids)
+    missing = missing_heights(list(img_jobs.values_list("id", "user_plan_id")))
+    created = 0
+    for img_job in img_jobs.filter(id__in=missing):
+        try:
+            created += _backfill_image_job(img_job, missing[img_job.id])
+        except Exception as e:
+            logger.error(e)
+    return created
+
+
+@shared_task
+def process_next_image_job(queue: str) -> None:
+    # jobs aren't bound to tasks: every task takes the next job of its queue in fair order
+    if img_job_ids := claim_new_image_jobs(queue, 1):
+        _process_image_job_batch(img_job_ids)
+
+
+@shared_task
+def process_new_image_jobs(queue: str) -> None:
+    # cleared before pulling, so jobs committed from now on schedule another run
+    cache.delete(f"{MICRO_BATCH_SCHEDULED_KEY}:{queue}")
+    while img_job_ids := claim_new_image_jobs(queue, settings.IMAGE_JOB_MICRO_BATCH_SIZE):
+        _process_image_job_batch(img_job_ids)
+
+
+def dispatch_image_jobs(img_job_ids: List[int]) -> None:
+    # once the jobs are committed, a worker could miss them otherwise
+    transaction.on_commit(lambda: _dispatch_image_jobs(img_job_ids))
+
+
+def _dispatch_image_jobs(img_job_ids: List[int]) -> None:
+    queues = Counter(ImageJob.objects.filter(id__in=img_job_ids).values_list("queue", flat=True))
+    if settings.IMAGE_JOB_MICRO_BATCH_SIZE > 1:
+        # micro-batching: new jobs are pulled from the db by a single task run per queue, which is only
+        # scheduled when none is pending yet
+        for queue in queues:
+            timeout = settings.IMAGE_JOB_MICRO_BATCH_SCHEDULE_TIMEOUT
+            if cache.add(f"{MICRO_BATCH_SCHEDULED_KEY}:{queue}", True, timeout=timeout):
+                process_new_image_jobs.apply_async((queue,), queue=queue)
+        return
+    # one task per job on the job's queue, published as a single group over one broker connection
+    group(
+        process_next_image_job.si(queue).set(queue=queue) for queue, count in queues.items() for _ in range(count)
+    ).apply_async()
+
+
+@shared_task
+def sweep_expired_links() -> int:
+    return purge_expired_links()
+
+
+@shared_task
+def sweep_failed_jobs() -> int:
+    return purge_failed_jobs()
+
+
+@shared_task
+def reconcile_media_files() -> int:
+    return len(reconcile_media())
+
+
+@shared_task
+def prune_in_flight_jobs() -> int:
+    return quotas.prune_in_flight()
+
+
+@shared_task
+def reclaim_image_jobs() -> Tuple[int, int]:
+    requeued, failed = requeue_expired_leases()
+    if img_job_ids := release_due_retries():
+        dispatch_image_jobs(img_job_ids)
+    return requeued, failed
@@ -1,35 +1,83 @@
+import hashlib
+import json
 import os
+import struct
+import tempfile
+import time
+import tracemalloc
+import zlib
 from datetime import timedelta
-from urllib.parse import urlparse
+from io import BytesIO, StringIO
+from unittest import mock
 
 from django.conf import settings
 from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import transaction
 from django.db.models import F
-from django.test import TestCase, override_settings
+from django.test import SimpleTestCase, TestCase, override_settings
 from django.urls import reverse
+from django.utils import timezone
 
+import boto3
+import fakeredis
+import requests
+from asgiref.sync import async_to_sync
+from moto import mock_s3
 from parameterized import parameterized
 from PIL import Image
+from prometheus_client import REGISTRY
+from prometheus_client.parser import text_string_to_metric_families
+from rest_framework.utils.encoders import JSONEncoder
 
-from core.models import Plan, Thumbnail, UserPlan
+from core import benchmarks, imaging, links, plans, retention, tasks
+from core.encoding import EncoderConfig, encode
+from core.imaging import (
+    build_pyramid,
+    open_image,
+    resize_from_pyramid,
+    resize_to_height,
+)
+from core.links import revoke_external_link
+from core.models import (
+    EncoderProfile,
+    ImageJob,
+    Plan,
+    Thumbnail,
+    ThumbnailSize,
+    UserPlan,
+)
+from core.scheduling import claim_new_image_jobs, finish_image_jobs, queue_stats
+from core.serializers import ImageJobSerializer
+from core.variants import variant_name
 
-THUMBS_DIR = os.path.join(settings.BASE_DIR, "mediafiles", "thumbs")
+# under the test runner's temporary MEDIA_ROOT
+THUMBS_DIR = os.path.join(settings.MEDIA_ROOT, "thumbs")
 
 
-@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
-class TestImageJob(TestCase):
+class ImageJobTestMixin:
     img_path = os.path.join(settings.BASE_DIR, "testdata", "sample.jpg")
 
     def setUp(self):
+        plans.clear_local()  # rolled back rows send no signals
+        links.clear_local()
+        cache.clear()  # nor are the counters and cursors kept there
         self.user = User.objects.create_user("user1", "user1@example.com", "user1")
         self.client.login(username="user1", password="user1")
 
+    def _post(self, url, data):
+        # jobs are dispatched once the upload is committed
+        with self.captureOnCommitCallbacks(execute=True):
+            return self.client.post(url, data)
+
     def _post_image(self, filename, link_expires_in=None):
         with open(filename, "rb") as f:
             data = {"original_image": f}
             if link_expires_in:
                 data["link_expires_in"] = link_expires_in
-            return self.client.post(reverse("image-jobs"), data)
+            return self._post(reverse("image-jobs"), data)
 
     def _create_user_plan(self, user, plan_title):
         return UserPlan.objects.create(user=user, plan=Plan.objects.get(title=plan_title))
@@ -40,6 +88,9 @@ class TestImageJob(TestCase):
             img = Image.open(f)
             return img.height
 
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestImageJob(ImageJobTestMixin, TestCase):
     def test_required_auth(self):
         self.client.logout()
         # get
@@ -66,7 +117,7 @@ class TestImageJob(TestCase):
         User.objects.create_user("user2", "user2@example.com", "user2")
         self.client.login(username="user2", password="user2")
         response = self.client.get(reverse("image-jobs"))
-        job_results = response.json()
+        job_results = response.json()["results"]
         self.assertEquals(len(job_results), 0)
 
     @parameterized.expand(
@@ -83,7 +134,7 @@ class TestImageJob(TestCase):
         self.assertEquals(response.status_code, 201)
 
         response = self.client.get(reverse("image-jobs"))
-        job_result = response.json()[0]
+        job_result = response.json()["results"][0]
 
         thumbnail_sizes = [self._get_thumb_image_height(t["image_url"]) for t in job_result["thumbnails"]]
         self.assertEquals(sorted(thumbnail_sizes), expected_sizes)
@@ -102,7 +153,7 @@ class TestImageJob(TestCase):
         self.assertEquals(response.status_code, 201)
 
         response = self.client.get(reverse("image-jobs"))
-        job_result = response.json()[0]
+        job_result = response.json()["results"][0]
 
         self.assertEquals(bool(job_result["original_image"]), keeping)
 
@@ -119,7 +170,7 @@ class TestImageJob(TestCase):
         self.assertEquals(response.status_code, 201)
 
         response = self.client.get(reverse("image-jobs"))
-        job_result = response.json()[0]
+        job_result = response.json()["results"][0]
 
         self.assertIsNone(job_result["thumbnails"][0]["external_url"])
         self.assertIsNone(job_result["thumbnails"][0]["external_url_expires_at"])
@@ -134,22 +185,1179 @@ class TestImageJob(TestCase):
 
         # fetch job result
         response = self.client.get(reverse("image-jobs"))
-        job_result = response.json()[0]
+        job_result = response.json()["results"][0]
         self.assertIsNotNone(job_result["thumbnails"][0]["external_url"])
         self.assertIsNotNone(job_result["thumbnails"][0]["external_url_expires_at"])
 
-        # verify expected redirect
-        parsed_url = urlparse(job_result["thumbnails"][0]["image_url"])
-        response = self.client.get(job_result["thumbnails"][0]["external_url"], follow=True)
-        self.assertEquals([(parsed_url.path, 302)], response.redirect_chain)
+        # the thumbnail is served directly, without a redirect to the media url,
+        # and signed links resolve without any db query
+        with self.assertNumQueries(0):
+            response = self.client.get(job_result["thumbnails"][0]["external_url"])
+        self.assertEquals(response.status_code, 200)
+        with override_settings(DEBUG=True):
+            media_response = self.client.get(job_result["thumbnails"][0]["image_url"])
+        self.assertEquals(b"".join(response.streaming_content), b"".join(media_response.streaming_content))
+
+        # a tampered token is rejected
+        response = self.client.get(job_result["thumbnails"][0]["external_url"].replace(":", ":x", 1))
+        self.assertEquals(response.status_code, 404)
+
+        # the expiry is part of the signed token
+        later = timezone.now() + timedelta(seconds=link_expires_in + 1)
+        with mock.patch("core.links.timezone.now", return_value=later):
+            response = self.client.get(job_result["thumbnails"][0]["external_url"])
+        self.assertEquals(response.status_code, 404)
 
         # fake timeout to force the external url to expire
+        thumbnail = Thumbnail.objects.first()
+        legacy_url = reverse("ext_image", args=[thumbnail.external_id, "jpg"])
+        self.assertEquals(self.client.get(legacy_url).status_code, 200)
         Thumbnail.objects.update(
             external_id_expires_at=F("external_id_expires_at") - timedelta(seconds=link_expires_in)
         )
-        response = self.client.get(job_result["thumbnails"][0]["external_url"])
+        response = self.client.get(legacy_url)
         self.assertEquals(response.status_code, 404)
 
         # after timeout external url is removed
         response = self.client.get(reverse("image-jobs"))
-        self.assertIsNone(response.json()[0]["thumbnails"][0]["external_url"])
+        self.assertIsNone(response.json()["results"][0]["thumbnails"][0]["external_url"])
+
+    def test_revoked_external_link(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+        external_url = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]["external_url"]
+
+        self.assertEquals(self.client.get(external_url).status_code, 200)
+        for thumbnail in Thumbnail.objects.all():
+            revoke_external_link(thumbnail.external_id, thumbnail.external_id_expires_at)
+        self.assertEquals(self.client.get(external_url).status_code, 404)
+
+    def test_revocations_checked_periodically(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+        external_url = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]["external_url"]
+        self.assertEquals(self.client.get(external_url).status_code, 200)
+
+        # resolved from memory between checks
+        with mock.patch("core.links.caches") as caches:
+            self.assertEquals(self.client.get(external_url).status_code, 200)
+        caches.__getitem__.assert_not_called()
+
+        # revoked by another process: noticed at the next check
+        thumbnail = Thumbnail.objects.first()
+        revoke_external_link(thumbnail.external_id, thumbnail.external_id_expires_at)
+        links._revoked.clear()
+        self.assertEquals(self.client.get(external_url).status_code, 200)
+        later = time.monotonic() + settings.EXTERNAL_LINK_REVOCATION_CHECK_INTERVAL
+        with mock.patch("core.links.time.monotonic", return_value=later):
+            self.assertEquals(self.client.get(external_url).status_code, 404)
+
+        # and by a process started afterwards
+        links.clear_local()
+        self.assertEquals(self.client.get(external_url).status_code, 404)
+
+    def test_failed_job_leaves_no_thumbnail_files(self):
+        self._create_user_plan(self.user, "Premium")
+        os.makedirs(THUMBS_DIR, exist_ok=True)
+        thumbs_before = set(os.listdir(THUMBS_DIR))
+
+        def resize(levels, height):
+            if height == 200:
+                raise ValueError("resize failed")
+            return resize_from_pyramid(levels, height)
+
+        with mock.patch("core.tasks.resize_from_pyramid", side_effect=resize):
+            response = self._post_image(self.img_path)
+        self.assertEquals(response.status_code, 201)
+
+        response = self.client.get(reverse("image-jobs"))
+        self.assertEquals(response.json()["results"][0]["status"], "E")
+        self.assertEquals(set(os.listdir(THUMBS_DIR)), thumbs_before)
+
+    def test_batch_upload(self):
+        self._create_user_plan(self.user, "Premium")
+
+        with open(self.img_path, "rb") as f1, open(self.img_path, "rb") as f2, open(self.img_path, "rb") as f3:
+            response = self._post(reverse("image-job-batches"), {"original_images": [f1, f2, f3]})
+        self.assertEquals(response.status_code, 201)
+        batch = response.json()
+        self.assertEquals(len(batch["jobs"]), 3)
+
+        response = self.client.get(reverse("image-job-batch", args=[batch["id"]]))
+        self.assertEquals(response.status_code, 200)
+        batch_result = response.json()
+        self.assertTrue(batch_result["done"])
+        self.assertEquals(sorted(job["id"] for job in batch_result["jobs"]), sorted(batch["jobs"]))
+        self.assertTrue(all(len(job["thumbnails"]) == 2 for job in batch_result["jobs"]))
+
+    def test_batch_upload_required_user_plan(self):
+        with open(self.img_path, "rb") as f:
+            response = self._post(reverse("image-job-batches"), {"original_images": [f]})
+        self.assertEquals(response.status_code, 400)
+        self.assertEquals(response.json(), {"non_field_errors": ["User plan required"]})
+
+    @override_settings(IMAGE_JOB_MICRO_BATCH_SIZE=2)
+    def test_micro_batching(self):
+        self._create_user_plan(self.user, "Basic")
+        open_image_calls = []
+
+        def open_image(fp, **kwargs):
+            open_image_calls.append(fp)
+            if len(open_image_calls) == 2:
+                raise ValueError("decode failed")
+            return imaging.open_image(fp, **kwargs)
+
+        with mock.patch("core.tasks.open_image", side_effect=open_image):
+            with open(self.img_path, "rb") as f1, open(self.img_path, "rb") as f2, open(self.img_path, "rb") as f3:
+                response = self._post(reverse("image-job-batches"), {"original_images": [f1, f2, f3]})
+        self.assertEquals(response.status_code, 201)
+
+        # a single task run pulled all three jobs, the failing one did not affect the others
+        response = self.client.get(reverse("image-job-batch", args=[response.json()["id"]]))
+        jobs = sorted(response.json()["jobs"], key=lambda job: job["id"])
+        self.assertEquals([job["status"] for job in jobs], ["D", "E", "D"])
+        self.assertEquals([len(job["thumbnails"]) for job in jobs], [1, 0, 1])
+        self.assertEquals([job["original_image"] for job in jobs], [None, jobs[1]["original_image"], None])
+
+    @parameterized.expand([["P"], ["1"]])
+    def test_palette_and_bilevel_png(self, mode):
+        self._create_user_plan(self.user, "Premium")
+        with tempfile.NamedTemporaryFile(suffix=".png") as f:
+            # large enough to be reduced into the pyramid
+            img = benchmarks.synthetic_image(4)
+            (img.quantize(16) if mode == "P" else img.convert(mode)).save(f, "PNG")
+            f.flush()
+            self._post_image(f.name)
+        self.assertEquals(ImageJob.objects.get().status, ImageJob.STATUS_DONE)
+        self.assertEquals(sorted(Thumbnail.objects.values_list("height", flat=True)), [200, 400])
+
+    def _convert_opaque_pngs(self, title):
+        Plan.objects.filter(title=title).update(
+            encoder_profile=EncoderProfile.objects.create(name="Opaque to jpeg", opaque_png_to_jpeg=True)
+        )
+        plans.clear_local()
+
+    @parameterized.expand([[255, ".jpg"], [128, ".png"]])
+    def test_encoder_profile(self, alpha, expected_ext):
+        self._create_user_plan(self.user, "Premium")
+        self._convert_opaque_pngs("Premium")
+        with tempfile.NamedTemporaryFile(suffix=".png") as f:
+            img = benchmarks.synthetic_image(0.5)
+            img.putalpha(alpha)
+            img.save(f, "PNG")
+            f.flush()
+            self._post_image(f.name)
+        thumbnails = Thumbnail.objects.order_by("height")
+        # opaque png thumbnails are converted to progressive jpegs, transparent ones stay png
+        self.assertEquals({os.path.splitext(thumbnail.image.name)[-1] for thumbnail in thumbnails}, {expected_ext})
+        if expected_ext == ".jpg":
+            self.assertTrue(Image.open(thumbnails[0].image.path).info.get("progressive"))
+
+    def test_no_variants_by_default(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        storage = Thumbnail._meta.get_field("image").storage
+        for thumbnail in Thumbnail.objects.all():
+            for ext in ("avif", "webp"):
+                self.assertFalse(storage.exists(variant_name(thumbnail.image.name, ext)))
+        image_url = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]["image_url"]
+        with override_settings(DEBUG=True):
+            response = self.client.get(image_url, HTTP_ACCEPT="image/avif,image/webp")
+        self.assertEquals(response["Content-Type"], "image/jpeg")
+        self.assertFalse(response.has_header("Vary"))
+
+    def test_16_bit_png(self):
+        self._create_user_plan(self.user, "Premium")
+        self._convert_opaque_pngs("Premium")
+        with tempfile.NamedTemporaryFile(suffix=".png") as f:
+            img = benchmarks.synthetic_image(0.5).convert("L")
+            img.convert("I").point(lambda v: v * 257).save(f, "PNG")
+            f.flush()
+            self._post_image(f.name)
+        # stays a 16 bit png, not clipped into a near white jpeg
+        for thumbnail in Thumbnail.objects.all():
+            self.assertEquals(os.path.splitext(thumbnail.image.name)[-1], ".png")
+            with Image.open(thumbnail.image.path) as thumbnail_img:
+                self.assertEquals(thumbnail_img.mode, "I")
+                self.assertGreater(thumbnail_img.getextrema()[1], 255)
+
+    def test_16_bit_scaled_to_jpeg(self):
+        img = Image.new("I", (32, 8))
+        for i, value in enumerate([0, 16384, 32768, 65535]):
+            img.paste(value, (i * 8, 0, i * 8 + 8, 8))
+        output = BytesIO()
+        encode(img, output, "JPEG", EncoderConfig.from_profile(EncoderProfile()))
+        pixels = [Image.open(output).getpixel((i * 8 + 4, 4)) for i in range(4)]
+        self.assertEquals([round(pixel / 16) for pixel in pixels], [0, 4, 8, 16])
+
+    def test_thumbnail_size_encoder_profile(self):
+        self._create_user_plan(self.user, "Premium")
+        profile = EncoderProfile.objects.create(name="Small", quality=40)
+        ThumbnailSize.objects.filter(plan__title="Premium", height=200).update(encoder_profile=profile)
+        plans.clear_local()
+        plan_config = plans.get_user_plan_config(self.user.pk).plan
+        self.assertEquals(plan_config.encoder(200).quality, 40)
+        self.assertEquals(plan_config.encoder(400).quality, 80)
+        self.assertIsNone(plan_config.encoder(800))
+
+    def test_original_header(self):
+        self._create_user_plan(self.user, "Basic")
+        self._post_image(self.img_path)
+        img_job = ImageJob.objects.get()
+        with Image.open(self.img_path) as img:
+            self.assertEquals(
+                (img_job.original_width, img_job.original_height, img_job.original_format, img_job.original_mode),
+                (img.width, img.height, "JPEG", img.mode),
+            )
+
+        with override_settings(IMAGE_JOB_MAX_PIXELS=1000):
+            response = self._post_image(self.img_path)
+        self.assertEquals(response.status_code, 400)
+        self.assertIn("original_image", response.json())
+        self.assertEquals(ImageJob.objects.count(), 1)
+
+    def test_duplicate_upload_reuses_files(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        with mock.patch("core.tasks.open_image") as open_image:
+            response = self._post_image(self.img_path)
+        self.assertEquals(response.status_code, 201)
+        open_image.assert_not_called()
+
+        first, second = ImageJob.objects.order_by("id")
+        self.assertEquals(first.original_digest, second.original_digest)
+        self.assertEquals(first.original_image.name, second.original_image.name)
+        self.assertEquals(
+            sorted(first.thumbnails.values_list("image", flat=True)),
+            sorted(second.thumbnails.values_list("image", flat=True)),
+        )
+
+    def test_shared_original_is_not_dropped(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        self.client.logout()
+
+        # a Basic user uploading the same image must not delete the original kept for the Premium one
+        user = User.objects.create_user("user2", "user2@example.com", "user2")
+        self._create_user_plan(user, "Basic")
+        self.client.login(username="user2", password="user2")
+        self._post_image(self.img_path)
+
+        first, second = ImageJob.objects.order_by("id")
+        self.assertFalse(second.original_image)
+        self.assertTrue(os.path.exists(first.original_image.path))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestBackfill(ImageJobTestMixin, TestCase):
+    def test_missing_thumbnails_rendered(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        self._post_image(self.img_path)
+        ThumbnailSize.objects.create(plan=Plan.objects.get(title="Premium"), height=100)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            checkpoint = os.path.join(tmp, "checkpoint.json")
+            call_command("backfillthumbnails", checkpoint=checkpoint, chunk_size=1, stdout=StringIO())
+            with open(checkpoint) as f:
+                self.assertEquals(json.load(f)["last_id"], ImageJob.objects.order_by("id").last().id)
+
+            for img_job in ImageJob.objects.all():
+                self.assertEquals(sorted(img_job.thumbnails.values_list("height", flat=True)), [100, 200, 400])
+                height_100 = img_job.thumbnails.get(height=100)
+                self.assertEquals(self._get_thumb_image_height(height_100.image.url), 100)
+
+            # resumed from the checkpoint, nothing left to do; and rerunning renders nothing twice
+            with mock.patch("core.tasks._process_thumbnails") as process_thumbnails:
+                call_command("backfillthumbnails", checkpoint=checkpoint, stdout=StringIO())
+                call_command("backfillthumbnails", after=0, stdout=StringIO())
+            process_thumbnails.assert_not_called()
+
+    def test_celery_dispatch(self):
+        self._create_user_plan(self.user, "Basic")
+        self._post_image(self.img_path)
+        ThumbnailSize.objects.create(plan=Plan.objects.get(title="Basic"), height=100)
+
+        # the original isn't kept on Basic
+        with mock.patch("core.tasks.backfill_image_jobs.apply_async") as apply_async:
+            call_command("backfillthumbnails", celery=True, stdout=StringIO())
+        apply_async.assert_not_called()
+
+        Plan.objects.filter(title="Basic").update(keeping_original_image=True)
+        ImageJob.objects.update(original_image="original/missing.jpg")
+        with mock.patch("core.tasks.backfill_image_jobs.apply_async") as apply_async:
+            call_command("backfillthumbnails", celery=True, stdout=StringIO())
+        apply_async.assert_called_once_with(([ImageJob.objects.get().id],), queue=settings.IMAGE_JOB_BACKFILL_QUEUE)
+
+
+class TestPlanConfig(ImageJobTestMixin, TestCase):
+    def test_cached_without_queries(self):
+        self._create_user_plan(self.user, "Premium")
+        user_plan = plans.get_user_plan_config(self.user.pk)
+        self.assertEquals(user_plan.plan.heights, (400, 200))
+        self.assertEquals(plans.get_user_plan_config_by_id(user_plan.id), user_plan)
+        with self.assertNumQueries(0):
+            self.assertEquals(plans.get_user_plan_config(self.user.pk), user_plan)
+            self.assertEquals(plans.get_user_plan_config_by_id(user_plan.id), user_plan)
+
+    def test_invalidated_on_change(self):
+        self.assertIsNone(plans.get_user_plan_config(self.user.pk))
+        self._create_user_plan(self.user, "Basic")
+        plan = Plan.objects.get(title="Basic")
+        self.assertEquals(plans.get_user_plan_config(self.user.pk).plan.heights, (200,))
+
+        ThumbnailSize.objects.create(plan=plan, height=600)
+        self.assertEquals(plans.get_user_plan_config(self.user.pk).plan.heights, (600, 200))
+        plan.keeping_original_image = True
+        plan.save()
+        self.assertTrue(plans.get_user_plan_config(self.user.pk).plan.keeping_original_image)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, RATE_LIMIT_URL="redis://rate-limits")
+class TestRateLimits(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("core.quotas._client")
+        self.redis = patcher.start().return_value
+        self.addCleanup(patcher.stop)
+        self.script = self.redis.register_script.return_value
+        self.script.return_value = ["", 0]
+        plan = Plan.objects.get(title="Basic")
+        plan.upload_rate = 0.5
+        plan.max_in_flight_jobs = 2
+        plan.megapixels_per_hour = 36
+        plan.save()
+
+    def test_throttled(self):
+        user_plan = self._create_user_plan(self.user, "Basic")
+        self.script.return_value = ["uploads", 1500]
+        response = self._post_image(self.img_path)
+        self.assertEquals(response.status_code, 429)
+        self.assertEquals(response["Retry-After"], "2")
+        self.assertFalse(ImageJob.objects.exists())
+
+        keys, args = self.script.call_args.kwargs["keys"], self.script.call_args.kwargs["args"]
+        self.assertEquals(
+            keys, [f"rate-limit:{{{user_plan.id}}}:{limit}" for limit in ("uploads", "megapixels", "in-flight-jobs")]
+        )
+        self.assertEquals(args[:5], [0.5, 10, 1, 0.01, 36])
+        with Image.open(self.img_path) as img:
+            self.assertAlmostEquals(args[5], img.width * img.height / 1_000_000)
+
+    def test_unlimited_plan(self):
+        self._create_user_plan(self.user, "Premium")
+        self.assertEquals(self._post_image(self.img_path).status_code, 201)
+        self.redis.register_script.assert_not_called()
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, RATE_LIMIT_URL="redis://rate-limits")
+class TestJobsInFlight(ImageJobTestMixin, TestCase):
+    # the scripts run against fakeredis' lua
+    def setUp(self):
+        super().setUp()
+        self.redis = fakeredis.FakeRedis(decode_responses=True)
+        patcher = mock.patch("core.quotas._client", return_value=self.redis)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        Plan.objects.filter(title="Basic").update(max_in_flight_jobs=2)
+        self.user_plan = self._create_user_plan(self.user, "Basic")
+        self.key = f"rate-limit:{{{self.user_plan.id}}}:in-flight-jobs"
+
+    def _upload(self):
+        with mock.patch("core.views.dispatch_image_jobs"):
+            return self._post_image(self.img_path)
+
+    def _process(self, img_job):
+        with self.captureOnCommitCallbacks(execute=True):
+            tasks.process_image_job(img_job.id)
+        self.assertEquals(ImageJob.objects.get(id=img_job.id).status, ImageJob.STATUS_DONE)
+
+    def test_admitted_and_released(self):
+        self.assertEquals([self._upload().status_code for _ in range(3)], [201, 201, 429])
+        self.assertEquals(
+            set(self.redis.zrange(self.key, 0, -1)), set(ImageJob.objects.values_list("admission", flat=True))
+        )
+        self._process(ImageJob.objects.first())
+        self.assertEquals(self.redis.zcard(self.key), 1)
+        self.assertEquals(self._upload().status_code, 201)
+
+    def test_released_after_plan_switch(self):
+        self._upload()
+        # the plan it was admitted by no longer limits the jobs in flight, the job still leaves the count
+        UserPlan.objects.filter(id=self.user_plan.id).update(plan=Plan.objects.get(title="Premium"))
+        plans.clear_local()
+        self._process(ImageJob.objects.get())
+        self.assertEquals(self.redis.zcard(self.key), 0)
+
+    def test_leaked_pruned(self):
+        self._upload()
+        self._upload()
+        done, new = ImageJob.objects.order_by("id")
+        # the release of the done job was lost, an upload failed without withdrawing, another is being created
+        ImageJob.objects.filter(id=done.id).update(status=ImageJob.STATUS_DONE)
+        now = self.redis.time()[0]
+        self.redis.zadd(self.key, {done.admission: now - 3600, new.admission: now - 3600, "failed:1": now - 3600})
+        self.redis.zadd(self.key, {"creating:1": now})
+        self.assertEquals(self._upload().status_code, 429)
+        self.assertEquals(tasks.prune_in_flight_jobs(), 2)
+        self.assertEquals(set(self.redis.zrange(self.key, 0, -1)), {new.admission, "creating:1"})
+
+    def test_stale_admissions_expire(self):
+        # leaked members are dropped one by one once older than the ttl, new admissions don't keep them
+        now = self.redis.time()[0]
+        self.redis.zadd(self.key, {"leaked:1": now - settings.RATE_LIMIT_IN_FLIGHT_TTL - 1, "leaked:2": now - 60})
+        self.assertEquals(self._upload().status_code, 201)
+        self.assertEquals(self._upload().status_code, 429)
+        self.assertEquals(len(self.redis.zrange(self.key, 0, -1)), 2)
+        self.assertNotIn("leaked:1", self.redis.zrange(self.key, 0, -1))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestJobScheduling(ImageJobTestMixin, TestCase):
+    def _create_jobs(self, user_plan, count):
+        return [
+            ImageJob.objects.create(user_plan=user_plan, original_image="original/sample.jpg").id for _ in range(count)
+        ]
+
+    def test_plan_queues(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path)
+        with override_settings(IMAGE_JOB_HEAVY_SIZE=1024):
+            self._post_image(self.img_path)
+        with override_settings(IMAGE_JOB_HEAVY_PIXELS=1000):
+            self._post_image(self.img_path)
+        self.assertEquals(
+            list(ImageJob.objects.order_by("id").values_list("queue", flat=True)),
+            ["images-enterprise", "images-heavy", "images-heavy"],
+        )
+
+    def test_fair_claim(self):
+        bulk = self._create_jobs(self._create_user_plan(self.user, "Basic"), 3)
+        user2 = User.objects.create_user("user2", "user2@example.com", "user2")
+        single = self._create_jobs(self._create_user_plan(user2, "Basic"), 1)
+
+        # the later job of the second user is not queued behind the whole bulk upload
+        self.assertEquals(claim_new_image_jobs("images", 2), [bulk[0], single[0]])
+        self.assertEquals(claim_new_image_jobs("images", 2), [bulk[1], bulk[2]])
+        self.assertEquals(claim_new_image_jobs("images", 2), [])
+        self.assertEquals(claim_new_image_jobs("images-premium", 2), [])
+
+    def test_round_robin_across_claims(self):
+        first = self._create_jobs(self._create_user_plan(self.user, "Basic"), 2)
+        user2 = User.objects.create_user("user2", "user2@example.com", "user2")
+        second = self._create_jobs(self._create_user_plan(user2, "Basic"), 2)
+
+        # single claims go on from the user served last
+        claimed = [claim_new_image_jobs("images", 1) for _ in range(5)]
+        self.assertEquals(claimed, [[first[0]], [second[0]], [first[1]], [second[1]], []])
+
+    def test_duplicate_delivery(self):
+        img_job_id = self._create_jobs(self._create_user_plan(self.user, "Basic"), 1)[0]
+        with mock.patch("core.tasks._process_image_job_batch") as process:
+            tasks.process_image_job(img_job_id)
+            tasks.process_image_job(img_job_id)
+        process.assert_called_once_with([img_job_id])
+        img_job = ImageJob.objects.get(id=img_job_id)
+        self.assertEquals((img_job.status, img_job.attempts), (ImageJob.STATUS_PENDING, 1))
+        self.assertIsNotNone(img_job.lease_expires_at)
+
+    @override_settings(IMAGE_JOB_MAX_ATTEMPTS=2)
+    def test_expired_leases_reclaimed(self):
+        img_job_id = self._create_jobs(self._create_user_plan(self.user, "Basic"), 1)[0]
+        claim_new_image_jobs("images", 1)
+        stale = ImageJob.objects.get(id=img_job_id)
+
+        def expire_lease_and_reclaim(backoff=0):
+            now = timezone.now() + timedelta(seconds=settings.IMAGE_JOB_LEASE + 1 + backoff)
+            with mock.patch("core.scheduling.timezone.now", return_value=now), mock.patch(
+                "core.tasks._dispatch_image_jobs"
+            ) as dispatch, self.captureOnCommitCallbacks(execute=True):
+                reclaimed = tasks.reclaim_image_jobs()
+            return reclaimed, dispatch
+
+        # requeued, but not claimable before the backoff is over
+        self.assertEquals(expire_lease_and_reclaim()[0], (1, 0))
+        self.assertEquals(ImageJob.objects.get(id=img_job_id).status, ImageJob.STATUS_NEW)
+        self.assertEquals(claim_new_image_jobs("images", 1), [])
+        _, dispatch = expire_lease_and_reclaim(backoff=settings.IMAGE_JOB_RETRY_BACKOFF)
+        dispatch.assert_called_once_with([img_job_id])
+        self.assertEquals(claim_new_image_jobs("images", 1), [img_job_id])
+
+        # the worker that lost the lease can't finish the job anymore
+        self.assertEquals(finish_image_jobs([stale], ImageJob.STATUS_DONE), [])
+        self.assertEquals(ImageJob.objects.get(id=img_job_id).status, ImageJob.STATUS_PENDING)
+
+        # failed after the last attempt
+        self.assertEquals(expire_lease_and_reclaim()[0], (0, 1))
+        img_job = ImageJob.objects.get(id=img_job_id)
+        self.assertEquals((img_job.status, img_job.attempts, img_job.lease_expires_at), ("E", 2, None))
+
+    def test_queue_stats(self):
+        img_job_ids = self._create_jobs(self._create_user_plan(self.user, "Basic"), 3)
+        claim_new_image_jobs("images", 1)
+        stats = {queue["queue"]: queue for queue in queue_stats()}
+        self.assertEquals(set(stats), {"images", "images-premium", "images-enterprise", "images-heavy"})
+        self.assertEquals((stats["images"]["depth"], stats["images"]["users"], stats["images"]["started"]), (2, 1, 1))
+        self.assertEquals(stats["images-heavy"]["depth"], 0)
+        self.assertEquals(ImageJob.objects.get(id=img_job_ids[0]).status, ImageJob.STATUS_PENDING)
+
+
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    METRICS_ENABLED=True,
+    METRICS_TOKEN="secret",
+    MIDDLEWARE=["core.metrics.RequestMetricsMiddleware"] + settings.MIDDLEWARE,
+)
+class TestMetrics(ImageJobTestMixin, TestCase):
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_job_and_request_metrics(self):
+        self._create_user_plan(self.user, "Basic")
+        stages = ["decode", "resize", "encode", "write", "thumbnails", "delete_original", "commit"]
+        before = [self._sample("heximg_job_stage_seconds_count", stage=stage) for stage in stages]
+        jobs_before = self._sample("heximg_job_bytes_written_count")
+        requests_before = self._sample("heximg_request_seconds_count", view="image-jobs", method="POST", status="201")
+
+        self._post_image(self.img_path)
+        after = [self._sample("heximg_job_stage_seconds_count", stage=stage) for stage in stages]
+        self.assertTrue(all(a > b for a, b in zip(after, before)), dict(zip(stages, after)))
+        self.assertEquals(self._sample("heximg_job_bytes_written_count"), jobs_before + 1)
+        self.assertEquals(
+            self._sample("heximg_request_seconds_count", view="image-jobs", method="POST", status="201"),
+            requests_before + 1,
+        )
+
+    def test_endpoint(self):
+        self.assertEquals(self.client.get(reverse("metrics")).status_code, 401)
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        self.assertEquals(response.status_code, 200)
+        self.assertIn(b"# TYPE heximg_job_stage_seconds histogram", response.content)
+        with override_settings(METRICS_ENABLED=False):
+            self.assertEquals(self.client.get(reverse("metrics")).status_code, 404)
+
+    def test_queue_gauges(self):
+        user_plan = self._create_user_plan(self.user, "Basic")
+        for _ in range(2):
+            ImageJob.objects.create(user_plan=user_plan, original_image="original/sample.jpg")
+        ImageJob.objects.update(created_at=timezone.now() - timedelta(seconds=30))
+        response = self.client.get(reverse("metrics"), HTTP_AUTHORIZATION="Bearer secret")
+        samples = {
+            (sample.name, sample.labels["queue"]): sample.value
+            for family in text_string_to_metric_families(response.content.decode())
+            if family.name.startswith("heximg_queue_")
+            for sample in family.samples
+        }
+        self.assertEquals(samples[("heximg_queue_depth", "images")], 2)
+        self.assertEquals(samples[("heximg_queue_users", "images")], 1)
+        self.assertEquals(samples[("heximg_queue_depth", "images-heavy")], 0)
+        self.assertTrue(30 <= samples[("heximg_queue_oldest_wait_seconds", "images")] < 60)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestRetention(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        media_settings = override_settings(MEDIA_ROOT=media_root.name)
+        media_settings.enable()
+        self.addCleanup(media_settings.disable)
+        self.media_root = media_root.name
+
+    def test_original_deleted_after_commit(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        with self.captureOnCommitCallbacks() as callbacks, transaction.atomic():
+            retention.drop_originals(list(ImageJob.objects.all()))
+        self.assertEquals(len(os.listdir(os.path.join(self.media_root, "original"))), 1)
+        for callback in callbacks:
+            callback()
+        self.assertEquals(os.listdir(os.path.join(self.media_root, "original")), [])
+
+    def test_purge_expired_links(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+        self.assertEquals(retention.purge_expired_links(), 0)
+
+        Thumbnail.objects.update(external_id_expires_at=timezone.now() - timedelta(seconds=1))
+        with override_settings(RETENTION_BATCH_SIZE=1):
+            self.assertEquals(retention.purge_expired_links(), Thumbnail.objects.count())
+        self.assertFalse(Thumbnail.objects.exclude(external_id=None).exists())
+
+    def test_purge_failed_jobs(self):
+        self._create_user_plan(self.user, "Premium")
+        with mock.patch("core.tasks.resize_from_pyramid", side_effect=ValueError("resize failed")):
+            self._post_image(self.img_path)
+        img_job = ImageJob.objects.get()
+        self.assertEquals(img_job.status, ImageJob.STATUS_ERROR)
+        self.assertEquals(retention.purge_failed_jobs(), 0)
+
+        ImageJob.objects.update(created_at=F("created_at") - timedelta(seconds=settings.RETENTION_FAILED_JOBS_AFTER))
+        with self.captureOnCommitCallbacks(execute=True):
+            self.assertEquals(retention.purge_failed_jobs(), 1)
+        img_job.refresh_from_db()
+        self.assertFalse(img_job.original_image)
+        self.assertEquals(os.listdir(os.path.join(self.media_root, "original")), [])
+
+    def test_reconcile_media(self):
+        self._create_user_plan(self.user, "Premium")
+        self._post_image(self.img_path)
+        thumbnail = Thumbnail.objects.first()
+        variant = thumbnail.image.path + ".webp"
+        orphan = os.path.join(self.media_root, "thumbs", "orphan.jpg")
+        for path in (variant, orphan):
+            with open(path, "wb") as f:
+                f.write(b"x")
+
+        # within the grace period nothing is touched
+        self.assertEquals(retention.reconcile_media(), [])
+
+        later = timezone.now() + timedelta(seconds=settings.RETENTION_ORPHAN_GRACE + 1)
+        with mock.patch("core.retention.timezone.now", return_value=later):
+            self.assertEquals(retention.reconcile_media(dry_run=True), ["thumbs/orphan.jpg"])
+            self.assertTrue(os.path.exists(orphan))
+            self.assertEquals(retention.reconcile_media(), ["thumbs/orphan.jpg"])
+        self.assertFalse(os.path.exists(orphan))
+        self.assertTrue(os.path.exists(variant))
+        self.assertTrue(os.path.exists(thumbnail.image.path))
+        self.assertTrue(os.path.exists(ImageJob.objects.get().original_image.path))
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, JOB_EVENTS_URL="redis://events")
+class TestJobEvents(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch("core.events._client")  # no redis for the jobs processed along
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_published_on_commit(self):
+        user_plan = self._create_user_plan(self.user, "Basic")
+        with mock.patch("core.events._client") as client:
+            self._post_image(self.img_path)
+        img_job = ImageJob.objects.get()
+        pipe = client.return_value.pipeline.return_value.__enter__.return_value
+        self.assertEquals(
+            [xadd.args[:2] for xadd in pipe.xadd.call_args_list],
+            [
+                (f"image-job-events:{user_plan.id}", {"id": img_job.id, "status": "P"}),
+                (f"image-job-events:{user_plan.id}", {"id": img_job.id, "status": "D"}),
+            ],
+        )
+
+    def test_long_poll_and_event_stream(self):
+        self._create_user_plan(self.user, "Basic")
+        self._post_image(self.img_path)
+        img_job = ImageJob.objects.get()
+        job_events = [("1-0", {"id": str(img_job.id), "status": "P"}), ("2-0", {"id": str(img_job.id), "status": "D"})]
+
+        with mock.patch("core.events.last_cursor", return_value="0-0"):
+            self.assertEquals(self.client.get(reverse("image-job-events")).json(), {"cursor": "0-0", "jobs": []})
+        with mock.patch("core.events.read_events", return_value=job_events) as read_events:
+            response = self.client.get(reverse("image-job-events"), {"since": "0-0"})
+        read_events.assert_called_once_with(img_job.user_plan_id, "0-0", settings.JOB_EVENTS_POLL_TIMEOUT)
+        self.assertEquals(response.json()["cursor"], "2-0")
+        self.assertEquals(
+            [(job["id"], job["status"], len(job["thumbnails"])) for job in response.json()["jobs"]],
+            [(img_job.id, "D", 1)],
+        )
+        self.assertEquals(self.client.get(reverse("image-job-events"), {"since": "x"}).status_code, 400)
+
+        with mock.patch("core.events.read_events", side_effect=[[], job_events]) as read_events:
+            response = self.client.get(
+                reverse("image-job-events"), HTTP_ACCEPT="text/event-stream", HTTP_LAST_EVENT_ID="0-0"
+            )
+            self.assertEquals(response["Content-Type"], "text/event-stream")
+            self.assertEquals(next(response.streaming_content), b": keepalive\n\n")
+            event = next(response.streaming_content).decode()
+        self.assertTrue(event.startswith("id: 2-0\nevent: status\ndata: {"), event)
+        self.assertEquals(json.loads(event.split("data: ")[1])["status"], "D")
+
+        with override_settings(JOB_EVENTS_URL=None):
+            self.assertEquals(self.client.get(reverse("image-job-events")).status_code, 404)
+
+    def test_async_event_stream(self):
+        self._create_user_plan(self.user, "Basic")
+        self._post_image(self.img_path)
+        img_job = ImageJob.objects.get()
+        self.async_client.force_login(self.user)
+
+        # served through asgi, the stream is consumed on the event loop
+        with mock.patch("core.events.async_client"), mock.patch(
+            "core.events.aread_events", side_effect=[[("3-0", {"id": str(img_job.id), "status": "D"})]]
+        ):
+            response = async_to_sync(self.async_client.get)(
+                reverse("image-job-events"), headers={"Accept": "text/event-stream", "Last-Event-ID": "0-0"}
+            )
+
+            async def first_event():
+                return await anext(aiter(response.streaming_content))
+
+            event = async_to_sync(first_event)().decode()
+        self.assertTrue(event.startswith("id: 3-0\nevent: status\n"), event)
+
+
+class TestImageJobPagination(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user("user1", "user1@example.com", "user1")
+        self.client.login(username="user1", password="user1")
+        user_plan = UserPlan.objects.create(user=self.user, plan=Plan.objects.get(title="Basic"))
+        self.jobs = ImageJob.objects.bulk_create(
+            ImageJob(user_plan=user_plan, status=ImageJob.STATUS_DONE if i % 2 else ImageJob.STATUS_NEW)
+            for i in range(7)
+        )
+        # a few jobs share created_at, the id has to break the tie
+        ImageJob.objects.filter(id__in=[job.id for job in self.jobs[2:5]]).update(created_at=self.jobs[2].created_at)
+
+    def _fetch_all(self, url):
+        ids = []
+        while url:
+            response = self.client.get(url)
+            self.assertEquals(response.status_code, 200)
+            ids.extend(job["id"] for job in response.json()["results"])
+            url = response.json()["next"]
+        return ids
+
+    def test_cursor_pagination(self):
+        expected = list(ImageJob.objects.order_by("-created_at", "-id").values_list("id", flat=True))
+        self.assertEquals(self._fetch_all(reverse("image-jobs") + "?page_size=2"), expected)
+
+    def test_status_filter(self):
+        expected = list(ImageJob.objects.filter(status="D").order_by("-created_at", "-id").values_list("id", flat=True))
+        self.assertEquals(self._fetch_all(reverse("image-jobs") + "?page_size=2&status=D"), expected)
+
+    def test_invalid_filters(self):
+        self.assertEquals(self.client.get(reverse("image-jobs") + "?status=X").status_code, 400)
+        self.assertEquals(self.client.get(reverse("image-jobs") + "?created_after=yesterday").status_code, 400)
+        self.assertEquals(self.client.get(reverse("image-jobs") + "?cursor=foo").status_code, 404)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True, IMAGE_JOB_LIST_CACHE_TIMEOUT=300)
+class TestJobListCache(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=600)
+
+    def test_matches_serializer(self):
+        self._post_image(self.img_path)
+        response = self.client.get(reverse("image-jobs"))
+        img_jobs = ImageJob.objects.order_by("-created_at", "-id")
+        serialized = ImageJobSerializer(img_jobs, many=True, context={"request": response.wsgi_request}).data
+        self.assertEquals(response.json()["results"], json.loads(json.dumps(serialized, cls=JSONEncoder)))
+
+    def test_etag(self):
+        response = self.client.get(reverse("image-jobs"))
+        etag = response["ETag"]
+        self.assertEquals(self.client.get(reverse("image-jobs"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # unchanged jobs are served from the cache
+        Thumbnail.objects.update(external_id_expires_at=None)
+        self.assertEquals(self.client.get(reverse("image-jobs"), HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # changes made through the app invalidate it
+        thumbnail = Thumbnail.objects.exclude(external_id=None).first()
+        with self.captureOnCommitCallbacks(execute=True):
+            revoke_external_link(thumbnail.external_id, timezone.now() + timedelta(seconds=600))
+        response = self.client.get(reverse("image-jobs"), HTTP_IF_NONE_MATCH=etag)
+        self.assertEquals(response.status_code, 200)
+        self.assertNotEquals(response["ETag"], etag)
+
+        self._post_image(self.img_path)
+        response = self.client.get(reverse("image-jobs"), HTTP_IF_NONE_MATCH=response["ETag"])
+        self.assertEquals(response.status_code, 200)
+        self.assertEquals(len(response.json()["results"]), 2)
+
+
+# django streams media itself in development only
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True, DEBUG=True, THUMBNAIL_VARIANT_FORMATS=["avif", "webp"], THUMBNAIL_VARIANTS_EAGER=True
+)
+class TestMediaDelivery(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=600)
+        self.thumbnail = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]
+
+    @parameterized.expand(
+        [
+            ["x-accel", "X-Accel-Redirect", "/protected-media/thumbs/"],
+            ["x-sendfile", "X-Sendfile", os.path.join(THUMBS_DIR, "")],
+        ]
+    )
+    def test_file_body_left_to_proxy(self, delivery, header, prefix):
+        with override_settings(MEDIA_DELIVERY=delivery), mock.patch("core.delivery.FileResponse") as file_response:
+            for url in (self.thumbnail["image_url"], self.thumbnail["external_url"]):
+                response = self.client.get(url)
+                self.assertEquals(response.status_code, 200)
+                self.assertTrue(response[header].startswith(prefix))
+                self.assertEquals(response.content, b"")
+        file_response.assert_not_called()
+
+    def test_cache_headers(self):
+        response = self.client.get(self.thumbnail["image_url"])
+        self.assertEquals(response["Cache-Control"], "public, max-age=31536000, immutable")
+
+        # originals are users' uploads, kept out of shared caches
+        original_url = self.client.get(reverse("image-jobs")).json()["results"][0]["original_image"]
+        self.assertEquals(self.client.get(original_url)["Cache-Control"], "private, max-age=86400")
+
+    def test_media_route(self):
+        # in production only a proxy delivery mode serves media
+        with override_settings(DEBUG=False):
+            self.assertEquals(self.client.get(self.thumbnail["image_url"]).status_code, 404)
+            with override_settings(MEDIA_DELIVERY="x-accel"):
+                self.assertEquals(self.client.get(self.thumbnail["image_url"]).status_code, 200)
+
+        self.assertEquals(self.client.head(self.thumbnail["image_url"]).status_code, 200)
+        self.assertEquals(self.client.head(self.thumbnail["external_url"]).status_code, 200)
+        self.assertEquals(self.client.post(self.thumbnail["image_url"]).status_code, 405)
+        # a name resolving to a directory
+        self.assertEquals(self.client.get(reverse("media", args=["thumbs/.."])).status_code, 404)
+
+        response = self.client.get(self.thumbnail["external_url"])
+        max_age = int(response["Cache-Control"].split("max-age=")[1])
+        self.assertTrue(590 < max_age <= 600)
+
+    def test_conditional_get(self):
+        response = self.client.get(self.thumbnail["image_url"])
+        for headers in (
+            {"HTTP_IF_NONE_MATCH": response["ETag"]},
+            {"HTTP_IF_MODIFIED_SINCE": response["Last-Modified"]},
+        ):
+            conditional_response = self.client.get(self.thumbnail["image_url"], **headers)
+            self.assertEquals(conditional_response.status_code, 304)
+            self.assertEquals(conditional_response["ETag"], response["ETag"])
+
+    def test_format_negotiation(self):
+        for url in (self.thumbnail["image_url"], self.thumbnail["external_url"]):
+            response = self.client.get(url, HTTP_ACCEPT="image/avif,image/webp,*/*")
+            self.assertEquals(response["Content-Type"], "image/webp")
+            self.assertEquals(response["Vary"], "Accept")
+            self.assertEquals(Image.open(BytesIO(b"".join(response.streaming_content))).format, "WEBP")
+
+            response = self.client.get(url, HTTP_ACCEPT="image/webp;q=0,*/*")
+            self.assertEquals(response["Content-Type"], "image/jpeg")
+
+    def test_explicit_format(self):
+        url = self.thumbnail["external_url"].rsplit(".", 1)[0]
+        response = self.client.get(url + ".webp")
+        self.assertEquals(response["Content-Type"], "image/webp")
+        self.assertFalse(response.has_header("Vary"))
+        for fmt in ("png", "gif"):
+            self.assertEquals(self.client.get(f"{url}.{fmt}").status_code, 404)
+
+    def test_variants_of_same_stem(self):
+        # thumbnails named alike but for the extension get variants of their own
+        media_root = tempfile.TemporaryDirectory()
+        self.addCleanup(media_root.cleanup)
+        with override_settings(MEDIA_ROOT=media_root.name):
+            for ext, color in ((".jpg", "red"), (".jpeg", "blue")):
+                path = os.path.join(media_root.name, f"collide{ext}")
+                Image.new("RGB", (600, 400), color).save(path)
+                self._post_image(path)
+            thumbnails = list(Thumbnail.objects.filter(height=200, image__contains="collide").order_by("id"))
+            names = [thumbnail.image.name for thumbnail in thumbnails]
+            self.assertEquals(names, ["thumbs/collide_thumb_200.jpg", "thumbs/collide_thumb_200.jpeg"])
+            colors = []
+            for thumbnail in thumbnails:
+                with thumbnail.image.storage.open(variant_name(thumbnail.image.name, "webp")) as f:
+                    colors.append(Image.open(f).convert("RGB").getpixel((0, 0)))
+            self.assertGreater(colors[0][0], 200)
+            self.assertGreater(colors[1][2], 200)
+
+            # deleting one thumbnail leaves the other's variant
+            tasks._delete_thumbnail_images(thumbnails[:1])
+            self.assertTrue(thumbnails[1].image.storage.exists(variant_name(names[1], "webp")))
+
+    def test_missing_variant_rendered_on_request(self):
+        variant = os.path.join(THUMBS_DIR, os.path.basename(self.thumbnail["image_url"]) + ".webp")
+        os.remove(variant)
+        response = self.client.get(self.thumbnail["image_url"], HTTP_ACCEPT="image/webp")
+        self.assertEquals(response["Content-Type"], "image/webp")
+        self.assertTrue(os.path.exists(variant))
+
+
+S3_STORAGES = {
+    "default": {"BACKEND": "core.storage.S3MediaStorage"},
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+
+
+@mock_s3
+@override_settings(
+    CELERY_TASK_ALWAYS_EAGER=True,
+    STORAGES=S3_STORAGES,
+    MEDIA_S3_BUCKET="media",
+    MEDIA_S3_REGION="us-east-1",
+    THUMBNAIL_VARIANT_FORMATS=["avif", "webp"],
+    THUMBNAIL_VARIANTS_EAGER=True,
+)
+class TestS3Storage(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.s3 = boto3.client("s3", region_name="us-east-1")
+        self.s3.create_bucket(Bucket="media")
+
+    def _keys(self):
+        return sorted(entry["Key"] for entry in self.s3.list_objects_v2(Bucket="media").get("Contents", []))
+
+    def test_job_files_in_bucket(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+        img_job = ImageJob.objects.get()
+        self.assertEquals(img_job.status, ImageJob.STATUS_DONE)
+        thumbnail_names = sorted(img_job.thumbnails.values_list("image", flat=True))
+        variant_names = [name + ".webp" for name in thumbnail_names]
+        self.assertEquals(self._keys(), sorted([img_job.original_image.name, *thumbnail_names, *variant_names]))
+
+        # thumbnails are read back from the bucket
+        thumbnail = img_job.thumbnails.first()
+        with thumbnail.image.open() as f:
+            self.assertEquals(Image.open(f).height, thumbnail.height)
+
+        # nothing is orphaned, dropping the original deletes it after commit
+        with mock.patch("core.retention.timezone.now", return_value=timezone.now() + timedelta(days=2)):
+            self.assertEquals(retention.reconcile_media(dry_run=True), [])
+        original = img_job.original_image.name
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            retention.drop_originals([img_job])
+        self.assertNotIn(original, self._keys())
+
+    @parameterized.expand(
+        [[None, "https://media.s3.amazonaws.com/thumbs/"], ["cdn.example.com", "https://cdn.example.com/thumbs/"]]
+    )
+    def test_urls_without_store_requests(self, custom_domain, prefix):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+
+        # urls are presigned locally or point at the cdn, no request reaches the store
+        storage = Thumbnail._meta.get_field("image").storage
+        with mock.patch.object(storage, "custom_domain", custom_domain), mock.patch(
+            "botocore.client.BaseClient._make_api_call", side_effect=AssertionError("store contacted")
+        ):
+            thumbnail = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]
+            self.assertIn(prefix, thumbnail["image_url"])
+            response = self.client.get(thumbnail["external_url"], HTTP_ACCEPT="image/webp")
+            self.assertEquals(response.status_code, 302)
+            self.assertIn(prefix, response["Location"])
+            self.assertTrue(response["Location"].split("?")[0].endswith(".webp"))
+            if custom_domain is None:
+                self.assertIn("X-Amz-Signature", response["Location"])
+
+            legacy = reverse("ext_image", args=[Thumbnail.objects.first().external_id, "jpg"])
+            self.assertEquals(self.client.get(legacy).status_code, 302)
+
+        # the presigned url serves the thumbnail
+        if custom_domain is None:
+            self.assertEquals(requests.get(thumbnail["image_url"]).status_code, 200)
+
+    def test_missing_variant_rendered_on_request(self):
+        self._create_user_plan(self.user, "Enterprise")
+        self._post_image(self.img_path, link_expires_in=300)
+        # a thumbnail from before variants: redirected to a variant rendered on request, not a missing object
+        thumbnail = Thumbnail.objects.first()
+        variant = variant_name(thumbnail.image.name, "webp")
+        self.s3.delete_object(Bucket="media", Key=variant)
+        cache.clear()
+        external_url = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"][0]["external_url"]
+        response = self.client.get(external_url, HTTP_ACCEPT="image/webp")
+        self.assertEquals(response.status_code, 302)
+        self.assertTrue(response["Location"].split("?")[0].endswith(".webp"))
+        self.assertIn(variant, self._keys())
+
+        # and then known to be there
+        with mock.patch("botocore.client.BaseClient._make_api_call", side_effect=AssertionError("store contacted")):
+            self.assertEquals(self.client.get(external_url, HTTP_ACCEPT="image/webp").status_code, 302)
+
+
+@override_settings(CELERY_TASK_ALWAYS_EAGER=True)
+class TestLazyThumbnails(ImageJobTestMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        plan = Plan.objects.create(title="Lazy", keeping_original_image=True, lazy_thumbnails=True)
+        ThumbnailSize.objects.bulk_create([ThumbnailSize(plan=plan, height=200), ThumbnailSize(plan=plan, height=400)])
+        self._create_user_plan(self.user, "Lazy")
+
+    def test_rendered_on_first_request(self):
+        response = self._post_image(self.img_path)
+        self.assertEquals(response.status_code, 201)
+        self.assertFalse(Thumbnail.objects.exclude(image="").exists())
+
+        response = self.client.get(reverse("image-jobs"))
+        job_result = response.json()["results"][0]
+        self.assertEquals(job_result["status"], "D")
+
+        heights = []
+        for thumbnail in job_result["thumbnails"]:
+            response = self.client.get(thumbnail["image_url"])
+            self.assertEquals(response.status_code, 200)
+            heights.append(Image.open(BytesIO(b"".join(response.streaming_content))).height)
+        self.assertEquals(sorted(heights), [200, 400])
+
+        # served from the cache afterwards
+        with mock.patch("core.tasks.open_image") as open_image:
+            response = self.client.get(job_result["thumbnails"][0]["image_url"])
+        self.assertEquals(response.status_code, 200)
+        open_image.assert_not_called()
+
+    @override_settings(LAZY_THUMBNAIL_CACHE_BYTES=1)
+    def test_lru_eviction(self):
+        self._post_image(self.img_path)
+        thumbnails = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"]
+        self.client.get(thumbnails[0]["image_url"])
+        self.client.get(thumbnails[1]["image_url"])
+        self.assertEquals(Thumbnail.objects.exclude(image="").count(), 1)
+
+    def test_rendered_total_counted_once(self):
+        self._post_image(self.img_path)
+        thumbnails = self.client.get(reverse("image-jobs")).json()["results"][0]["thumbnails"]
+        self.client.get(thumbnails[0]["image_url"])
+        with mock.patch("core.tasks.lazy_thumbnail_bytes") as lazy_thumbnail_bytes:
+            self.client.get(thumbnails[1]["image_url"])
+        lazy_thumbnail_bytes.assert_not_called()
+        self.assertEquals(cache.get(tasks.LAZY_THUMBNAIL_BYTES_KEY), tasks.lazy_thumbnail_bytes())
+        self.assertEquals(tasks.recount_lazy_thumbnails(), tasks.lazy_thumbnail_bytes())
+
+    def test_rendered_concurrently(self):
+        self._post_image(self.img_path)
+        thumbnail = Thumbnail.objects.get(height=200)
+        save_thumbnail_image = tasks._save_thumbnail_image
+
+        rendered = []
+
+        def render_elsewhere(rendering, *args, **kwargs):
+            # another process claims the row while this one renders
+            save_thumbnail_image(rendering, *args, **kwargs)
+            rendered.append(rendering.image.name)
+            Thumbnail.objects.filter(id=thumbnail.id).update(image="thumbs/elsewhere.jpg")
+
+        with mock.patch("core.tasks._save_thumbnail_image", side_effect=render_elsewhere):
+            materialized = tasks.materialize_thumbnail(thumbnail)
+        self.assertEquals(materialized.image.name, "thumbs/elsewhere.jpg")
+        self.assertFalse(thumbnail.image.storage.exists(rendered[0]))
+
+    def test_render_coalesced_across_processes(self):
+        self._post_image(self.img_path)
+        thumbnail, other = Thumbnail.objects.order_by("height")
+        # another process holds the render lock and stores the file while this one waits
+        lock = tasks.RENDER_LOCK_KEY.format(digest=hashlib.sha256(f"thumbnail:{thumbnail.id}".encode()).hexdigest())
+        cache.add(lock, True)
+
+        def render_elsewhere(seconds):
+            Thumbnail.objects.filter(id=thumbnail.id).update(image="thumbs/elsewhere.jpg")
+
+        with mock.patch("core.tasks.time.sleep", side_effect=render_elsewhere) as sleep, mock.patch(
+            "core.tasks.open_image"
+        ) as open_image:
+            materialized = tasks.materialize_thumbnail(thumbnail)
+        self.assertEquals(materialized.image.name, "thumbs/elsewhere.jpg")
+        sleep.assert_called_once()
+        open_image.assert_not_called()
+
+        # other thumbnails don't wait on it
+        with mock.patch("core.tasks.time.sleep") as sleep:
+            self.assertTrue(tasks.materialize_thumbnail(other).image)
+        sleep.assert_not_called()
+
+    def test_keeping_original_image_required(self):
+        plan = Plan(title="Lazy Basic", lazy_thumbnails=True)
+        with self.assertRaises(ValidationError):
+            plan.full_clean()
+
+
+class TestBenchmarkComparison(SimpleTestCase):
+    def test_regressions(self):
+        baseline = {"list": [{"id": "list/10", "jobs": 10, "first_page_s": 0.01, "jobs_per_s": 100.0, "bytes": 1000}]}
+        results = {
+            "list": [
+                {"id": "list/10", "jobs": 20, "first_page_s": 0.011, "jobs_per_s": 70.0, "bytes": 1300},
+                {"id": "list/1000", "jobs": 1000, "first_page_s": 1.0},
+            ]
+        }
+        regressions = benchmarks.compare(results, baseline, tolerance=0.2)
+        self.assertEquals(
+            [(regression["id"], regression["metric"]) for regression in regressions],
+            [
+                ("list/10", "jobs_per_s"),
+                ("list/10", "bytes"),
+            ],
+        )
+
+
+class TestResizeEngine(SimpleTestCase):
+    def test_jpeg_draft_decoding(self):
+        filename = benchmarks.synthetic_image_file(4)
+        img = open_image(filename, max_height=200)
+        self.assertGreaterEqual(img.height, 400)
+        self.assertLess(img.height, Image.open(filename).height)
+
+    def test_quality_tolerance(self):
+        filename = benchmarks.synthetic_image_file(4)
+        heights = [400, 200]
+        for reference, thumbnail in zip(
+            benchmarks.reference_thumbnails(filename, heights), benchmarks.engine_thumbnails(filename, heights)
+        ):
+            self.assertEquals(reference.size, thumbnail.size)
+            self.assertLess(benchmarks.mean_abs_diff(reference, thumbnail), 1.0)
+
+    def test_pyramid_levels(self):
+        img = Image.new("RGB", (3000, 2000))
+        levels = build_pyramid(img, min_height=200)
+        self.assertEquals([level.height for level in levels], [2000, 1000, 500])
+        self.assertEquals(resize_from_pyramid(levels, 200).size, (300, 200))
+        self.assertEquals(resize_from_pyramid(levels, 400).size, (600, 400))
+
+    def test_no_upscaling(self):
+        img = Image.new("RGB", (30, 20))
+        self.assertEquals(resize_to_height(img, 200).size, (30, 20))
+
+    @parameterized.expand([["P", "RGB"], ["P", "RGBA"], ["1", "L"]])
+    def test_palette_and_bilevel(self, mode, resized_mode):
+        img = benchmarks.synthetic_image(0.3)
+        img = img.convert("RGBA").quantize(16) if resized_mode == "RGBA" else img.convert(mode)
+        if resized_mode == "RGBA":
+            img.info["transparency"] = 0
+        self.assertEquals(img.mode, mode)
+        resized = resize_to_height(img, 40)
+        self.assertEquals((resized.mode, resized.height), (resized_mode, 40))
+
+    @parameterized.expand([["RGB"], ["RGBA"], ["L"], ["P"]])
+    def test_png_strip_decoding(self, mode):
+        img = benchmarks.synthetic_image(0.3)
+        img = img.quantize(64) if mode == "P" else img.convert(mode)
+        output = BytesIO()
+        img.save(output, "PNG")
+        output.seek(0)
+        # a budget of a few rows: many strips, each referring to the previous one's last row
+        strips = open_image(output, max_height=40, memory_budget=img.width * 64)
+        full = Image.open(output)
+        full = full.convert("RGB") if mode == "P" else full
+        factor = int(img.height // (40 * imaging.REDUCING_GAP))
+        self.assertEquals(strips.tobytes(), full.reduce(factor).tobytes())
+
+    def test_png_strip_decoding_bomb(self):
+        # image data inflating to far more than the header's 1000x1000 pixels
+        width = height = 1000
+        scanlines = bytes(width + 1) * height + bytes(64 * 1024 * 1024)
+
+        def chunk(chunk_type: bytes, data: bytes) -> bytes:
+            return struct.pack(">I", len(data)) + chunk_type + data + struct.pack(">I", zlib.crc32(chunk_type + data))
+
+        output = BytesIO(
+            b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 0, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(scanlines, 9))
+            + chunk(b"IEND", b"")
+        )
+        del scanlines
+        tracemalloc.start()
+        try:
+            reduced = open_image(output, max_height=40, memory_budget=width * 64)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        self.assertEquals(reduced.getextrema(), (0, 0))
+        self.assertLess(peak, 4 * 1024 * 1024)
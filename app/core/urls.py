@@ -4,6 +4,11 @@ from core import views
 
 urlpatterns = [
     path("image-jobs/", views.ImageJobView.as_view(), name="image-jobs"),
+    path("image-jobs/events/", views.ImageJobEventsView.as_view(), name="image-job-events"),
+    path("image-jobs/batches/", views.ImageJobBatchView.as_view(), name="image-job-batches"),
+    path("image-jobs/batches/<int:pk>/", views.ImageJobBatchDetailView.as_view(), name="image-job-batch"),
     path("", views.ApiCore.as_view(), name="core"),
     path("image/<slug:external_id>.<str:fmt>", views.ext_image, name="ext_image"),
+    path("image/s/<str:token>.<str:fmt>", views.ext_image_signed, name="ext_image_signed"),
+    path("thumbnails/<int:pk>", views.thumbnail_image, name="thumbnail"),
 ]
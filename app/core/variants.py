@@ -0,0 +1,94 @@
+import hashlib
+import mimetypes
+import os
+from tempfile import SpooledTemporaryFile
+from typing import List, Optional
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files import File
+from django.core.files.storage import Storage
+from django.http import HttpRequest
+
+from PIL import Image
+
+from core.encoding import eight_bit
+
+# modern formats a thumbnail can additionally be stored in, best compression first
+VARIANT_FORMATS = {"avif": "AVIF", "webp": "WEBP"}
+
+VARIANT_CONTENT_TYPES = {"avif": "image/avif", "webp": "image/webp"}
+
+mimetypes.add_type("image/avif", ".avif")
+
+# variants seen in a remote store, which isn't asked on every request
+EXISTS_KEY = "thumbnail-variant:{digest}"
+EXISTS_TIMEOUT = 24 * 3600
+
+
+def variant_formats() -> List[str]:
+    # configured and supported by the installed Pillow build
+    Image.init()
+    return [
+        ext for ext, fmt in VARIANT_FORMATS.items() if ext in settings.THUMBNAIL_VARIANT_FORMATS and fmt in Image.SAVE
+    ]
+
+
+def variant_name(name: str, ext: str) -> str:
+    # the whole thumbnail name: shared thumbnail files share their variants too, but thumbnails of the same
+    # stem in other formats (x_thumb_200.jpg, x_thumb_200.jpeg, x_thumb_200.png) don't
+    return f"{name}.{ext}"
+
+
+def thumbnail_name(name: str) -> Optional[str]:
+    # of the thumbnail a variant belongs to
+    root, ext = os.path.splitext(name)
+    return root if ext[1:] in VARIANT_FORMATS else None
+
+
+def accepted_variants(request: HttpRequest) -> List[str]:
+    # only explicitly listed types count, browsers send */* without supporting every format
+    accepted = set()
+    for media_range in request.headers.get("Accept", "").split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        if not any(param.replace(" ", "") in ("q=0", "q=0.0", "q=0.00", "q=0.000") for param in params):
+            accepted.add(media_type.lower())
+    return [ext for ext in variant_formats() if VARIANT_CONTENT_TYPES[ext] in accepted]
+
+
+def _exists_key(name: str, ext: str) -> str:
+    return EXISTS_KEY.format(digest=hashlib.sha256(variant_name(name, ext).encode()).hexdigest())
+
+
+def variant_exists(storage: Storage, name: str, ext: str) -> bool:
+    # thumbnails from before variants (or before the installed Pillow supported a format) have none even
+    # where variants are rendered eagerly
+    if not getattr(storage, "remote", False):
+        return storage.exists(variant_name(name, ext))
+    if cache.get(_exists_key(name, ext)):
+        return True
+    if not storage.exists(variant_name(name, ext)):
+        return False
+    cache.set(_exists_key(name, ext), True, timeout=EXISTS_TIMEOUT)
+    return True
+
+
+def save_variant(storage: Storage, img: Image.Image, name: str, ext: str, quality: int, replace: bool = False) -> None:
+    # replace: the thumbnail file was just written, a variant of its name is left over from a deleted one
+    if replace:
+        storage.delete(variant_name(name, ext))
+        cache.delete(_exists_key(name, ext))
+    with SpooledTemporaryFile(max_size=settings.THUMBNAIL_SPOOL_MAX_SIZE) as output:
+        eight_bit(img).save(output, VARIANT_FORMATS[ext], quality=quality)
+        output.seek(0)
+        saved = storage.save(variant_name(name, ext), File(output))
+    if saved != variant_name(name, ext):
+        # rendered concurrently from the same thumbnail file by another process, whose file is kept
+        storage.delete(saved)
+    cache.set(_exists_key(name, ext), True, timeout=EXISTS_TIMEOUT)
+
+
+def delete_variants(storage: Storage, name: str) -> None:
+    for ext in VARIANT_FORMATS:
+        storage.delete(variant_name(name, ext))
+    cache.delete_many([_exists_key(name, ext) for ext in VARIANT_FORMATS])
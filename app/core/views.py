@@ -1,24 +1,68 @@
+import json
 import os
+import time
+from datetime import datetime
+from typing import AsyncIterator, Dict, Iterator, List, Optional, Tuple
 
-from django.http import Http404, HttpRequest, HttpResponse
-from django.shortcuts import get_object_or_404, redirect
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError as DjangoValidationError
+from django.core.handlers.asgi import ASGIRequest
+from django.http import (
+    Http404,
+    HttpRequest,
+    HttpResponse,
+    HttpResponseNotAllowed,
+    StreamingHttpResponse,
+)
+from django.shortcuts import get_object_or_404
 from django.urls import reverse
 from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.crypto import constant_time_compare
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.http import require_GET, require_safe
 
+from asgiref.sync import sync_to_async
+from prometheus_client import CONTENT_TYPE_LATEST
 from rest_framework import generics
-from rest_framework.decorators import api_view
+from rest_framework.decorators import api_view, permission_classes
+from rest_framework.exceptions import ValidationError
 from rest_framework.parsers import FormParser, MultiPartParser
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.encoders import JSONEncoder
 
-from core.models import ImageJob, Thumbnail
-from core.serializers import ImageJobSerializer, NewImageJobSerializer
-from core.tasks import process_image_job
+from core import events, joblist, metrics
+from core.delivery import file_response
+from core.links import resolve_external_link
+from core.models import ImageJob, ImageJobBatch, Thumbnail
+from core.pagination import KeysetPagination
+from core.plans import get_user_plan_config
+from core.renderers import EventStreamRenderer
+from core.serializers import (
+    ImageJobBatchSerializer,
+    ImageJobSerializer,
+    NewImageJobBatchSerializer,
+    NewImageJobSerializer,
+)
+from core.tasks import (
+    SUPPORTED_IMG_FORMATS,
+    dispatch_image_jobs,
+    materialize_thumbnail,
+    materialize_variant,
+)
+from core.variants import accepted_variants, variant_formats
+
+THUMBNAIL_UPLOAD_TO = Thumbnail._meta.get_field("image").upload_to
 
 
 class ImageJobView(generics.ListCreateAPIView):
     permission_classes = [IsAuthenticated]
     parser_class = [MultiPartParser, FormParser]
+    pagination_class = KeysetPagination
 
     def get_serializer(self, *args, **kwargs):
         context = kwargs.get("context", {})
@@ -29,16 +73,151 @@ class ImageJobView(generics.ListCreateAPIView):
         return ImageJobSerializer(*args, **kwargs)
 
     def get_queryset(self):
-        return (
-            ImageJob.objects.select_related("user_plan")
-            .filter(user_plan__user=self.request.user)
-            .prefetch_related("thumbnails")
-            .order_by("-created_at")
-        )
+        queryset = ImageJob.objects.filter(user_plan__user=self.request.user)
+        params = self.request.query_params
+        if "status" in params:
+            if params["status"] not in dict(ImageJob.STATUS_CHOICES):
+                raise ValidationError({"status": _("Invalid status")})
+            queryset = queryset.filter(status=params["status"])
+        for param, lookup in (("created_after", "created_at__gte"), ("created_before", "created_at__lt")):
+            if param in params:
+                value = parse_datetime(params[param])
+                if value is None:
+                    raise ValidationError({param: _("Invalid datetime")})
+                queryset = queryset.filter(**{lookup: value})
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        # rendered from values() rows rather than serialized, cached per user until their jobs change
+        user_plan = get_user_plan_config(request.user.pk)
+        if user_plan is None:
+            return super().list(request, *args, **kwargs)
+        # read before the rows: a page rendered from rows changed meanwhile is cached under the stale version
+        key = joblist.page_key(user_plan.id, joblist.list_version(user_plan.id), request)
+        data = cache.get(key) if settings.IMAGE_JOB_LIST_CACHE_TIMEOUT else None
+        if data is None:
+            now = timezone.now()
+            queryset = self.filter_queryset(self.get_queryset()).values(*joblist.JOB_FIELDS)
+            results, first_expiry = joblist.render_jobs(request, self.paginate_queryset(queryset), now)
+            data = {"next": self.paginator.get_next_link(), "results": results}
+            # links expiring drop out of the page
+            timeout = settings.IMAGE_JOB_LIST_CACHE_TIMEOUT
+            if first_expiry:
+                timeout = min(timeout, int((first_expiry - now).total_seconds()))
+            if timeout > 0:
+                cache.set(key, data, timeout)
+
+        etag = joblist.etag(data, request.accepted_media_type)
+        conditional = get_conditional_response(request._request, etag=etag)
+        response = Response(status=conditional.status_code) if conditional else Response(data)
+        response["ETag"] = etag
+        response["Cache-Control"] = "private, no-cache"
+        patch_vary_headers(response, ["Accept"])
+        return response
+
+    def perform_create(self, serializer):
+        super().perform_create(serializer)
+        joblist.jobs_changed([serializer.instance.user_plan_id])
+        dispatch_image_jobs([serializer.instance.id])
+
+
+class ImageJobEventsView(generics.GenericAPIView):
+    # status changes of the user's jobs, pushed as server-sent events or long-polled from a cursor
+    permission_classes = [IsAuthenticated]
+    renderer_classes = [*api_settings.DEFAULT_RENDERER_CLASSES, EventStreamRenderer]
+
+    def get_queryset(self):
+        return ImageJob.objects.filter(user_plan__user=self.request.user).prefetch_related("thumbnails")
+
+    def get(self, request, *args, **kwargs):
+        if not events.enabled():
+            raise Http404()
+        user_plan = get_user_plan_config(request.user.pk)
+        if user_plan is None:
+            raise ValidationError(_("User plan required"))
+        # Last-Event-ID is sent by reconnecting event sources
+        cursor = request.headers.get("Last-Event-ID") or request.query_params.get("since")
+        if cursor is not None and not events.CURSOR_RE.match(cursor):
+            raise ValidationError({"since": _("Invalid cursor")})
+
+        if isinstance(request.accepted_renderer, EventStreamRenderer):
+            cursor = cursor or events.last_cursor(user_plan.id)
+            # django buffers a whole stream of the other kind, served by an event loop an idle stream holds no thread
+            asgi = isinstance(request._request, ASGIRequest)
+            response = StreamingHttpResponse(
+                self._async_event_stream(user_plan.id, cursor) if asgi else self._event_stream(user_plan.id, cursor),
+                content_type="text/event-stream",
+            )
+            response["Cache-Control"] = "no-cache"
+            response["X-Accel-Buffering"] = "no"  # nginx would hold the events back
+            return response
+
+        # long poll: without a cursor, the current one to start from
+        if cursor is None:
+            return Response({"cursor": events.last_cursor(user_plan.id), "jobs": []})
+        jobs = self._jobs(events.read_events(user_plan.id, cursor, settings.JOB_EVENTS_POLL_TIMEOUT))
+        return Response({"cursor": jobs[-1][0] if jobs else cursor, "jobs": [job for _, job in jobs]})
+
+    def _jobs(self, job_events: List[events.Event]) -> List[Tuple[str, Dict]]:
+        # events only name the jobs, their current state is rendered like in the job list
+        cursors: Dict[int, str] = {}
+        for cursor, event in job_events:
+            cursors.pop(int(event["id"]), None)  # ordered by the job's last event
+            cursors[int(event["id"])] = cursor
+        img_jobs = self.get_queryset().in_bulk(list(cursors))
+        return [
+            (cursor, ImageJobSerializer(img_jobs[img_job_id], context={"request": self.request}).data)
+            for img_job_id, cursor in cursors.items()
+            if img_job_id in img_jobs
+        ]
+
+    def _event_stream(self, user_plan_id: int, cursor: str) -> Iterator[str]:
+        # ends after a while, event sources reconnect with the Last-Event-ID
+        deadline = time.monotonic() + settings.JOB_EVENTS_STREAM_TIMEOUT
+        while time.monotonic() < deadline:
+            job_events = events.read_events(user_plan_id, cursor, settings.JOB_EVENTS_HEARTBEAT)
+            if not job_events:
+                yield ": keepalive\n\n"
+                continue
+            cursor = job_events[-1][0]
+            for job_cursor, job in self._jobs(job_events):
+                yield self._event(job_cursor, job)
+
+    async def _async_event_stream(self, user_plan_id: int, cursor: str) -> AsyncIterator[str]:
+        deadline = time.monotonic() + settings.JOB_EVENTS_STREAM_TIMEOUT
+        async with events.async_client() as client:
+            while time.monotonic() < deadline:
+                job_events = await events.aread_events(client, user_plan_id, cursor, settings.JOB_EVENTS_HEARTBEAT)
+                if not job_events:
+                    yield ": keepalive\n\n"
+                    continue
+                cursor = job_events[-1][0]
+                for job_cursor, job in await sync_to_async(self._jobs)(job_events):
+                    yield self._event(job_cursor, job)
+
+    def _event(self, cursor: str, job: Dict) -> str:
+        return f"id: {cursor}\nevent: status\ndata: {json.dumps(job, cls=JSONEncoder)}\n\n"
+
+
+class ImageJobBatchView(generics.CreateAPIView):
+    permission_classes = [IsAuthenticated]
+    parser_class = [MultiPartParser, FormParser]
+
+    def get_serializer(self, *args, **kwargs):
+        return NewImageJobBatchSerializer(self.request.user, *args, **kwargs)
 
     def perform_create(self, serializer):
         super().perform_create(serializer)
-        process_image_job.delay(serializer.instance.id)
+        joblist.jobs_changed([serializer.instance.user_plan_id])
+        dispatch_image_jobs(serializer.data["jobs"])
+
+
+class ImageJobBatchDetailView(generics.RetrieveAPIView):
+    permission_classes = [IsAuthenticated]
+    serializer_class = ImageJobBatchSerializer
+
+    def get_queryset(self):
+        return ImageJobBatch.objects.filter(user_plan__user=self.request.user).prefetch_related("jobs__thumbnails")
 
 
 class ApiCore(generics.GenericAPIView):
@@ -48,15 +227,98 @@ class ApiCore(generics.GenericAPIView):
         return Response(
             {
                 "image-jobs": request.build_absolute_uri(reverse("image-jobs")),
+                "image-job-batches": request.build_absolute_uri(reverse("image-job-batches")),
+                "image-job-events": request.build_absolute_uri(reverse("image-job-events")),
             }
         )
 
 
-@api_view(["GET"])
-def ext_image(request: HttpRequest, external_id: str, fmt: str) -> HttpResponse:
-    thumbnail = get_object_or_404(Thumbnail, external_id=external_id)
-    valid_fmt = os.path.splitext(thumbnail.image.path)[-1] == "." + fmt
+def _link_cache_control(expires_at: Optional[datetime]) -> Dict:
+    # cacheable until the external link expires
+    max_age = int((expires_at - timezone.now()).total_seconds()) if expires_at else 0
+    return {"public": True, "max_age": max(max_age, 0)}
+
+
+def _thumbnail_response(request: HttpRequest, name: str, fmt: str, **cache_control) -> HttpResponse:
+    # the thumbnail's own extension negotiates the best format the client accepts,
+    # a variant's extension asks for that format explicitly
+    if fmt == os.path.splitext(name)[-1][1:]:
+        accepted = accepted_variants(request)
+        response = file_response(request, materialize_variant(name, accepted[0]) if accepted else name, **cache_control)
+        if variant_formats():
+            patch_vary_headers(response, ["Accept"])
+        return response
+    if fmt in variant_formats():
+        return file_response(request, materialize_variant(name, fmt), **cache_control)
+    raise Http404()
+
+
+def _ext_image_response(request: HttpRequest, thumbnail: Thumbnail, fmt: str) -> HttpResponse:
+    thumbnail = materialize_thumbnail(thumbnail)
+    return _thumbnail_response(
+        request, thumbnail.image.name, fmt, **_link_cache_control(thumbnail.external_id_expires_at)
+    )
+
+
+async def ext_image(request: HttpRequest, external_id: str, fmt: str) -> HttpResponse:
+    # plain async django view: public links need no session, and the lookup doesn't occupy a thread under asgi
+    if request.method not in ("GET", "HEAD"):
+        return HttpResponseNotAllowed(["GET", "HEAD"])
+    try:
+        thumbnail = await Thumbnail.objects.select_related("image_job").aget(external_id=external_id)
+    except (Thumbnail.DoesNotExist, DjangoValidationError):  # not a uuid
+        raise Http404()
+    valid_fmt = thumbnail.ext == "." + fmt or fmt in variant_formats()
     expired = thumbnail.external_id_expires_at and thumbnail.external_id_expires_at < timezone.now()
     if not valid_fmt or expired:
         raise Http404()
-    return redirect(thumbnail.image.url)
+    # rendering a lazy thumbnail and the file's metadata are blocking
+    return await sync_to_async(_ext_image_response)(request, thumbnail, fmt)
+
+
+@require_safe
+def ext_image_signed(request: HttpRequest, token: str, fmt: str) -> HttpResponse:
+    # plain django view: neither the db nor the session is touched
+    resolved = resolve_external_link(token)
+    if resolved is None:
+        raise Http404()
+    name, expires_at = resolved
+    return _thumbnail_response(request, name, fmt, **_link_cache_control(expires_at))
+
+
+@api_view(["GET"])
+@permission_classes([IsAuthenticated])
+def thumbnail_image(request: HttpRequest, pk: int) -> HttpResponse:
+    thumbnail = get_object_or_404(
+        Thumbnail.objects.select_related("image_job"), pk=pk, image_job__user_plan__user=request.user
+    )
+    thumbnail = materialize_thumbnail(thumbnail)
+    return _thumbnail_response(
+        request, thumbnail.image.name, thumbnail.ext[1:], private=True, max_age=settings.MEDIA_CACHE_MAX_AGE
+    )
+
+
+@require_GET
+def metrics_view(request: HttpRequest) -> HttpResponse:
+    if not settings.METRICS_ENABLED:
+        raise Http404()
+    authorization = request.headers.get("Authorization", "")
+    if settings.METRICS_TOKEN and not constant_time_compare(authorization, f"Bearer {settings.METRICS_TOKEN}"):
+        return HttpResponse(status=401)
+    return HttpResponse(metrics.exposition(), content_type=CONTENT_TYPE_LATEST)
+
+
+@require_safe
+def media(request: HttpRequest, name: str) -> HttpResponse:
+    # django only streams media itself in development, in production the front proxy sends the body
+    if not settings.DEBUG and settings.MEDIA_DELIVERY == "django":
+        raise Http404()
+    if name.startswith(THUMBNAIL_UPLOAD_TO):
+        # thumbnail names are never reused for other content
+        cache_control = {"public": True, "max_age": settings.THUMBNAIL_CACHE_MAX_AGE, "immutable": True}
+        ext = os.path.splitext(name)[-1]
+        if ext in SUPPORTED_IMG_FORMATS:
+            return _thumbnail_response(request, name, ext[1:], **cache_control)
+        return file_response(request, name, **cache_control)
+    # users' uploads, not for shared caches
+    return file_response(request, name, private=True, max_age=settings.MEDIA_CACHE_MAX_AGE)
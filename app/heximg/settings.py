@@ -115,9 +115,174 @@ STATIC_ROOT = BASE_DIR / "staticfiles"
 
 MEDIA_URL = "/media/"
 MEDIA_ROOT = BASE_DIR / "mediafiles"
+# tests run against a temporary MEDIA_ROOT
+TEST_RUNNER = "heximg.test_runner.TemporaryMediaRunner"
+# "filesystem" keeps media in MEDIA_ROOT, "s3" in an S3 compatible bucket shared by every host
+MEDIA_STORAGE = os.environ.get("MEDIA_STORAGE", "filesystem")
+MEDIA_S3_BUCKET = os.environ.get("MEDIA_S3_BUCKET")
+# minio or another stand-in, aws when unset; credentials come from the usual AWS_* variables
+MEDIA_S3_ENDPOINT_URL = os.environ.get("MEDIA_S3_ENDPOINT_URL")
+MEDIA_S3_REGION = os.environ.get("MEDIA_S3_REGION")
+# cdn in front of the bucket, its urls aren't presigned
+MEDIA_S3_CUSTOM_DOMAIN = os.environ.get("MEDIA_S3_CUSTOM_DOMAIN")
+MEDIA_S3_URL_EXPIRE = int(os.environ.get("MEDIA_S3_URL_EXPIRE", 60 * 60))
+MEDIA_S3_MAX_POOL_CONNECTIONS = int(os.environ.get("MEDIA_S3_MAX_POOL_CONNECTIONS", 32))
+MEDIA_S3_MULTIPART_THRESHOLD = 8 * 1024 * 1024
+MEDIA_S3_MULTIPART_CHUNKSIZE = 8 * 1024 * 1024
+MEDIA_S3_MAX_CONCURRENCY = 4
+STORAGES = {
+    "default": {
+        "BACKEND": {
+            "filesystem": "django.core.files.storage.FileSystemStorage",
+            "s3": "core.storage.S3MediaStorage",
+        }[MEDIA_STORAGE]
+    },
+    "staticfiles": {"BACKEND": "django.contrib.staticfiles.storage.StaticFilesStorage"},
+}
+# "django" streams media files itself, "x-accel" (nginx) and "x-sendfile" (apache, lighttpd)
+# leave the file body to the front proxy
+MEDIA_DELIVERY = os.environ.get("MEDIA_DELIVERY", "django")
+# internal nginx location aliasing MEDIA_ROOT
+MEDIA_ACCEL_REDIRECT_PREFIX = os.environ.get("MEDIA_ACCEL_REDIRECT_PREFIX", "/protected-media/")
+MEDIA_CACHE_MAX_AGE = 24 * 60 * 60
+THUMBNAIL_CACHE_MAX_AGE = 365 * 24 * 60 * 60
+
+# uploads are hashed while streaming in, for deduplication
+FILE_UPLOAD_HANDLERS = [
+    "core.uploadhandlers.HashingMemoryFileUploadHandler",
+    "core.uploadhandlers.HashingTemporaryFileUploadHandler",
+]
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/4.2/ref/settings/#default-auto-field
 
 DEFAULT_AUTO_FIELD = "django.db.models.BigAutoField"
 
 CELERY_BROKER_URL = os.environ.get("CELERY_BROKER_URL", "redis://localhost:6379")
+
+# retention sweeps, run by a single celery beat
+CELERY_BEAT_SCHEDULE = {
+    "reclaim-image-jobs": {"task": "core.tasks.reclaim_image_jobs", "schedule": 60},
+    "recount-lazy-thumbnails": {"task": "core.tasks.recount_lazy_thumbnails", "schedule": 60 * 60},
+    "sweep-expired-links": {"task": "core.tasks.sweep_expired_links", "schedule": 5 * 60},
+    "sweep-failed-jobs": {"task": "core.tasks.sweep_failed_jobs", "schedule": 60 * 60},
+    "reconcile-media-files": {"task": "core.tasks.reconcile_media_files", "schedule": 24 * 60 * 60},
+    "prune-in-flight-jobs": {"task": "core.tasks.prune_in_flight_jobs", "schedule": 10 * 60},
+}
+
+# Cache shared by the API and the workers, local memory when no CACHE_URL is given
+
+if os.environ.get("CACHE_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.environ["CACHE_URL"],
+        }
+    }
+
+# cache alias shared by the processes revoking signed external links, revocation is disabled when empty.
+# every process holds the revoked links in memory and asks the cache for new ones every few seconds
+EXTERNAL_LINK_REVOCATION_CACHE = os.environ.get("EXTERNAL_LINK_REVOCATION_CACHE", "default")
+EXTERNAL_LINK_REVOCATION_CHECK_INTERVAL = 2
+# revoked links held by a process, the first to expire are dropped beyond it
+EXTERNAL_LINK_REVOCATION_MAX = 10000
+
+# Plan configuration cached in every process, checked for invalidation every few seconds
+
+PLAN_CONFIG_CHECK_INTERVAL = 2
+PLAN_CONFIG_CACHE_USERS = 10000
+
+# Prometheus metrics of the API (/metrics) and the workers (own http server); set PROMETHEUS_MULTIPROC_DIR
+# with prefork workers or multi-process servers
+
+METRICS_ENABLED = bool(int(os.environ.get("METRICS_ENABLED", 0)))
+# bearer token required by /metrics, open without
+METRICS_TOKEN = os.environ.get("METRICS_TOKEN")
+METRICS_WORKER_PORT = int(os.environ.get("METRICS_WORKER_PORT", 9808))
+
+if METRICS_ENABLED:
+    MIDDLEWARE.insert(0, "core.metrics.RequestMetricsMiddleware")
+
+# Image job status events, a redis stream per user plan; image-jobs/events/ is disabled without JOB_EVENTS_URL
+
+JOB_EVENTS_URL = os.environ.get("JOB_EVENTS_URL")
+JOB_EVENTS_STREAM_LENGTH = 1000
+JOB_EVENTS_STREAM_TTL = 24 * 60 * 60
+JOB_EVENTS_READ_COUNT = 100
+# seconds a long poll waits for events
+JOB_EVENTS_POLL_TIMEOUT = 25
+# seconds between keepalive comments of an idle event stream, and until the stream ends for the client to reconnect
+JOB_EVENTS_HEARTBEAT = 15
+JOB_EVENTS_STREAM_TIMEOUT = 300
+
+# Per plan admission limits (Plan upload rate, jobs in flight, megapixels per hour) as token buckets in redis,
+# not enforced without RATE_LIMIT_URL
+
+RATE_LIMIT_URL = os.environ.get("RATE_LIMIT_URL")
+# seconds clients with too many jobs in flight are asked to wait
+RATE_LIMIT_IN_FLIGHT_RETRY_AFTER = 5
+# seconds after its admission an upload still counted in flight is dropped, releases of jobs never created don't stick
+RATE_LIMIT_IN_FLIGHT_TTL = 24 * 60 * 60
+# seconds an admitted upload may take to get its job before pruning drops it from the jobs in flight
+RATE_LIMIT_IN_FLIGHT_GRACE = 10 * 60
+
+# Image jobs
+
+IMAGE_JOB_PAGE_SIZE = 50
+IMAGE_JOB_MAX_PAGE_SIZE = 500
+# seconds a rendered job list page is cached for, until the user's jobs change; 0 disables.
+# the cache must be shared with the workers (CACHE_URL), they invalidate the pages
+IMAGE_JOB_LIST_CACHE_TIMEOUT = int(
+    os.environ.get("IMAGE_JOB_LIST_CACHE_TIMEOUT", 300 if os.environ.get("CACHE_URL") else 0)
+)
+IMAGE_JOB_BATCH_MAX_FILES = int(os.environ.get("IMAGE_JOB_BATCH_MAX_FILES", 100))
+# opt-in: values > 1 make workers pull new jobs in batches of this size instead of one task per job
+IMAGE_JOB_MICRO_BATCH_SIZE = int(os.environ.get("IMAGE_JOB_MICRO_BATCH_SIZE", 0))
+IMAGE_JOB_MICRO_BATCH_SCHEDULE_TIMEOUT = 60
+# originals larger than this go to the heavy-image worker pool instead of their plan's queue
+IMAGE_JOB_HEAVY_QUEUE = os.environ.get("IMAGE_JOB_HEAVY_QUEUE", "images-heavy")
+IMAGE_JOB_HEAVY_SIZE = int(os.environ.get("IMAGE_JOB_HEAVY_SIZE", 20 * 1024 * 1024))
+IMAGE_JOB_HEAVY_PIXELS = int(os.environ.get("IMAGE_JOB_HEAVY_PIXELS", 50_000_000))
+# uploads above are rejected, Pillow's decompression bomb check is aligned with it
+IMAGE_JOB_MAX_PIXELS = int(os.environ.get("IMAGE_JOB_MAX_PIXELS", 250_000_000))
+# consumed apart from the live queues, so backfilling thumbnails doesn't delay new jobs
+IMAGE_JOB_BACKFILL_QUEUE = os.environ.get("IMAGE_JOB_BACKFILL_QUEUE", "images-backfill")
+# a claimed job not finished within its lease (seconds, longer than a micro-batch takes) is taken to be lost
+# with its worker and retried after an exponential backoff, failed after IMAGE_JOB_MAX_ATTEMPTS claims
+IMAGE_JOB_LEASE = int(os.environ.get("IMAGE_JOB_LEASE", 15 * 60))
+IMAGE_JOB_MAX_ATTEMPTS = int(os.environ.get("IMAGE_JOB_MAX_ATTEMPTS", 3))
+IMAGE_JOB_RETRY_BACKOFF = 60
+IMAGE_JOB_REAPER_BATCH_SIZE = 500
+# seconds of recently started jobs the queue wait time metrics are computed over
+IMAGE_JOB_METRICS_WINDOW = 300
+
+# Thumbnails
+
+THUMBNAIL_THREADS = int(os.environ.get("THUMBNAIL_THREADS", 4))
+# encoded thumbnails larger than this are spooled to a temporary file instead of memory
+THUMBNAIL_SPOOL_MAX_SIZE = int(os.environ.get("THUMBNAIL_SPOOL_MAX_SIZE", 1024 * 1024))
+# decoded originals above are downscaled a strip at a time where the format allows it
+THUMBNAIL_DECODE_BUDGET = int(os.environ.get("THUMBNAIL_DECODE_BUDGET", 256 * 1024 * 1024))
+# modern formats thumbnails are also stored in, served to clients accepting them (avif needs Pillow support),
+# e.g. "avif,webp"; none by default, each one is another encode of every thumbnail
+THUMBNAIL_VARIANT_FORMATS = [fmt for fmt in os.environ.get("THUMBNAIL_VARIANT_FORMATS", "").split(",") if fmt]
+# variants are rendered with their thumbnails, otherwise on first request
+THUMBNAIL_VARIANTS_EAGER = bool(int(os.environ.get("THUMBNAIL_VARIANTS_EAGER", 0)))
+THUMBNAIL_VARIANT_QUALITY = 80
+# disk budget of rendered lazy thumbnails, least recently used ones are evicted above it; their total is kept
+# in the shared cache and recounted hourly
+LAZY_THUMBNAIL_CACHE_BYTES = int(os.environ.get("LAZY_THUMBNAIL_CACHE_BYTES", 1024 * 1024 * 1024))
+# seconds between last access updates of a lazy thumbnail
+LAZY_THUMBNAIL_TOUCH_INTERVAL = 60
+# seconds a render on request holds its lock in the shared cache at most, and between checks of its waiters
+RENDER_LOCK_TIMEOUT = 60
+RENDER_LOCK_POLL_INTERVAL = 0.05
+
+# Retention
+
+# rows per batch of the retention sweeps, each batch is its own short transaction
+RETENTION_BATCH_SIZE = 500
+# seconds until the originals of failed jobs are deleted
+RETENTION_FAILED_JOBS_AFTER = int(os.environ.get("RETENTION_FAILED_JOBS_AFTER", 7 * 24 * 60 * 60))
+# files younger than this may belong to uncommitted jobs, the reconciler leaves them
+RETENTION_ORPHAN_GRACE = 24 * 60 * 60
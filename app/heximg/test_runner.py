@@ -0,0 +1,18 @@
+import tempfile
+
+from django.test import override_settings
+from django.test.runner import DiscoverRunner
+
+
+class TemporaryMediaRunner(DiscoverRunner):
+    # the originals, thumbnails and variants tests write go to a MEDIA_ROOT removed after the run
+    def setup_test_environment(self, **kwargs):
+        self._media_root = tempfile.TemporaryDirectory(prefix="heximg-media-")
+        self._media_settings = override_settings(MEDIA_ROOT=self._media_root.name)
+        self._media_settings.enable()
+        super().setup_test_environment(**kwargs)
+
+    def teardown_test_environment(self, **kwargs):
+        super().teardown_test_environment(**kwargs)
+        self._media_settings.disable()
+        self._media_root.cleanup()
@@ -1,12 +1,19 @@
+import re
+
 from django.conf import settings
-from django.conf.urls.static import static
 from django.contrib import admin
-from django.urls import include, path
+from django.urls import include, path, re_path
+
+from core import views as core_views
 
 urlpatterns = [
     path("admin/", admin.site.urls),
     path("api/core/", include("core.urls")),
     path("api-auth/", include("rest_framework.urls")),
-] + static(
-    settings.MEDIA_URL, document_root=settings.MEDIA_ROOT
-)  # type: ignore
+    path("metrics", core_views.metrics_view, name="metrics"),
+    re_path(
+        r"^{}(?P<name>(?:original|thumbs)/[^/]+)$".format(re.escape(settings.MEDIA_URL.lstrip("/"))),
+        core_views.media,
+        name="media",
+    ),
+]
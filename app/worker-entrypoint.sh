@@ -1,5 +1,5 @@
 #!/bin/sh
 
-celery -A heximg worker -l INFO
+celery -A heximg worker -l INFO -Q celery,images-enterprise,images-premium,images,images-heavy,images-backfill
 
 exec "$@"
\ No newline at end of file